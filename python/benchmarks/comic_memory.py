@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+# Memory kept by the references in the bot
+#   refs    : the json references, dicts of dicts with the transcripts
+#   table   : comics.ComicTable of them, the references dropped (json path
+#             of the bot)
+#   jsonl   : same table, the line delimited references read one at a time
+#             (client_helpers.loadComics)
+#   snapshot: ComicTable of a snapshot
+# Each one is loaded in its own process:
+#   heap: python allocations still alive once loaded (tracemalloc)
+#   peak: most python allocations alive at once while loading
+#   rss : resident set size, the interpreter included
+# Also times a lookup (reference -> comic -> title), what a reply does.
+#
+# Usage: python comic_memory.py [path/to/json/dir/]
+# Needs no discord.py, a module standing in for it is used if it's missing.
+
+import os
+import sys
+import json
+import random
+import tempfile
+import subprocess
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+LIB = os.path.join (HERE, '..', 'lib')
+JSON = sys.argv[1] if len (sys.argv) > 1 else \
+        os.path.join (HERE, '..', '..', 'json', '')
+MODES = ('refs', 'table', 'jsonl', 'snapshot')
+LOOKUPS = 100000
+
+# Run by each process: python comic_memory.py --child MODE DIR
+CHILD = '--child'
+
+def stand_in ():
+    import types
+    sys.path.insert (0, LIB)
+    try:
+        import discord
+    except ImportError:
+        sys.modules['discord'] = types.ModuleType ('discord')
+
+def child (mode, root):
+    import gc
+    import time
+    import tracemalloc
+    stand_in ()
+    import client_helpers as CLIENT
+    import snapshot as SNAPSHOT
+    from comics import ComicTable
+
+    refs_file = os.path.join (root, 'xkcd.references.json')
+    tracemalloc.start ()
+    if mode == 'refs':
+        refs = CLIENT.loadJson (refs_file)
+    elif mode == 'table':
+        refs = ComicTable.of (CLIENT.loadJson (refs_file))
+    elif mode == 'jsonl':
+        refs = CLIENT.loadComics (os.path.join (root, 'xkcd.jsonl.json'))
+    else:
+        refs = SNAPSHOT.load (os.path.join (root, 'xkcd.snapshot'))['refs']
+    gc.collect ()
+    heap, peak = tracemalloc.get_traced_memory ()
+    tracemalloc.stop ()
+
+    keys = random.Random (42).choices (list (refs), k = LOOKUPS)
+    start = time.perf_counter ()
+    for k in keys:
+        comic = refs[k]['comic']
+        if comic:
+            comic['title']
+    lookup = (time.perf_counter () - start) / LOOKUPS * 1e6
+
+    with open ('/proc/self/statm') as statm:
+        rss = int (statm.read ().split ()[1]) * os.sysconf ('SC_PAGE_SIZE')
+    print (json.dumps ({'heap': heap // 1024, 'peak': peak // 1024,
+        'rss': rss // 1024, 'lookup': lookup}))
+
+def prepare (root, tmp):
+    stand_in ()
+    import client_helpers as CLIENT
+    import snapshot as SNAPSHOT
+    import refs_jsonl as REFS_JSONL
+
+    refs = CLIENT.loadJson (os.path.join (root, 'xkcd.references.json'))
+    # Only the .jsonl next to it is read (see loadComics)
+    REFS_JSONL.write (os.path.join (tmp, 'xkcd.jsonl.jsonl'), refs.items ())
+    SNAPSHOT.write (os.path.join (tmp, 'xkcd.snapshot'), dict (),
+            refs.items (), ())
+    os.symlink (os.path.abspath (os.path.join (root, 'xkcd.references.json')),
+            os.path.join (tmp, 'xkcd.references.json'))
+
+def main ():
+    with tempfile.TemporaryDirectory () as tmp:
+        prepare (JSON, tmp)
+        print ('{:<10}{:>11}{:>11}{:>11}{:>13}'.format (
+            'refs', 'heap (kB)', 'peak (kB)', 'rss (kB)', 'lookup (us)'))
+        for mode in MODES:
+            out = subprocess.check_output ([sys.executable,
+                os.path.abspath (__file__), CHILD, mode, tmp])
+            r = json.loads (out.decode ().splitlines ()[-1])
+            print ('{:<10}{:>11}{:>11}{:>11}{:>13.2f}'.format (
+                mode, r['heap'], r['peak'], r['rss'], r['lookup']))
+
+if __name__ == '__main__':
+    if len (sys.argv) > 1 and sys.argv[1] == CHILD:
+        child (sys.argv[2], sys.argv[3])
+    else:
+        main ()
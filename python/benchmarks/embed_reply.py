@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+# Reply construction latency for --random and --search results:
+#   before: list (refs.keys ()) + random.choice + a new discord.Embed
+#   after : random pick in the EmbedCache numbers + cached embed
+#
+# Usage: python embed_reply.py [path/to/json/dir/]
+# Needs discord.py, like the bot.
+
+import os
+import sys
+import json
+import time
+import random
+
+LIB = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'lib')
+sys.path.insert (0, LIB)
+from embed_cache import EmbedCache, build_embed
+
+JSON = sys.argv[1] if len (sys.argv) > 1 else \
+        os.path.join (os.path.dirname (os.path.abspath (__file__)),
+                '..', '..', 'json', '')
+REFS = JSON + 'xkcd.references.json'
+REPLIES = 20000
+
+def timed (f):
+    start = time.perf_counter ()
+    for i in range (REPLIES):
+        f ()
+    return (time.perf_counter () - start) / REPLIES * 1e6
+
+def main ():
+    with open (REFS) as infile:
+        refs = json.load (infile)
+    valid = [k for k in refs if refs[k]['comic']]
+
+    # What random_embed and create_embed did for every reply
+    def random_before ():
+        key = random.choice (list (refs.keys ()))
+        if refs[key]['comic']:
+            build_embed (refs[key]['comic'])
+
+    def search_before ():
+        build_embed (refs[random.choice (valid)]['comic'])
+
+    start = time.perf_counter ()
+    embeds = EmbedCache (refs)
+    build = (time.perf_counter () - start) * 1000
+
+    def random_after ():
+        embeds.random ()
+
+    def search_after ():
+        embeds.get (refs[random.choice (valid)])
+
+    # Warm the cache so that the timings are the steady state
+    for k in valid:
+        embeds.get (refs[k])
+
+    print ('EmbedCache built in {:.1f} ms for {} comics'.format (
+        build, len (embeds.nums)))
+    print ('{:<10}{:>14}{:>14}'.format ('reply', 'before (us)', 'after (us)'))
+    print ('{:<10}{:>14.2f}{:>14.2f}'.format (
+        '--random', timed (random_before), timed (random_after)))
+    print ('{:<10}{:>14.2f}{:>14.2f}'.format (
+        '--search', timed (search_before), timed (search_after)))
+
+if __name__ == '__main__':
+    main ()
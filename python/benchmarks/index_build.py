@@ -0,0 +1,89 @@
+#!/usr/bin/python
+
+# Time of the full build of scraper/index.py (without writing the files),
+# with the stop words in the json list it used to test every word against,
+# and in the frozenset of tokenizer.stop_words. Also checks that both build
+# the same index.
+#
+# Usage: python index_build.py [path/to/json/dir/]
+
+import os
+import sys
+import json
+import time
+
+LIB = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'lib')
+sys.path.insert (0, LIB)
+import tokenizer as TOKENIZER
+import xkcd_helpers as XKCD
+
+JSON = sys.argv[1] if len (sys.argv) > 1 else \
+        os.path.join (os.path.dirname (os.path.abspath (__file__)),
+                '..', '..', 'json', '')
+REFS = JSON + 'xkcd.references.json'
+BLACK_LIST = JSON + 'xkcd.common.json'
+ROUNDS = 3
+
+# Same as index.comic_text
+def comic_text (ref):
+    transcript = str ()
+    title = str ()
+    alt = str ()
+    if ref['stat_com']['status'] == 0:
+        title = ref['comic']['title']
+        alt = ref['comic']['alt']
+        if ref['stat_tr']['status'] >= -1:
+            transcript = XKCD.removeNoise (ref['comic']['transcript'])
+    return '{} {} {}'.format (title, alt, transcript)
+
+# The loop of index.py before: every token tested against the list
+def build_list (refs, black_list):
+    index = dict ()
+    for i in refs:
+        single = dict ()
+        XKCD.indexTokens (TOKENIZER.tokens (comic_text (refs[i])), i, single,
+                black_list)
+        for w in single:
+            index.setdefault (w, dict ())[i] = single[w][i]
+    return index
+
+# The loop of index.py now: TOKENIZER.terms with the set
+def build_set (refs, black_list):
+    index = dict ()
+    for i in refs:
+        single = dict ()
+        XKCD.indexTokens (TOKENIZER.terms (comic_text (refs[i]), black_list),
+                i, single, ())
+        for w in single:
+            index.setdefault (w, dict ())[i] = single[w][i]
+    return index
+
+def bench (f, refs, black_list):
+    best = None
+    for r in range (ROUNDS):
+        start = time.perf_counter ()
+        index = f (refs, black_list)
+        elapsed = time.perf_counter () - start
+        best = elapsed if best is None else min (best, elapsed)
+    return best, index
+
+def main ():
+    with open (REFS) as infile:
+        refs = json.load (infile)
+    with open (BLACK_LIST) as infile:
+        as_list = json.load (infile)
+    as_set = TOKENIZER.stop_words (BLACK_LIST)
+
+    list_time, list_index = bench (build_list, refs, as_list)
+    set_time, set_index = bench (build_set, refs, as_set)
+
+    print ('{} comics, {} stop words, {} words indexed, {}'.format (
+        len (refs), len (as_set), len (set_index),
+        'same index' if list_index == set_index else 'INDEXES DIFFER'))
+    print ('{:<12}{:>12}{:>12}'.format ('stop words', 'time (ms)', 'speedup'))
+    for name, elapsed in (('list', list_time), ('frozenset', set_time)):
+        print ('{:<12}{:>12.1f}{:>11.2f}x'.format (
+            name, elapsed * 1000, list_time / elapsed))
+
+if __name__ == '__main__':
+    main ()
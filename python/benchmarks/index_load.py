@@ -0,0 +1,108 @@
+#!/usr/bin/python
+
+# Compare the json index, the compiled index and the mapped compiled index
+#   - resident memory after loading (each loader runs in its own process)
+#   - load time
+#   - lookup latency: fetch the postings of a word and walk them
+#
+# Usage: python index_load.py [path/to/json/dir/]
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import subprocess
+
+LIB = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'lib')
+sys.path.insert (0, LIB)
+from compiled_index import CompiledIndex
+
+JSON = sys.argv[1] if len (sys.argv) > 1 else \
+        os.path.join (os.path.dirname (os.path.abspath (__file__)),
+                '..', '..', 'json', '')
+INDEX = JSON + 'xkcd.index.json'
+LOOKUPS = 100000
+
+# Current resident set size, in kB
+def rss ():
+    try:
+        with open ('/proc/self/statm') as statm:
+            pages = int (statm.read ().split ()[1])
+        return pages * os.sysconf ('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+
+def load_json (f):
+    with open (f) as infile:
+        return json.load (infile)
+
+# Runs in a child process, prints a json line with the measures
+# words is a file with one word to look up per line
+def child (kind, f, words):
+    with open (words) as infile:
+        words = infile.read ().split ('\n')
+    before = rss ()
+
+    start = time.perf_counter ()
+    if kind == 'json':
+        index = load_json (f)
+    elif kind == 'mapped':
+        index = CompiledIndex.open (f)
+    else:
+        index = CompiledIndex.load (f)
+    load_time = time.perf_counter () - start
+    after = rss ()
+
+    start = time.perf_counter ()
+    total = 0
+    for w in words:
+        for comic, count in index[w].items ():
+            total += count
+    lookup_time = time.perf_counter () - start
+
+    print (json.dumps ({
+        'kind': kind,
+        'rss_kb': after - before,
+        'load_ms': load_time * 1000,
+        'lookup_us': lookup_time / LOOKUPS * 1e6,
+        'total': total}))
+
+def run (kind, f, words):
+    out = subprocess.check_output (
+            [sys.executable, __file__, '--child', kind, f, words])
+    return json.loads (out.decode ('utf-8').splitlines ()[-1])
+
+def main ():
+    with tempfile.TemporaryDirectory () as tmp:
+        compiled = os.path.join (tmp, 'xkcd.index.bin')
+        index = load_json (INDEX)
+        CompiledIndex.from_dict (index).save (compiled)
+
+        words = os.path.join (tmp, 'words.txt')
+        with open (words, 'w') as outfile:
+            outfile.write ('\n'.join (
+                random.Random (42).choices (list (index), k = LOOKUPS)))
+        del index
+
+        results = [
+                run ('json', INDEX, words),
+                run ('compiled', compiled, words),
+                run ('mapped', compiled, words)]
+        if len (set (r['total'] for r in results)) != 1:
+            print ('Warning: both indexes do not return the same postings')
+
+        print ('{:<10}{:>12}{:>12}{:>14}{:>12}'.format (
+            'index', 'size (kB)', 'RSS (kB)', 'load (ms)', 'lookup (us)'))
+        for r, f in zip (results, (INDEX, compiled, compiled)):
+            print ('{:<10}{:>12}{:>12}{:>14.1f}{:>12.2f}'.format (
+                r['kind'], os.path.getsize (f) // 1024, r['rss_kb'],
+                r['load_ms'], r['lookup_us']))
+
+if __name__ == '__main__':
+    if len (sys.argv) > 1 and sys.argv[1] == '--child':
+        child (sys.argv[2], sys.argv[3], sys.argv[4])
+    else:
+        main ()
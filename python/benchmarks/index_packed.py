@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+# Compare the compiled index (uint32 arrays) and the packed index (delta +
+# varint postings) built from the json index
+#   - size on disk
+#   - build time: json dict -> index -> file
+#   - decode speed: every posting list decoded once, packed without its
+#     cache (the compiled one has nothing to decode, it's the baseline)
+#   - lookup latency: postings of random words, walked
+# Also checks that both give the same postings.
+#
+# Usage: python index_packed.py [path/to/json/dir/]
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+LIB = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'lib')
+sys.path.insert (0, LIB)
+from compiled_index import CompiledIndex
+from packed_index import PackedIndex
+
+JSON = sys.argv[1] if len (sys.argv) > 1 else \
+        os.path.join (os.path.dirname (os.path.abspath (__file__)),
+                '..', '..', 'json', '')
+INDEX = JSON + 'xkcd.index.json'
+LOOKUPS = 100000
+ROUNDS = 3
+
+def best_of (f):
+    best = None
+    for r in range (ROUNDS):
+        start = time.perf_counter ()
+        f ()
+        elapsed = time.perf_counter () - start
+        best = elapsed if best is None else min (best, elapsed)
+    return best
+
+def decode_all (index):
+    total = 0
+    for term_id in range (len (index)):
+        total += len (index.postings_of (term_id).docs)
+    return total
+
+def lookups (index, words):
+    total = 0
+    for w in words:
+        for comic, count in index[w].items ():
+            total += count
+    return total
+
+def main ():
+    with open (INDEX) as infile:
+        as_dict = json.load (infile)
+    words = random.Random (42).choices (list (as_dict), k = LOOKUPS)
+
+    with tempfile.TemporaryDirectory () as tmp:
+        results = list ()
+        for kind, name in ((CompiledIndex, 'compiled'), (PackedIndex, 'packed')):
+            f = os.path.join (tmp, 'xkcd.index.' + name)
+            build = best_of (lambda: kind.from_dict (as_dict).save (f))
+            index = kind.load (f)
+            if kind is PackedIndex:
+                # Every lookup decodes
+                index._decoded.size = 0
+            decode = best_of (lambda: decode_all (index))
+            lookup = best_of (lambda: lookups (index, words))
+            results.append ((name, index, os.path.getsize (f), build, decode,
+                lookup))
+
+        compiled, packed = results[0][1], results[1][1]
+        same = all (
+                list (compiled.postings_of (t).items ())
+                == list (packed.postings_of (t).items ())
+                for t in range (len (compiled)))
+        postings = compiled.posting_count
+        print ('{} words, {} postings, json index {} kB, {}'.format (
+            len (compiled), postings, os.path.getsize (INDEX) // 1024,
+            'same postings' if same else 'POSTINGS DIFFER'))
+
+        print ('{:<10}{:>11}{:>12}{:>12}{:>16}{:>13}'.format (
+            'index', 'size (kB)', 'B/posting', 'build (ms)',
+            'decode (Mp/s)', 'lookup (us)'))
+        for name, index, size, build, decode, lookup in results:
+            print ('{:<10}{:>11}{:>12.2f}{:>12.1f}{:>16.2f}{:>13.2f}'.format (
+                name, size // 1024, size / postings, build * 1000,
+                postings / decode / 1e6, lookup / LOOKUPS * 1e6))
+
+if __name__ == '__main__':
+    main ()
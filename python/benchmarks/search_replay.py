@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# Replay a log of queries through client_helpers.search (search_ranked with
+# --ranking), on the real index and references, like the bot does it
+# (SearchData, stop words)
+#   - latency of each query: p50, p90, p99, max, by kind of query
+#   - throughput: queries per second, one after the other
+#   - peak memory: python allocations during the replay (tracemalloc, on a
+#     second pass, it slows things down) and peak resident set size
+#
+# The queries are taken from the references, in equal parts:
+#   title: the title of a comic
+#   alt  : a few words in a row from an alt text
+#   mix  : random words of the titles and alt texts, matching or not
+# They are written to a log (one {"kind", "q"} per line) replayed as it is
+# by the next runs: same queries, runs which can be compared.
+#
+# Usage: python search_replay.py [options]
+#   --json DIR     json directory (default: the one of the repo)
+#   --log FILE     query log, created if it doesn't exist
+#                  (default: search_replay.queries.jsonl)
+#   --queries N    queries in a new log (default: 3000)
+#   --seed N       seed of a new log (default: 42)
+#   --cache N      query cache size, 0 for none as it hides the search
+#                  (default: 0)
+#   --fuzzy        correct the queries finding nothing, like "fuzzy"
+#   --ranking M    ranked search, M being bm25 or tfidf, like "ranking"
+#                  (default: none, plain search)
+#   --top-k N      comics kept by a ranked search (default: 10)
+#   --out FILE     write the results there, for --compare
+#        python search_replay.py --compare BEFORE AFTER
+#                  compare the results of two runs
+#
+# Offline: nothing is sent to discord (a module standing in for discord.py
+# is used when it isn't installed) and nothing is asked to xkcd.com.
+
+import os
+import sys
+import json
+import time
+import types
+import random
+import asyncio
+import resource
+import tracemalloc
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+LIB = os.path.join (HERE, '..', 'lib')
+sys.path.insert (0, LIB)
+try:
+    import discord
+except ImportError:
+    # Searching builds no embed and sends nothing
+    sys.modules['discord'] = types.ModuleType ('discord')
+import client_helpers as CLIENT
+import tokenizer as TOKENIZER
+from search_data import SearchData
+from ranking import MODELS
+
+# Numbers missing from the references are looked up on xkcd.com by search:
+# not while measuring it
+async def offline (number = 0):
+    return {'status': -1, 'comic': ''}
+CLIENT.get_online_xkcd = offline
+
+KINDS = ('title', 'alt', 'mix')
+WARMUP = 200
+
+# Value following name on the command line, default if it isn't there
+def option (name, default):
+    if not name in sys.argv:
+        return default
+    i = sys.argv.index (name)
+    if i + 1 >= len (sys.argv):
+        print ('{} needs a value'.format (name))
+        exit (1)
+    return type (default) (sys.argv[i + 1])
+
+# n queries from the references
+def make_queries (refs, n, seed):
+    rand = random.Random (seed)
+    comics = [refs[k]['comic'] for k in sorted (refs, key = int)
+            if refs[k]['comic']]
+    words = sorted ({w for c in comics
+        for w in TOKENIZER.tokens (c['title'] + ' ' + c['alt'])})
+
+    queries = list ()
+    for i in range (n):
+        kind = KINDS[i % len (KINDS)]
+        comic = rand.choice (comics)
+        if kind == 'title':
+            q = comic['title']
+        elif kind == 'alt':
+            alt = comic['alt'].split () or [comic['title']]
+            length = rand.randint (2, 5)
+            start = rand.randrange (max (1, len (alt) - length + 1))
+            q = ' '.join (alt[start:start + length])
+        else:
+            q = ' '.join (rand.sample (words, rand.randint (1, 4)))
+        queries.append ({'kind': kind, 'q': q})
+    return queries
+
+def load_queries (f, refs):
+    if os.path.exists (f):
+        with open (f) as infile:
+            return [json.loads (line) for line in infile if line.strip ()]
+    queries = make_queries (refs, option ('--queries', 3000),
+            option ('--seed', 42))
+    with open (f, 'w') as outfile:
+        for query in queries:
+            outfile.write (json.dumps (query) + '\n')
+    print ('Wrote {} queries to {}'.format (len (queries), f))
+    return queries
+
+# Every query once, returns the seconds each one took and whether it found
+# a comic
+async def replay (queries, data, bl):
+    times = list ()
+    found = list ()
+    k = option ('--top-k', 10)
+    for query in queries:
+        start = time.perf_counter ()
+        # The same calls as CommandManager.search
+        if data.ranker is not None:
+            result = await CLIENT.search_ranked (
+                    query['q'],
+                    data.refs,
+                    bl,
+                    data.ranker,
+                    k = k,
+                    vocab = data.vocab,
+                    cache = data.queries)
+        else:
+            result = await CLIENT.search (
+                    query['q'],
+                    data.index,
+                    data.refs,
+                    bl,
+                    scorer = data.scorer,
+                    cache = data.queries,
+                    vocab = data.vocab)
+        times.append (time.perf_counter () - start)
+        found.append (result['status'] == 0)
+    return times, found
+
+def percentile (ordered, p):
+    return ordered[min (len (ordered) - 1, int (p / 100 * len (ordered)))]
+
+def stats (times, found):
+    ordered = sorted (times)
+    total = sum (times)
+    return {
+            'queries': len (times),
+            'found': sum (found),
+            'p50_us': percentile (ordered, 50) * 1e6,
+            'p90_us': percentile (ordered, 90) * 1e6,
+            'p99_us': percentile (ordered, 99) * 1e6,
+            'max_us': ordered[-1] * 1e6,
+            'mean_us': total / len (times) * 1e6,
+            'qps': len (times) / total}
+
+def print_stats (results):
+    print ('{:<9}{:>9}{:>8}{:>10}{:>10}{:>10}{:>11}{:>10}'.format (
+        'queries', 'count', 'found', 'p50 (us)', 'p90 (us)', 'p99 (us)',
+        'max (us)', 'q/s'))
+    for name, s in results['latency'].items ():
+        print ('{:<9}{:>9}{:>8}{:>10.1f}{:>10.1f}{:>10.1f}{:>11.1f}{:>10.0f}'
+                .format (name, s['queries'], s['found'], s['p50_us'],
+                    s['p90_us'], s['p99_us'], s['max_us'], s['qps']))
+    print ('peak python allocations during the replay: {} kB'.format (
+        results['peak_alloc_kb']))
+    print ('peak resident set size: {} kB'.format (results['max_rss_kb']))
+
+def run ():
+    model = option ('--ranking', '')
+    if model and not model in MODELS:
+        print ('--ranking is one of {}'.format (', '.join (MODELS)))
+        exit (1)
+
+    root = option ('--json', os.path.join (HERE, '..', '..', 'json', ''))
+    index = CLIENT.loadIndex (os.path.join (root, 'xkcd.index.json'))
+    refs = CLIENT.loadRefs (os.path.join (root, 'xkcd.references.json'))
+    bl = TOKENIZER.stop_words (os.path.join (root, 'xkcd.common.json'))
+    queries = load_queries (option ('--log', 'search_replay.queries.jsonl'),
+            refs)
+
+    def data ():
+        return SearchData (index, refs,
+                ranking = {'model': model} if model else None,
+                cache_size = option ('--cache', 0),
+                fuzzy = '--fuzzy' in sys.argv)
+
+    loop = asyncio.get_event_loop ()
+    loop.run_until_complete (replay (queries[:WARMUP], data (), bl))
+
+    # Timed pass, then the same queries again for the allocations
+    times, found = loop.run_until_complete (replay (queries, data (), bl))
+    tracemalloc.start ()
+    loop.run_until_complete (replay (queries, data (), bl))
+    peak = tracemalloc.get_traced_memory ()[1]
+    tracemalloc.stop ()
+
+    latency = {'all': stats (times, found)}
+    for kind in KINDS:
+        picked = [i for i, q in enumerate (queries) if q['kind'] == kind]
+        if picked:
+            latency[kind] = stats ([times[i] for i in picked],
+                    [found[i] for i in picked])
+
+    results = {
+            'index': type (index).__name__,
+            'ranking': model or None,
+            'options': sys.argv[1:],
+            'latency': latency,
+            'peak_alloc_kb': peak // 1024,
+            'max_rss_kb': resource.getrusage (
+                resource.RUSAGE_SELF).ru_maxrss}
+    print_stats (results)
+
+    out = option ('--out', '')
+    if out:
+        with open (out, 'w') as outfile:
+            json.dump (results, outfile, indent = 2)
+
+# Change from before to after, in percents
+def change (before, after):
+    return (after - before) / before * 100 if before else 0.0
+
+def compare (before_file, after_file):
+    with open (before_file) as infile:
+        before = json.load (infile)
+    with open (after_file) as infile:
+        after = json.load (infile)
+
+    print ('{} -> {}'.format (before_file, after_file))
+    print ('{:<9}{:<8}{:>12}{:>12}{:>9}'.format (
+        'queries', 'metric', 'before', 'after', 'change'))
+    for name, b in before['latency'].items ():
+        a = after['latency'].get (name)
+        if a is None:
+            continue
+        for metric in ('p50_us', 'p99_us', 'qps'):
+            print ('{:<9}{:<8}{:>12.1f}{:>12.1f}{:>+8.1f}%'.format (
+                name, metric.split ('_')[0], b[metric], a[metric],
+                change (b[metric], a[metric])))
+        if a['found'] != b['found']:
+            print ('{:<9}found   {:>12}{:>12}'.format (
+                name, b['found'], a['found']))
+    for metric in ('peak_alloc_kb', 'max_rss_kb'):
+        print ('{:<17}{:>12}{:>12}{:>+8.1f}%'.format (
+            metric[:-3], before[metric], after[metric],
+            change (before[metric], after[metric])))
+
+def main ():
+    if '--compare' in sys.argv:
+        i = sys.argv.index ('--compare')
+        if i + 2 >= len (sys.argv):
+            print ('Usage: python {} --compare BEFORE AFTER'.format (
+                sys.argv[0]))
+            exit (1)
+        compare (sys.argv[i + 1], sys.argv[i + 2])
+    else:
+        run ()
+
+if __name__ == '__main__':
+    main ()
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+# Time for the bot to have its data ready, from a fresh process
+#   json    : json index (compiled by the scorer) and json references
+#   bin     : compiled index (xkcd.index.bin) and json references
+#   snapshot: xkcd.snapshot (index, comics and stop words)
+# Each one runs in its own python process, ROUNDS times, the median is kept:
+#   load   : reading the files
+#   ready  : load + the search data (SearchData, BM25 ranker on)
+#   search : the first search after that (it reads references)
+#   rss    : resident memory once ready
+# The imports are left out, they are the same for every one.
+#
+# Usage: python startup.py [path/to/json/dir/]
+# Needs no discord.py, a module standing in for it is used if it's missing.
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+from statistics import median
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+LIB = os.path.join (HERE, '..', 'lib')
+JSON = sys.argv[1] if len (sys.argv) > 1 else \
+        os.path.join (HERE, '..', '..', 'json', '')
+ROUNDS = 5
+MODES = ('json', 'bin', 'snapshot')
+
+# Run by each process: python startup.py --child MODE DIR
+CHILD = '--child'
+
+def child (mode, root):
+    import time
+    import types
+    import asyncio
+    sys.path.insert (0, LIB)
+    try:
+        import discord
+    except ImportError:
+        sys.modules['discord'] = types.ModuleType ('discord')
+    import client_helpers as CLIENT
+    import tokenizer as TOKENIZER
+    import snapshot as SNAPSHOT
+    from search_data import SearchData
+
+    index_file = os.path.join (root, 'xkcd.index.json')
+    refs_file = os.path.join (root, 'xkcd.references.json')
+    start = time.perf_counter ()
+    if mode == 'snapshot':
+        snapshot = SNAPSHOT.load (os.path.join (root, 'xkcd.snapshot'))
+        index, refs = snapshot['index'], snapshot['refs']
+        bl = snapshot['black_list']
+    else:
+        index = CLIENT.loadIndex (index_file)
+        refs = CLIENT.loadRefs (refs_file)
+        bl = TOKENIZER.stop_words (os.path.join (root, 'xkcd.common.json'))
+    load = time.perf_counter ()
+    data = SearchData (index, refs, ranking = {'model': 'bm25'})
+    ready = time.perf_counter ()
+    asyncio.get_event_loop ().run_until_complete (CLIENT.search_ranked (
+        'python import antigravity', data.refs, bl, data.ranker))
+    search = time.perf_counter ()
+
+    with open ('/proc/self/statm') as statm:
+        rss = int (statm.read ().split ()[1]) * os.sysconf ('SC_PAGE_SIZE')
+    print (json.dumps ({
+        'load': (load - start) * 1000,
+        'ready': (ready - start) * 1000,
+        'search': (search - ready) * 1000,
+        'rss': rss // 1024}))
+
+# The files of each mode, made from the json ones in root
+def prepare (root, tmp):
+    sys.path.insert (0, LIB)
+    import types
+    try:
+        import discord
+    except ImportError:
+        sys.modules['discord'] = types.ModuleType ('discord')
+    import client_helpers as CLIENT
+    import tokenizer as TOKENIZER
+    import snapshot as SNAPSHOT
+    from compiled_index import CompiledIndex
+
+    dirs = dict ()
+    for mode in MODES:
+        d = dirs[mode] = os.path.join (tmp, mode)
+        os.mkdir (d)
+        for name in ('xkcd.index.json', 'xkcd.references.json',
+                'xkcd.common.json'):
+            os.symlink (os.path.abspath (os.path.join (root, name)),
+                    os.path.join (d, name))
+
+    index = CLIENT.loadJson (os.path.join (root, 'xkcd.index.json'))
+    compiled = CompiledIndex.from_dict (index)
+    compiled.save (os.path.join (dirs['bin'], 'xkcd.index.bin'))
+    refs = CLIENT.loadJson (os.path.join (root, 'xkcd.references.json'))
+    SNAPSHOT.write (os.path.join (dirs['snapshot'], 'xkcd.snapshot'),
+            compiled, refs.items (),
+            TOKENIZER.stop_words (os.path.join (root, 'xkcd.common.json')))
+    return dirs
+
+def main ():
+    with tempfile.TemporaryDirectory () as tmp:
+        dirs = prepare (JSON, tmp)
+        print ('{:<10}{:>11}{:>12}{:>13}{:>11}'.format (
+            'data', 'load (ms)', 'ready (ms)', 'search (ms)', 'rss (kB)'))
+        for mode in MODES:
+            runs = list ()
+            for r in range (ROUNDS):
+                out = subprocess.check_output ([sys.executable,
+                    os.path.abspath (__file__), CHILD, mode, dirs[mode]])
+                runs.append (json.loads (out.decode ().splitlines ()[-1]))
+            m = {k: median (run[k] for run in runs) for k in runs[0]}
+            print ('{:<10}{:>11.1f}{:>12.1f}{:>13.1f}{:>11}'.format (
+                mode, m['load'], m['ready'], m['search'], int (m['rss'])))
+
+if __name__ == '__main__':
+    if len (sys.argv) > 1 and sys.argv[1] == CHILD:
+        child (sys.argv[2], sys.argv[3])
+    else:
+        main ()
@@ -0,0 +1,84 @@
+#!/usr/bin/python
+
+# Throughput of the tokenizer over every comic of the references
+# (title, alt and transcript), against the character by character
+# removePunk it replaced. Also checks that both give the same words.
+#
+# Usage: python tokens_throughput.py [path/to/json/dir/]
+
+import os
+import sys
+import json
+import time
+
+LIB = os.path.join (os.path.dirname (os.path.abspath (__file__)), '..', 'lib')
+sys.path.insert (0, LIB)
+import tokenizer as TOKENIZER
+
+JSON = sys.argv[1] if len (sys.argv) > 1 else \
+        os.path.join (os.path.dirname (os.path.abspath (__file__)),
+                '..', '..', 'json', '')
+REFS = JSON + 'xkcd.references.json'
+ROUNDS = 5
+
+# xkcd_helpers.removePunk before the tokenizer, kept here as the reference
+# (its two identical branches for spaces merged)
+def remove_punk_legacy (p):
+    p = p.replace('\n', ' ')
+    phrase = str ()
+    for index, char in enumerate(p):
+        if char.isalpha () or char.isdigit ():
+            phrase += char
+        elif char == ' ':
+            phrase += ' '
+        elif char == '-':
+            if index - 1 > 0 and index + 1 < len (p):
+                # If in the middle of a word
+                if p[index - 1].isalpha () and p[index + 1].isalpha ():
+                    phrase += char
+                else:
+                    phrase += ' '
+            else:
+                phrase += ' '
+        else:
+            phrase += ' '
+
+    return phrase.lower ()
+
+def legacy (text):
+    return [w for w in remove_punk_legacy (text).split (' ') if w]
+
+def tokens (text):
+    return list (TOKENIZER.tokens (text))
+
+def bench (f, texts):
+    best = None
+    for r in range (ROUNDS):
+        start = time.perf_counter ()
+        count = 0
+        for t in texts:
+            count += len (f (t))
+        elapsed = time.perf_counter () - start
+        best = elapsed if best is None else min (best, elapsed)
+    return best, count
+
+def main ():
+    with open (REFS) as infile:
+        refs = json.load (infile)
+    texts = ['{} {} {}'.format (r['comic']['title'], r['comic']['alt'],
+        r['comic']['transcript']) for r in refs.values () if r['comic']]
+    size = sum (len (t.encode ('utf-8')) for t in texts) / 1e6
+
+    mismatches = sum (1 for t in texts if legacy (t) != tokens (t))
+    print ('{} comics, {:.2f} MB of text, {} mismatch(es)'.format (
+        len (texts), size, mismatches))
+
+    print ('{:<12}{:>12}{:>12}{:>14}'.format (
+        'tokenizer', 'time (ms)', 'MB/s', 'tokens/s'))
+    for name, f in (('removePunk', legacy), ('tokens', tokens)):
+        elapsed, count = bench (f, texts)
+        print ('{:<12}{:>12.1f}{:>12.2f}{:>14.0f}'.format (
+            name, elapsed * 1000, size / elapsed, count / elapsed))
+
+if __name__ == '__main__':
+    main ()
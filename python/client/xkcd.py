@@ -20,6 +20,11 @@ sys.path.insert (0, PATH['lib'])
 print(sys.path[0])
 try:
     import client_helpers as CLIENT
+    import tokenizer as TOKENIZER
+    import dispatcher as DISPATCHER
+    import snapshot as SNAPSHOT
+    import shards as SHARDS
+    from metrics import METRICS
     from command import CommandManager
 except ImportError:
     print ('Error: One or more modules were not found in path.')
@@ -33,6 +38,8 @@ INDEX = JSON + "xkcd.index.json"
 REF = JSON + "xkcd.references.json"
 BL = JSON + "xkcd.common.json"
 COMMANDS = JSON + "xkcd.command.json"
+# Index, references and stop words pre-parsed by the scraper
+SNAPSHOT_FILE = JSON + "xkcd.snapshot"
 
 logging.basicConfig (level = logging.INFO)
 
@@ -41,49 +48,141 @@ xkcd_index = dict ()
 xkcd_refs = dict ()
 
 wame_config = CLIENT.loadJson (CONFIG)
-xkcd_index = CLIENT.loadJson (INDEX)
-xkcd_refs = CLIENT.loadJson (REF)
-blk_list = CLIENT.loadJson (BL)
+# Latencies, caches, HTTP and event loop lag, served on a local port or
+# logged, see metrics. Off without a "metrics" entry
+if 'metrics' in wame_config:
+    METRICS.enable (wame_config['metrics'])
+# Uses xkcd.index.bin instead if the scraper compiled it
+# With "shared_data" the binary files are mapped, several bots running on the
+# same machine then share one copy of them
+SHARED = wame_config.get ('shared_data', False)
+# Faster: the snapshot, unless a file it was made from changed since.
+# Not with "shared_data", it would give each bot its own copy
+snapshot = None
+if not SHARED:
+    snapshot = SNAPSHOT.load (
+            SNAPSHOT_FILE, CLIENT.dataFiles (INDEX, REF) + [BL])
+if snapshot is not None:
+    xkcd_index = snapshot['index']
+    xkcd_refs = snapshot['refs']
+    blk_list = snapshot['black_list']
+else:
+    xkcd_index = CLIENT.loadIndex (INDEX, shared = SHARED)
+    # Only the comics, not the transcripts, see comics
+    xkcd_refs = CLIENT.loadComics (REF, shared = SHARED)
+    blk_list = TOKENIZER.stop_words (BL)
 commands = CLIENT.loadJson (COMMANDS)
 
-Wame = discord.Client ()
-wgame = discord.Game (name = wame_config['game'])
-
-comanager = CommandManager(
-        Wame,
-        xkcd_refs,
-        xkcd_index,
-        blk_list,
-        commands,
-        wame_config)
-
-@Wame.event
-async def on_ready ():
-    await Wame.change_presence (game = wgame)
-    bug_channel = Wame.get_channel (wame_config['report_channel'])
-    CLIENT.greet (Wame, channel = bug_channel)
-
-@Wame.event
-async def on_message (message):
-    if any([message.content.startswith (i) for i in wame_config['prefix']]):
-        if message.mention_everyone \
-                or len(message.content.split("@here")) > 1 \
-                or len(message.mentions) > 1:
-                    return
-
-        args = await CLIENT.parse_args (message.content, wame_config['prefix'])
-        
-        if len(args) == 0:
-            command = '--search'
-        elif not args[0] in comanager.com:
-            command = '--search'
-        else:
-            command = args[0]
-            args = args[1:]
-        
-        logging.info ('\nFull mess: {}\nCommand  : {}\nArgs     : {}'\
-                .format (message.content, command, args))
-        
-        await comanager.run(message, command, args)
-
-Wame.run (wame_config['token'])
+# One gateway shard: its own client, command manager and dispatcher, on the
+# data loaded above (shared by every shard, see shards)
+# shard_id, shard_count: None for a bot without shards
+def run_shard (shard_id = None, shard_count = None):
+    # A loop of its own, whatever the process it was forked from did
+    asyncio.set_event_loop (asyncio.new_event_loop ())
+    if shard_id is not None:
+        Wame = discord.Client (shard_id = shard_id, shard_count = shard_count)
+        # One metrics port per shard
+        if METRICS.config.get ('port'):
+            METRICS.config = dict (METRICS.config,
+                    port = METRICS.config['port'] + shard_id)
+    else:
+        Wame = discord.Client ()
+    wgame = discord.Game (name = wame_config['game'])
+    # Time spent talking to discord (nothing is wrapped when metrics are off)
+    for call in ('send_message', 'edit_message'):
+        METRICS.wrap (Wame, call, 'wame_discord_seconds', call = call)
+
+    comanager = CommandManager(
+            Wame,
+            xkcd_refs,
+            xkcd_index,
+            blk_list,
+            commands,
+            wame_config,
+            paths = {'index': INDEX, 'refs': REF})
+
+    # Commands run on a few worker tasks, fed by a bounded queue, see
+    # dispatcher
+    # "dispatch": {"workers": 4, "queue": 64, "per_user": 2, "per_guild": 8}
+    dispatch_config = wame_config.get ('dispatch', dict ())
+    dispatcher = DISPATCHER.Dispatcher (
+            comanager.run,
+            workers = dispatch_config.get ('workers', 4),
+            size = dispatch_config.get ('queue', 64),
+            per_user = dispatch_config.get ('per_user', 2),
+            per_guild = dispatch_config.get ('per_guild', 8))
+
+    # Replies to the commands the dispatcher turned down
+    REASONS = {
+            DISPATCHER.BUSY : "_I'm swamped right now, " \
+                    "try again in a moment._",
+            DISPATCHER.USER : "_Hold on, I'm still working on your last " \
+                    "command._",
+            DISPATCHER.GUILD: "_Too many commands on this server at once, " \
+                    "try again in a moment._"}
+
+    METRICS.collect ('wame_dispatch_pending', 'gauge',
+            lambda: [({}, dispatcher.pending)])
+    METRICS.collect ('wame_dispatch_shed_total', 'counter',
+            lambda: [({}, dispatcher.shed)])
+
+    @Wame.event
+    async def on_ready ():
+        await Wame.change_presence (game = wgame)
+        bug_channel = Wame.get_channel (wame_config['report_channel'])
+        CLIENT.greet (Wame, channel = bug_channel)
+        comanager.start_refresher ()
+        comanager.start_watcher ()
+        dispatcher.start ()
+        METRICS.start ()
+
+    @Wame.event
+    async def on_message (message):
+        if any([message.content.startswith (i)
+                for i in wame_config['prefix']]):
+            if message.mention_everyone \
+                    or len(message.content.split("@here")) > 1 \
+                    or len(message.mentions) > 1:
+                        return
+
+            with METRICS.time ('wame_parse_args_seconds'):
+                args = await CLIENT.parse_args (
+                        message.content, wame_config['prefix'])
+
+            if len(args) == 0:
+                command = '--search'
+            elif not args[0] in comanager.com:
+                command = '--search'
+            else:
+                command = args[0]
+                args = args[1:]
+
+            logging.info ('\nFull mess: {}\nCommand  : {}\nArgs     : {}'\
+                    .format (message.content, command, args))
+
+            # Private channels have no server
+            guild = message.server.id if message.server \
+                    else message.channel.id
+            reason = dispatcher.submit (
+                    message.author.id, guild, message, command, args)
+            if reason is not None:
+                logging.info ('Turned down ({}), {} waiting'.format (
+                    reason, dispatcher.pending))
+                # Once per streak, a flood doesn't get a reply per message
+                if dispatcher.tell (message.author.id, guild, reason):
+                    await Wame.send_message (message.channel, REASONS[reason])
+
+    Wame.run (wame_config['token'])
+
+# "shards": {"count": 2, "restart_delay": 5, "max_restart_delay": 300}
+# More than one shard: one process for each, forked from this one, restarted
+# if they crash, see shards
+shard_config = wame_config.get ('shards', dict ())
+if shard_config.get ('count', 1) > 1:
+    SHARDS.Supervisor (
+            run_shard,
+            shard_config['count'],
+            delay = shard_config.get ('restart_delay', 5),
+            max_delay = shard_config.get ('max_restart_delay', 300)).start ()
+else:
+    run_shard ()
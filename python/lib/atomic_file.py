@@ -0,0 +1,41 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+# Write a data file the bots may be reading
+#
+#   with ATOMIC.replacing (f, 'wb') as outfile:
+#       outfile.write (...)
+#
+# The content goes to a new temporary file in the directory of f, is
+# synced to disk, then the temporary file is renamed over f. A bot with f
+# mapped (shared_data) keeps the old inode, a reload reads the old file or
+# the new one and never a part of one. Every writer has its own temporary
+# file, two of them writing f at once can't mix their content: the last
+# rename wins. If the block fails, f is left as it was.
+# The new file keeps the permissions of the one it replaces (0644 for a
+# new one, mkstemp would make it readable by its owner only).
+@contextmanager
+def replacing (f, mode = 'w'):
+    directory = os.path.dirname (os.path.abspath (f))
+    fd, tmp = tempfile.mkstemp (
+            dir = directory,
+            prefix = os.path.basename (f) + '.',
+            suffix = '.tmp')
+    try:
+        with os.fdopen (fd, mode) as outfile:
+            try:
+                permissions = os.stat (f).st_mode & 0o777
+            except FileNotFoundError:
+                permissions = 0o644
+            os.fchmod (outfile.fileno (), permissions)
+            yield outfile
+            outfile.flush ()
+            os.fsync (outfile.fileno ())
+        os.replace (tmp, f)
+    except BaseException:
+        try:
+            os.unlink (tmp)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,104 @@
+import time
+import asyncio
+from collections import OrderedDict
+
+# A single value fetched by a coroutine and kept for ttl seconds
+#
+# Concurrent callers share one fetch: the first one to find the value
+# expired starts it, the others await the same future instead of sending
+# their own request.
+#   fetch: coroutine function returning the new value
+#   ok   : tells if a fetched value is good enough to be cached. When it
+#          isn't, the previous value is served (stale) if there is one
+#   retry: seconds the stale value is served after such a failed fetch
+#          before fetching again, so that an outage of the source doesn't
+#          make every call wait for it
+# Counts the calls served from the cache (hits) and the ones fetching
+class TTLValue:
+    def __init__ (self, fetch, ttl, ok = lambda value: True, retry = 60):
+        self._fetch = fetch
+        self._ok = ok
+        self.ttl = ttl
+        self.retry = retry
+        self._value = None
+        self._expires = 0.0
+        self._inflight = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def fresh (self):
+        return self._value is not None and time.monotonic () < self._expires
+
+    # Last cached value, even if expired (None if nothing was ever fetched)
+    @property
+    def value (self):
+        return self._value
+
+    async def get (self):
+        if self.fresh:
+            self.hits += 1
+            return self._value
+        self.misses += 1
+        return await self.refresh ()
+
+    # Fetch now, joining the fetch in flight if there is one
+    async def refresh (self):
+        if self._inflight is None:
+            self._inflight = asyncio.ensure_future (self._refresh ())
+        # A cancelled caller must not cancel the fetch of the others
+        return await asyncio.shield (self._inflight)
+
+    async def _refresh (self):
+        try:
+            value = await self._fetch ()
+            if self._ok (value):
+                self._value = value
+                self._expires = time.monotonic () + self.ttl
+                return value
+            if self._value is None:
+                return value
+            self._expires = time.monotonic () + self.retry
+            return self._value
+        finally:
+            self._inflight = None
+
+# Least recently used cache of at most size entries
+# Counts its hits and misses
+class LRU:
+    def __init__ (self, size):
+        self.size = size
+        self._entries = OrderedDict ()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__ (self):
+        return len (self._entries)
+
+    def __contains__ (self, key):
+        return key in self._entries
+
+    # Cached value of key, default if it isn't there
+    def get (self, key, default = None):
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end (key)
+        self.hits += 1
+        return value
+
+    def put (self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end (key)
+        if len (self._entries) > self.size:
+            self._entries.popitem (last = False)
+
+    def clear (self):
+        self._entries.clear ()
+
+    @property
+    def hit_ratio (self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
@@ -1,8 +1,24 @@
+import os
+import re
 import asyncio
 import json
 import random
 import discord
-from urllib.request import urlopen
+import index_delta as INDEX_DELTA
+import refs_jsonl as REFS_JSONL
+import tokenizer as TOKENIZER
+from http_client import AsyncHTTP
+from compiled_index import CompiledIndex
+from packed_index import PackedIndex
+from refs_store import RefStore
+from comics import ComicTable
+from vocab_trie import VocabTrie
+from positional_index import PositionalIndex
+from embed_cache import build_embed
+
+# Shared by every xkcd.com lookup: pooled connections, 4 requests at most in
+# flight, 10 s per request
+HTTP = AsyncHTTP(max_connections = 4, timeout = 10)
 
 def generate_help(commands, config):
     e_title = config['help']['title']
@@ -49,6 +65,99 @@ def loadJson(f):
         a = json.load(infile)
     return a
 
+# Load the search index
+# Prefer the compiled index (same name, .bin extension) when it exists, then
+# the packed one (.pack, see packed_index), the json index otherwise
+# f is the json index file name
+# shared: map the compiled index instead of reading it, so that every bot
+# process uses the same copy from the page cache
+# The delta segment written by an incremental build (.delta.json) is merged
+# in. A mapped index then becomes a private copy, until the next full build
+def loadIndex(f, shared = False):
+    index = None
+    for ext, kind in (('.bin', CompiledIndex), ('.pack', PackedIndex)):
+        compiled = os.path.splitext(f)[0] + ext
+        if os.path.exists(compiled):
+            if shared:
+                index = kind.open(compiled)
+            else:
+                index = kind.load(compiled)
+            break
+    if index is None:
+        index = loadJson(f)
+
+    delta = INDEX_DELTA.load(deltaPath(f))
+    if INDEX_DELTA.is_empty(delta):
+        return index
+    if isinstance(index, CompiledIndex):
+        return index.merged(delta)
+    return INDEX_DELTA.apply(index, delta)
+
+# Name of the delta segment of the index f
+def deltaPath(f):
+    return os.path.splitext(f)[0] + '.delta.json'
+
+# Load the comic references
+# Same thing as loadIndex: the mapped store (.bin) is used when it exists
+# Records are then read from the file when they are accessed
+# Otherwise the line delimited references (.jsonl) the scraper writes are
+# preferred to the json ones
+def loadRefs(f, shared = False):
+    store = os.path.splitext(f)[0] + '.bin'
+    if shared and os.path.exists(store):
+        return RefStore.open(store)
+    if os.path.exists(REFS_JSONL.path(f)):
+        return REFS_JSONL.load(REFS_JSONL.path(f))
+    return loadJson(f)
+
+# What the bot keeps of the references f (see comics), from the same file
+# as loadRefs. The references are read one at a time and dropped once their
+# comic is in the table, only the json ones are loaded at once
+def loadComics(f, shared = False):
+    store = os.path.splitext(f)[0] + '.bin'
+    if shared and os.path.exists(store):
+        items = RefStore.open(store).items()
+    elif os.path.exists(REFS_JSONL.path(f)):
+        items = REFS_JSONL.iter_refs(REFS_JSONL.path(f))
+    else:
+        items = loadJson(f).items()
+    return ComicTable.from_items(items)
+
+# Every file the index f and the references refs can be loaded from
+def dataFiles(index, refs):
+    return [
+            index,
+            os.path.splitext(index)[0] + '.bin',
+            os.path.splitext(index)[0] + '.pack',
+            deltaPath(index),
+            vocabPath(index),
+            positionsPath(index),
+            refs,
+            REFS_JSONL.path(refs),
+            os.path.splitext(refs)[0] + '.bin']
+
+# Load the vocabulary trie written next to the index f by the scraper
+# None if there is none, see vocab_trie
+def loadVocab(f):
+    trie = vocabPath(f)
+    if os.path.exists(trie):
+        return VocabTrie.load(trie)
+    return None
+
+def vocabPath(f):
+    return os.path.splitext(f)[0] + '.trie'
+
+# Load the positional index written next to the index f (index.py
+# --positions), None if there is none
+def loadPositions(f):
+    pos = positionsPath(f)
+    if os.path.exists(pos):
+        return PositionalIndex.load(pos)
+    return None
+
+def positionsPath(f):
+    return os.path.splitext(f)[0] + '.pos'
+
 # Notify a successful connection in the terminal
 def greet(wame, channel = None):
     a = ""
@@ -139,25 +248,13 @@ Then select the ones with greated weight:
     '1': [3, 2], '2': [3, 2]
 Return one of them(1|2)
 """
-async def get_xkcd(phrase, index, refs):
-    """
-    If the query is one string long and the string is a number
-    1. Look if a comic of this number is in the reference
-    2. If not in reference check for it online
-    If both failed proceed to normal search,
-    otherwise return the comic of the said number
-    """
-    if len(phrase) == 1 and phrase [0].isdigit():
-        if int(phrase[0]) <=  len(refs):
-            return {'status': 0, 'comic': refs[phrase[0]]}
-        else:
-            online_check = await get_online_xkcd(number = phrase[0])
-            if online_check['status'] is 0:
-                # it\s to get shitty, get shitty
-                # FIXME: this is really shitty, gawd
-                return {'status': 0, 'comic': online_check}
+# Comics tied on the best (score, weight) for the words in phrase
+# Returns a list of comic numbers, empty if nothing matched
+# scorer: optional scoring.Scorer built on index, same ranking in one pass
+async def candidates(phrase, index, scorer = None):
+    if scorer is not None:
+        return scorer.best(phrase)
 
-    # Real search starts here
     matched = dict()
     score = dict()
     for word in phrase:
@@ -172,12 +269,28 @@ async def get_xkcd(phrase, index, refs):
         max_weight = a [max(a, key = lambda x: a[x]['weight'])]['weight']
         b = {x: a[x] for x in a if a[x]['weight'] == max_weight}
         
-        return {'status': 0, 'comic': refs[random.choice(list(b.keys()))]}
+        return list(b.keys())
     else:
-        return {'status': -1}
+        return list()
+
+# Look for a comic by number, locally then online
+# phrase is the cleaned up query
+# Returns None if the query isn't a number or the comic wasn't found
+async def get_number(phrase, refs):
+    if len(phrase) == 1 and phrase [0].isdigit():
+        # Not len(refs): comics added at runtime can leave gaps
+        if phrase[0] in refs:
+            return {'status': 0, 'comic': refs[phrase[0]]}
+        else:
+            online_check = await get_online_xkcd(number = phrase[0])
+            if online_check['status'] is 0:
+                # it\s to get shitty, get shitty
+                # FIXME: this is really shitty, gawd
+                return {'status': 0, 'comic': online_check}
+    return None
 
 """
-a: dict, b: dict
+a: dict, b: dict or compiled_index.Postings
 for each key in b:
     if the key is in a:
         add their value
@@ -185,41 +298,247 @@ for each key in b:
         a[key] = b[key], aka create the key in a with the same  value as in b
 """
 async def combine(a, b):
-    bk = list(b.keys())
-    for k in bk:
+    # Keys of b are unique, each one gets one more matched word
+    for k, v in b.items():
         if k in a:
-            a[k]['weight'] = a[k]['weight'] + b[k]
+            a[k]['weight'] = a[k]['weight'] + v
+            a[k]['score'] += 1
         else:
-            a[k] = {'weight': b[k], 'score': 0}
-
-    for k in list(set(bk)):
-        a[k]['score'] += 1
-
-# Clean up the query then call get_xkcd
-async def search(q, index, refs, bl):
-    import xkcd_helpers as XKCD
-    query = XKCD.removePunk(q)
-    qlist = list(set(query.split(' ')))
-    qlist = [x for x in qlist if x and not(x in bl or x == ' ')]
-    return await get_xkcd(qlist, index, refs)
+            a[k] = {'weight': v, 'score': 1}
+
+# Return one of the best comics, picked at random
+# The compiled index uses int comic numbers, the json one strings
+def pick_xkcd(best, refs):
+    if best:
+        return {'status': 0, 'comic': refs[str(random.choice(best))]}
+    return {'status': -1}
+
+# Edits allowed when looking for a word close to word
+# Short words have too many neighbours for a typo to be told apart
+def edits_for(word, max_edits):
+    if len(word) < 4:
+        return 0
+    if len(word) < 8:
+        return min(1, max_edits)
+    return max_edits
+
+# Word of the index standing for word, which isn't in it, None if none
+# The closest words (fuzzy) come first, then the words word is the
+# beginning of (prefixed). Among them, the one in the most comics wins
+# One edit is tried first: two edits cost ten times as much, they are only
+# looked for when one edit found nothing
+def closest_word(word, index, vocab, max_edits = 2):
+    found = list()
+    for edits in range(1, edits_for(word, max_edits) + 1):
+        near = [(d, w) for d, w in vocab.fuzzy(word, edits) if w in index]
+        if near:
+            found = [w for d, w in near if d == near[0][0]]
+            break
+    if not found and len(word) >= 3:
+        found = [w for w in vocab.prefixed(word) if w in index]
+    if not found:
+        return None
+    return max(sorted(found), key = lambda w: len(index[w]))
+
+# Replace the words of phrase which aren't in the index by their closest
+# word (see closest_word), the others are kept
+# Returns None if nothing could be replaced
+def correct_terms(phrase, index, vocab, max_edits = 2):
+    corrected = list()
+    changed = False
+    for word in phrase:
+        if not word in index:
+            alt = closest_word(word, index, vocab, max_edits)
+            if alt is not None:
+                corrected.append(alt)
+                changed = True
+            continue
+        corrected.append(word)
+    return corrected if changed else None
+
+# correct_terms in a worker thread, the other searches don't wait for the
+# fuzzy lookup (milliseconds per word)
+async def correct_terms_async(phrase, index, vocab, max_edits = 2):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+            None, correct_terms, phrase, index, vocab, max_edits)
+
+# Quoted part of a query, straight or curly quotes
+QUOTED = re.compile('["\u201c\u201d]([^"\u201c\u201d]*)["\u201c\u201d]')
+
+# Quoted phrases of a query, for positional_index.PositionalIndex.phrase
+# A phrase is a tuple of (offset, word), the offsets count the stop words
+# but the stop words aren't in it. A phrase of one word is only a word
+def phrase_terms(q, bl):
+    phrases = list()
+    for m in QUOTED.finditer(q):
+        phrase = tuple((offset, w)
+                for offset, w in enumerate(TOKENIZER.tokens(m.group(1)))
+                if not w in bl)
+        if len(phrase) > 1:
+            phrases.append(phrase)
+    return phrases
+
+# Comics holding every phrase, tied on the best (score, weight) for the
+# words of phrase, then on the closest words (see closest)
+def phrase_candidates(phrase, phrases, positions):
+    docs = None
+    for p in phrases:
+        found = set(positions.phrase(p))
+        docs = found if docs is None else docs & found
+        if not docs:
+            return list()
+
+    best = list()
+    top = (0, 0)
+    for doc in sorted(docs):
+        counts = [len(positions.positions(w, doc)) for w in phrase]
+        key = (sum(1 for c in counts if c), sum(counts))
+        if key > top:
+            top = key
+            best = [doc]
+        elif key == top:
+            best.append(doc)
+    return closest(phrase, best, positions)
+
+# Proximity: the comics of best in which the words of phrase are the
+# closest to each other
+def closest(phrase, best, positions):
+    if len(best) < 2 or len(phrase) < 2:
+        return best
+    spans = {doc: positions.span(phrase, doc) for doc in best}
+    shortest = min(spans.values())
+    return [doc for doc in best if spans[doc] == shortest]
+
+# Factor applied to a ranked score for words span positions apart
+# (0: one word found, no boost)
+def proximity_boost(span):
+    return 1 + 1 / span if span else 1
+
+# Clean up a query: list of unique words, without the black listed ones
+# bl is a set (see tokenizer.stop_words), the one the index was built with
+def query_terms(q, bl):
+    return list(set(TOKENIZER.terms(q, bl)))
+
+# Clean up the query, then pick one of the best comics for it (candidates)
+# cache: optional cache.LRU of the candidates of each query
+#   The key is the sorted words of the query, so "cat man" and "man the cat"
+#   share an entry. It keeps all the best comics, not the one picked, so
+#   ties are still broken at random. Comic numbers aren't cached, they can
+#   go online. The cache has to be emptied when the index changes
+# vocab: optional vocab_trie.VocabTrie over the index. When no comic has
+#   any word of the query, its words are corrected (see correct_terms) and
+#   looked up again: typos and plurals find something
+# positions: optional positional_index.PositionalIndex. With it, only the
+#   comics holding the quoted phrases of the query are kept, and ties go to
+#   the comics where the words are the closest
+async def search(q, index, refs, bl, scorer = None, cache = None,
+        vocab = None, max_edits = 2, positions = None):
+    qlist = query_terms(q, bl)
+    by_number = await get_number(qlist, refs)
+    if by_number is not None:
+        return by_number
+
+    phrases = phrase_terms(q, bl) if positions is not None else list()
+    key = (tuple(sorted(qlist)), tuple(phrases))
+    best = cache.get(key) if cache is not None else None
+    if best is None:
+        if phrases:
+            best = phrase_candidates(qlist, phrases, positions)
+        else:
+            best = await candidates(qlist, index, scorer)
+            if not best and vocab is not None:
+                corrected = await correct_terms_async(
+                        qlist, index, vocab, max_edits)
+                if corrected:
+                    best = await candidates(corrected, index, scorer)
+            if positions is not None:
+                best = closest(qlist, best, positions)
+        if cache is not None:
+            cache.put(key, best)
+    return pick_xkcd(best, refs)
+
+# Ranked search: the k best comics for the query, best first
+# ranker is a ranking.Ranker (BM25 or TF-IDF), ties are broken by number
+# vocab, max_edits: same fallback as search
+# positions: only the comics holding the quoted phrases are ranked, and the
+#   score of a comic goes up to twice as much the closer the words are
+# cache: same as search, with the comic numbers of the top k (a SearchData
+#   either ranks every query or none, the entries of search never mix in)
+# Returns {'status': 0, 'comics': [comic, ...]} or {'status': -1}
+async def search_ranked(q, refs, bl, ranker, k = 10, vocab = None,
+        max_edits = 2, positions = None, cache = None):
+    qlist = query_terms(q, bl)
+    by_number = await get_number(qlist, refs)
+    if by_number is not None:
+        return {'status': 0, 'comics': [by_number['comic']]}
+
+    phrases = phrase_terms(q, bl) if positions is not None else list()
+    key = (tuple(sorted(qlist)), tuple(phrases))
+    top = cache.get(key) if cache is not None else None
+    if top is None:
+        top = await rank(
+                qlist, phrases, ranker, k, vocab, max_edits, positions)
+        if cache is not None:
+            cache.put(key, top)
+    if not top:
+        return {'status': -1}
+    return {'status': 0, 'comics': [refs[str(n)] for n in top]}
+
+# Numbers of the top k comics for the words of qlist, see search_ranked
+async def rank(qlist, phrases, ranker, k, vocab, max_edits, positions):
+    allowed = None
+    for p in phrases:
+        found = set(positions.phrase(p))
+        allowed = found if allowed is None else allowed & found
+        if not allowed:
+            return list()
+
+    top = ranker.top(qlist, k, allowed)
+    if not top and vocab is not None and allowed is None:
+        corrected = await correct_terms_async(
+                qlist, ranker.index, vocab, max_edits)
+        if corrected:
+            qlist = corrected
+            top = ranker.top(qlist, k)
+    if positions is not None and len(qlist) > 1:
+        top = sorted(
+                ((score * proximity_boost(positions.span(qlist, n)), n)
+                    for score, n in top),
+                key = lambda x: (-x[0], x[1]))
+    return [n for score, n in top]
 
 async def create_embed(xkcd):
-    comic = xkcd['comic']
-    
-    embed_comic = discord.Embed \
-           (title = '{}: {}'.format(comic['num'], comic['title']), \
-            colour = discord.Colour(0x00ff00), url = comic['img'])
-
-    embed_comic.set_footer(text = '{}'.format(comic['alt']))
-    embed_comic.set_image(url = comic['img'])
-    embed_comic.set_author(name = 'xkcd', \
-            url = 'https://xkcd.com/{}'.format(comic['num']))
+    return build_embed(xkcd['comic'])
 
-    return embed_comic
+# embeds: optional EmbedCache of refs, picks from its prebuilt numbers
+async def random_embed(refs, embeds = None):
+    if embeds is not None:
+        return embeds.random()
 
-async def random_embed(refs):
-    return await create_embed \
-           (refs [random.choice(list(refs.keys()))])
+    # The store already has its comic numbers in an array, don't build (and
+    # throw away) a list of every key
+    if isinstance(refs, RefStore):
+        key = str(random.choice(refs.nums))
+    else:
+        key = random.choice(list(refs.keys()))
+    return await create_embed(refs[key])
+
+# Wrap a comic from xkcd.com as an entry of the references
+# Same shape as what the scraper writes, transcript status unknown
+def make_ref(comic):
+    return {
+            'comic': comic,
+            'stat_com': {'status': 0, 'error': ''},
+            'stat_tr': {'status': -3, 'error': 'live', 'complete': -3}}
+
+# Add comic to refs, which can be a dict or a RefStore
+def add_ref(refs, comic):
+    key = str(comic['num'])
+    if isinstance(refs, RefStore):
+        refs.add(key, make_ref(comic))
+    elif key not in refs:
+        refs[key] = make_ref(comic)
 
 #FIXME: This is some kind of a special madness, I don't remember having
 #coded while drunk
@@ -247,9 +566,9 @@ async def get_online_xkcd(number = 0):
 
     response = {'status': 0, 'comic': ""}
     
+    # Doesn't block the event loop, see http_client
     try:
-        online_comic = urlopen(url).read()
-        response['comic'] = json.loads(online_comic.decode('utf-8'))
+        response['comic'] = await HTTP.get_json(url)
     except:
         response['status'] = -1
     
@@ -0,0 +1,136 @@
+from array import array
+from collections.abc import MutableMapping
+
+# What the bot keeps of each comic
+#
+# A reference is a dict of dicts ('comic', 'stat_com', 'stat_tr') with a
+# dozen strings, the transcript being the biggest of them: the bot only ever
+# shows the number, title, alt text and image of a comic. Those four are
+# kept in a Comic (no __dict__), in a list indexed by comic number.
+# The rest (transcripts, status of the scraping) isn't kept: the table is
+# filled one reference at a time (from_items), which is dropped right after.
+
+FIELDS = frozenset (('num', 'title', 'alt', 'img'))
+
+class Comic:
+    __slots__ = ('num', 'title', 'alt', 'img')
+
+    def __init__ (self, num, title, alt, img):
+        self.num = num
+        self.title = title
+        self.alt = alt
+        self.img = img
+
+    @classmethod
+    def from_dict (cls, comic):
+        return cls (int (comic['num']), comic['title'], comic['alt'],
+                comic['img'])
+
+    # Read like the comic dict of a reference: comic['title']
+    def __getitem__ (self, key):
+        if not key in FIELDS:
+            raise KeyError (key)
+        return getattr (self, key)
+
+    def __reduce__ (self):
+        return (Comic, (self.num, self.title, self.alt, self.img))
+
+# A reference without a comic (404, or the scraper couldn't get it)
+NO_COMIC = ''
+
+# The comics of the references, with the same interface as them: string
+# comic numbers as keys, {'comic': Comic} as values (no status)
+# Comics can be added to it (client_helpers.add_ref).
+class ComicTable (MutableMapping):
+    def __init__ (self):
+        # comic number -> Comic, NO_COMIC, or None if there is no reference
+        self._comics = list ()
+        self._count = 0
+
+    # The table of (comic number, ref) pairs, taken one at a time: they
+    # can come straight from a file, a comic seen twice keeps its last ref
+    @classmethod
+    def from_items (cls, items):
+        table = cls ()
+        for num, ref in items:
+            table[num] = ref
+        return table
+
+    # The table of refs (any mapping of references), refs itself if it's one
+    @classmethod
+    def of (cls, refs):
+        if isinstance (refs, cls):
+            return refs
+        return cls.from_items (refs.items ())
+
+    def _num (self, key):
+        try:
+            num = int (key)
+        except (TypeError, ValueError):
+            return -1
+        if 0 <= num < len (self._comics):
+            return num
+        return -1
+
+    def __len__ (self):
+        return self._count
+
+    def __iter__ (self):
+        for num, comic in enumerate (self._comics):
+            if comic is not None:
+                yield str (num)
+
+    def __contains__ (self, key):
+        num = self._num (key)
+        return num >= 0 and self._comics[num] is not None
+
+    def __getitem__ (self, key):
+        try:
+            num = int (key)
+            comic = self._comics[num] if num >= 0 else None
+        except (TypeError, ValueError, IndexError):
+            comic = None
+        if comic is None:
+            raise KeyError (key)
+        return {'comic': comic}
+
+    # Keeps the comic of ref
+    def __setitem__ (self, key, ref):
+        num = int (key)
+        if num < 0:
+            raise KeyError (key)
+        if num >= len (self._comics):
+            self._comics.extend ([None] * (num + 1 - len (self._comics)))
+        if self._comics[num] is None:
+            self._count += 1
+        comic = ref['comic']
+        if comic and not isinstance (comic, Comic):
+            comic = Comic.from_dict (comic)
+        self._comics[num] = comic or NO_COMIC
+
+    def __delitem__ (self, key):
+        num = self._num (key)
+        if num < 0 or self._comics[num] is None:
+            raise KeyError (key)
+        self._comics[num] = None
+        self._count -= 1
+
+    # Comic of a number, None if there is none
+    def comic (self, num):
+        comic = self._comics[num] if 0 <= num < len (self._comics) else None
+        return comic or None
+
+    # Numbers of the references which have a comic (see EmbedCache)
+    @property
+    def comics (self):
+        return array ('I', (num for num, comic in enumerate (self._comics)
+            if comic))
+
+    def __reduce__ (self):
+        return (_table, (self._comics, self._count))
+
+def _table (comics, count):
+    table = ComicTable ()
+    table._comics = comics
+    table._count = count
+    return table
@@ -1,5 +1,21 @@
+import os
+import asyncio
+import logging
 import client_helpers as CLIENT
 import discord
+from collections import OrderedDict
+from cache import TTLValue
+from rate_limit import RateLimits
+from metrics import METRICS
+from search_data import SearchData, QUERY_CACHE_SIZE
+from comics import ComicTable
+
+# Number of (channel, user) for which the next matches of the last ranked
+# search are kept, the oldest searches are forgotten first
+NEXT_MATCHES_MAX = 1024
+
+# Missing comics fetched at most by one refresh of the latest comic
+BACKFILL_MAX = 20
 
 class CommandManager:
     def __init__ (
@@ -9,12 +25,83 @@ class CommandManager:
             index, 
             black_list, 
             dict_com, 
-            config):
+            config,
+            paths = None):
         
         self.client = client
-        self.refs = refs
-        self.index = index
-        self.black_list = black_list
+        # Tested for every word of every query
+        self.black_list = frozenset (black_list)
+
+        # Ranked search (BM25/TF-IDF) if the config asks for it
+        # "ranking": {"model": "bm25" | "tfidf", "top_k": 10}, false for none
+        self.ranking = config.get ('ranking')
+        self.ranking_k = 1
+        if self.ranking:
+            self.ranking_k = self.ranking.get ('top_k', 10)
+
+        # Number of queries whose results are cached (see CLIENT.search)
+        # "query_cache": {"size": 4096}, size 0 for no cache
+        self.query_cache_size = config.get ('query_cache', dict ()).get (
+                'size', QUERY_CACHE_SIZE)
+
+        # Words close to the ones of a query which found nothing, see
+        # CLIENT.correct_terms. Off without the entry
+        # "fuzzy": {"max_edits": 2}
+        self.fuzzy = config.get ('fuzzy')
+        self.max_edits = 2
+        if self.fuzzy:
+            self.max_edits = self.fuzzy.get ('max_edits', 2)
+
+        # Quoted phrases and proximity, with the positional index the scraper
+        # writes with --positions. Off without it or with false
+        # "positions": true
+        self.use_positions = config.get ('positions', False)
+
+        # Files the data comes from: {'index': path, 'refs': path}
+        # Needed to reload them (--reload or watcher), see reload
+        # "reload": {"watch": <seconds between checks, 0 to not watch>}
+        self.paths = paths
+
+        # Index, references, scorer, ranker and caches, see search_data
+        vocab = None
+        positions = None
+        if paths:
+            vocab, positions = self._load_extras ()
+        self.data = self._new_data (index, refs, vocab, positions)
+
+        self.watch_interval = config.get ('reload', dict ()).get ('watch', 0)
+        self._watcher = None
+        self._reload_lock = asyncio.Lock ()
+        self.admins = config.get ('admins', list ())
+        self.next_matches = OrderedDict ()
+        # Offers of a random comic still waiting for a reply (_offer_random)
+        self._offers = set ()
+
+        # The latest comic changes three times a week, don't ask xkcd.com
+        # for each --latest: cached for "ttl" seconds, and refreshed in the
+        # background every "refresh" seconds if set (see start_refresher)
+        # When xkcd.com can't be reached, the last one is served for "retry"
+        # seconds before asking again
+        # "latest": {"ttl": 900, "refresh": 3600, "retry": 60}
+        latest = config.get ('latest', dict ())
+        self.latest_cache = TTLValue (
+                CLIENT.get_online_xkcd,
+                latest.get ('ttl', 900),
+                ok = lambda r: r['status'] == 0,
+                retry = latest.get ('retry', 60))
+        self.refresh_interval = latest.get ('refresh', 0)
+        self._refresher = None
+
+        # Token buckets per user, per server and per command, see rate_limit
+        # No "rate_limits" entry, no limits
+        limits = config.get ('rate_limits')
+        self.limits = RateLimits (limits) if limits else None
+
+        # Caches, read when the metrics are asked for
+        METRICS.collect ('wame_cache_hits_total', 'counter', self._cache_hits)
+        METRICS.collect ('wame_cache_misses_total', 'counter',
+                self._cache_misses)
+        METRICS.collect ('wame_cache_hit_ratio', 'gauge', self._cache_ratios)
         
         self._dict_com = {x: dict_com[x]['func'] for x in dict_com}
         self.com = list (self._dict_com.keys ())
@@ -32,31 +119,224 @@ class CommandManager:
                 description = "_I found nothing. I'm so sawry and sad :(_. \
                         \nReply with **`random`** for a surprise\n",
                 colour = (0x000000))
+
+        self.no_next_message = discord.Embed (
+                description = "_No more matches. Try another search._",
+                colour = (0x000000))
+
+        self.slow_down_message = discord.Embed (
+                description = "_Slow down! Wait a bit before your next \
+                        command._",
+                colour = (0xff8800))
         
     async def run (self, message, command, args):
         try:
             f_name = self._dict_com[command]
+            if not await self._allowed (message, f_name):
+                METRICS.count ('wame_commands_limited_total', command = f_name)
+                return
             f = CommandManager.__getattribute__ (self, f_name)
-            await f (self, message, command, args)
+            with METRICS.time ('wame_command_seconds', command = f_name):
+                await f (self, message, command, args)
         except AttributeError as ne:
             raise NameError (f"Attribute {f_name} not found.") from ne
         except KeyError as ke:
             raise KeyError (f"No match found for {command}.") from ke
     
+    # The caches of the bot, by name (the ones of data start over with it)
+    def _caches (self):
+        data = self.data
+        caches = [('embed', data.embeds.stats), ('latest', self.latest_cache)]
+        if data.queries is not None:
+            caches.append (('query', data.queries))
+        return caches
+
+    def _cache_hits (self):
+        return [({'cache': name}, c.hits) for name, c in self._caches ()]
+
+    def _cache_misses (self):
+        return [({'cache': name}, c.misses) for name, c in self._caches ()]
+
+    def _cache_ratios (self):
+        return [({'cache': name}, c.hits / (c.hits + c.misses))
+                for name, c in self._caches () if c.hits + c.misses]
+
+    # Take the tokens of a command from the rate limits
+    # When it's stopped, the user is told once, the next ones are ignored
+    # until a command goes through again
+    async def _allowed (self, message, f_name):
+        if self.limits is None:
+            return True
+        guild = message.server.id if message.server else message.channel.id
+        stopped = self.limits.check (message.author.id, guild, f_name)
+        if stopped is None:
+            return True
+        buckets, key = stopped
+        if buckets.tell (key):
+            await self.client.send_message (
+                    message.channel, embed = self.slow_down_message)
+        return False
+
     @staticmethod
     async def random (coma, message, command, args):
-        embed_comic = await CLIENT.random_embed (coma.refs)
+        embed_comic = await CLIENT.random_embed (coma.refs, coma.data.embeds)
         await coma.client.send_message (message.channel, embed = embed_comic)
 
+    # Shortcuts to the current data, a command which has to see the same
+    # data from start to end takes coma.data once instead
+    @property
+    def index (self):
+        return self.data.index
+
+    @property
+    def refs (self):
+        return self.data.refs
+
+    @property
+    def scorer (self):
+        return self.data.scorer
+
+    @property
+    def ranker (self):
+        return self.data.ranker
+
+    # Files watched for a reload, index and references in every form
+    def _watched_files (self):
+        return CLIENT.dataFiles (self.paths['index'], self.paths['refs'])
+
+    # Modification times of the watched files (None if missing)
+    def _files_signature (self):
+        signature = list ()
+        for f in self._watched_files ():
+            try:
+                signature.append (os.stat (f).st_mtime_ns)
+            except FileNotFoundError:
+                signature.append (None)
+        return tuple (signature)
+
+    # vocab: trie of the index if there is one, built from it otherwise
+    # refs: any mapping of references, only their comics are kept (see
+    # comics) unless it's a ComicTable already
+    def _new_data (self, index, refs, vocab = None, positions = None):
+        return SearchData (
+                index,
+                ComicTable.of (refs),
+                self.ranking,
+                cache_size = self.query_cache_size,
+                fuzzy = bool (self.fuzzy),
+                vocab = vocab,
+                positions = positions)
+
+    # Vocabulary trie and positional index next to the index, each one
+    # only if the config uses it and the scraper wrote it (None otherwise)
+    def _load_extras (self):
+        vocab = None
+        positions = None
+        if self.fuzzy:
+            vocab = CLIENT.loadVocab (self.paths['index'])
+        if self.use_positions:
+            positions = CLIENT.loadPositions (self.paths['index'])
+        return vocab, positions
+
+    # Runs in a worker thread
+    def _load_data (self):
+        shared = self.config.get ('shared_data', False)
+        return self._new_data (
+                CLIENT.loadIndex (self.paths['index'], shared = shared),
+                CLIENT.loadComics (self.paths['refs'], shared = shared),
+                *self._load_extras ())
+
+    # Load the index and the references again, without stopping the bot
+    # Everything is built in a worker thread, the event loop keeps serving
+    # the old data, then the new data replaces it in one assignment
+    async def reload (self):
+        if self.paths is None:
+            raise RuntimeError ('CommandManager was created without paths.')
+
+        async with self._reload_lock:
+            loop = asyncio.get_event_loop ()
+            data = await loop.run_in_executor (None, self._load_data)
+            self.data = data
+
+        # The comics added since the references were built
+        latest = self.latest_cache.value
+        if latest is not None and latest['status'] == 0:
+            await self._add_new_comics (latest['comic'])
+
+        logging.info ('Reloaded: {} words, {} comics'.format (
+            len (data.index), len (data.refs)))
+        return data
+
+    # Start checking the data files for changes, once
+    # Needs a running event loop (call it from on_ready)
+    def start_watcher (self):
+        if self.watch_interval and self.paths and self._watcher is None:
+            self._watcher = asyncio.ensure_future (
+                    self._watch (self.watch_interval))
+
+    async def _watch (self, interval):
+        signature = self._files_signature ()
+        while True:
+            await asyncio.sleep (interval)
+            current = self._files_signature ()
+            if current == signature:
+                continue
+            # Let the indexer finish writing everything before loading
+            await asyncio.sleep (1)
+            signature = self._files_signature ()
+            try:
+                await self.reload ()
+            except Exception:
+                logging.exception ('Reload failed, keeping the old data')
+
+    # Start the background refresh of the latest comic, once
+    # Needs a running event loop (call it from on_ready)
+    def start_refresher (self):
+        if self.refresh_interval and self._refresher is None:
+            self._refresher = asyncio.ensure_future (
+                    self._refresh_latest (self.refresh_interval))
+
+    # A comic which can't be added (malformed, failed request) is logged and
+    # tried again at the next refresh, the refresher keeps running
+    async def _refresh_latest (self, interval):
+        while True:
+            try:
+                latest = await self.latest_cache.refresh ()
+                if latest['status'] == 0:
+                    await self._add_new_comics (latest['comic'])
+            except Exception:
+                logging.exception ('Refreshing the latest comic failed')
+            await asyncio.sleep (interval)
+
+    def _last_local (self):
+        return max ((int (k) for k in self.refs), default = 0)
+
+    # Add the latest comic, and the ones published since the last known one,
+    # to the references
+    async def _add_new_comics (self, comic):
+        last = self._last_local ()
+        if comic['num'] <= last:
+            return
+
+        first = max (last + 1, comic['num'] - BACKFILL_MAX)
+        for n in range (first, comic['num']):
+            missing = await CLIENT.get_online_xkcd (number = n)
+            if missing['status'] == 0:
+                CLIENT.add_ref (self.refs, missing['comic'])
+                self.data.embeds.add (n)
+        CLIENT.add_ref (self.refs, comic)
+        self.data.embeds.add (comic['num'])
+        logging.info ('Latest comic is now {}'.format (comic['num']))
+
     @staticmethod
     async def latest (coma, message, command, args):
-        online_latest = await CLIENT.get_online_xkcd ()
+        online_latest = await coma.latest_cache.get ()
 
-        if online_latest['status'] is 0:
-            embed_comic = await CLIENT.create_embed (online_latest)
+        if online_latest['status'] == 0:
+            embed_comic = coma.data.embeds.get (online_latest)
         else:
-            local_latest = xkc_refs[str (max (list (xkcd_refs.keys ())))]
-            embed_comic = await CLIENT.create_embed (local_latest)
+            local_latest = coma.refs[str (coma._last_local ())]
+            embed_comic = coma.data.embeds.get (local_latest)
 
         await coma.client.send_message (message.channel, embed = embed_comic)
 
@@ -89,13 +369,28 @@ class CommandManager:
             await coma.client.edit_message (tmp, ' ')
             await CommandManager.random (coma, message, command, args)
         else:
-            result = await CLIENT.search (
-                    ' '.join (args),
-                    coma.index,
-                    coma.refs,
-                    coma.black_list)
+            # Same data for the whole search, even if a reload happens
+            data = coma.data
+            if data.ranker is not None:
+                with METRICS.time ('wame_search_seconds', kind = 'ranked'):
+                    result = await CommandManager._search_ranked (
+                            coma, data, message, args)
+            else:
+                with METRICS.time ('wame_search_seconds', kind = 'plain'):
+                    result = await CLIENT.search (
+                            ' '.join (args),
+                            data.index,
+                            data.refs,
+                            coma.black_list,
+                            scorer = data.scorer,
+                            cache = data.queries,
+                            vocab = data.vocab,
+                            max_edits = coma.max_edits,
+                            positions = data.positions)
+            METRICS.count ('wame_searches_total',
+                    result = 'found' if result['status'] == 0 else 'not_found')
             if result['status'] == 0:
-                comic_embed = await CLIENT.create_embed (result['comic'])
+                comic_embed = data.embeds.get (result['comic'])
                 await coma.client.edit_message (tmp, ' ', embed = comic_embed)
             else:
                 await coma.client.edit_message (
@@ -103,13 +398,90 @@ class CommandManager:
                         ' ', 
                         embed = coma.not_found_message)
                 
-                msg = await coma.client.wait_for_message (
-                        author = message.author,
-                        content = "random",
-                        timeout = 20)
-
-                if msg:
-                    await coma.client.edit_message (tmp, ' ')
-                    await CommandManager.random (coma, message, command, args)
-                else:
-                    await coma.client.edit_message (tmp, "**Timeout**")
+                # Waiting for the reply doesn't hold the command (and the
+                # dispatcher worker running it) for 20 seconds
+                offer = asyncio.ensure_future (CommandManager._offer_random (
+                    coma, tmp, message, command, args))
+                coma._offers.add (offer)
+                offer.add_done_callback (coma._offer_done)
+
+    # After a search which found nothing: post a random comic if the user
+    # replies "random" in time
+    @staticmethod
+    async def _offer_random (coma, tmp, message, command, args):
+        msg = await coma.client.wait_for_message (
+                author = message.author,
+                content = "random",
+                timeout = 20)
+
+        if msg:
+            await coma.client.edit_message (tmp, ' ')
+            await CommandManager.random (coma, message, command, args)
+        else:
+            await coma.client.edit_message (tmp, "**Timeout**")
+
+    # An offer is over: forget it, and log how it failed if it did (it's
+    # awaited by no one)
+    def _offer_done (self, offer):
+        self._offers.discard (offer)
+        if not offer.cancelled () and offer.exception () is not None:
+            logging.error ('Random comic offer failed',
+                    exc_info = offer.exception ())
+
+    # Ranked search, the matches after the first one are kept for --next
+    @staticmethod
+    async def _search_ranked (coma, data, message, args):
+        result = await CLIENT.search_ranked (
+                ' '.join (args),
+                data.refs,
+                coma.black_list,
+                data.ranker,
+                k = coma.ranking_k,
+                vocab = data.vocab,
+                max_edits = coma.max_edits,
+                positions = data.positions,
+                cache = data.queries)
+
+        key = (message.channel.id, message.author.id)
+        coma.next_matches.pop (key, None)
+        if result['status'] != 0:
+            return result
+
+        coma.next_matches[key] = result['comics'][1:]
+        if len (coma.next_matches) > NEXT_MATCHES_MAX:
+            coma.next_matches.popitem (last = False)
+
+        return {'status': 0, 'comic': result['comics'][0]}
+
+    # Post the next match of the user's last ranked search in this channel
+    @staticmethod
+    async def next_match (coma, message, command, args):
+        key = (message.channel.id, message.author.id)
+        matches = coma.next_matches.get (key)
+        if not matches:
+            await coma.client.send_message (
+                    message.channel,
+                    embed = coma.no_next_message)
+            return
+
+        embed_comic = coma.data.embeds.get (matches.pop (0))
+        await coma.client.send_message (message.channel, embed = embed_comic)
+
+    # Admin only: reload the index and the references
+    @staticmethod
+    async def reload_data (coma, message, command, args):
+        if not message.author.id in coma.admins:
+            return
+
+        tmp = await coma.client.send_message (message.channel, 'Reloading...')
+        try:
+            data = await coma.reload ()
+            await coma.client.edit_message (
+                    tmp,
+                    'Reloaded: {} words, {} comics.'.format (
+                        len (data.index), len (data.refs)))
+        except Exception as e:
+            logging.exception ('Reload failed, keeping the old data')
+            await coma.client.edit_message (
+                    tmp,
+                    'Reload failed, keeping the old data: {}'.format (e))
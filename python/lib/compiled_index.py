@@ -0,0 +1,323 @@
+import io
+import sys
+import mmap
+import struct
+from zlib import crc32
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+import atomic_file as ATOMIC
+
+# Binary, array backed version of xkcd.index.json
+#
+# The json index is a {word: {"comic_number": count}} dict of dicts, which is
+# heavy to keep in memory and hashes string comic numbers on every lookup.
+# The compiled index keeps the same information in a few contiguous buffers:
+#   vocab_offsets: uint32[n_terms + 1] -> slices of the utf-8 vocabulary blob
+#   offsets      : uint32[n_terms + 1] -> slices of docs/tfs for each term
+#   docs         : uint32[n_postings]  -> comic numbers, sorted for each term
+#   tfs          : uint32[n_postings]  -> number of occurrences in the comic
+# The vocabulary is sorted, so a term id is also the rank of the word.
+#
+# File layout (little endian):
+#   header | vocab_offsets | offsets | docs | tfs | vocab blob
+# Every array starts on a 4 bytes boundary so it can be used in place.
+# CompiledIndex.open maps the file instead of reading it: several bot
+# processes then share the same pages through the OS page cache.
+# Pickled (see snapshot), an index is the content of its file plus what is
+# built from it on load, so that unpickling builds nothing.
+
+MAGIC = b'XKCDIDX\x00'
+VERSION = 1
+HEADER = struct.Struct ('<8sIIII')
+
+# 'I' is 4 bytes on every platform we care about, check it anyway
+if array ('I').itemsize != 4:
+    raise ImportError ('compiled_index needs 4 bytes unsigned ints')
+
+#==============================================================================#
+
+# The postings of one word
+# Behaves like the {comic_number: count} dict of the json index, but the keys
+# are ints and nothing is copied: docs and tfs are views on the index buffers
+class Postings (Mapping):
+    __slots__ = ('docs', 'tfs')
+
+    def __init__ (self, docs, tfs):
+        self.docs = docs
+        self.tfs = tfs
+
+    def __len__ (self):
+        return len (self.docs)
+
+    def __iter__ (self):
+        return iter (self.docs)
+
+    def __getitem__ (self, comic_number):
+        i = bisect_left (self.docs, comic_number)
+        if i < len (self.docs) and self.docs[i] == comic_number:
+            return self.tfs[i]
+        raise KeyError (comic_number)
+
+    def items (self):
+        return zip (self.docs, self.tfs)
+
+#==============================================================================#
+
+class CompiledIndex:
+    def __init__ (self, vocab, vocab_offsets, offsets, docs, tfs,
+            terms = True):
+        # vocab is the raw utf-8 blob, the other ones are uint32 buffers
+        self._vocab = vocab
+        self._vocab_offsets = vocab_offsets
+        self._offsets = offsets
+        self._docs = docs
+        self._tfs = tfs
+
+        # Interned word -> term id
+        # Without it words are found through the crc32 of their utf-8 bytes:
+        # two uint32 arrays (crc32 sorted, term id) built on the first lookup,
+        # 8 bytes per word in the process memory instead of a str and a dict
+        # entry. The vocabulary itself stays in the (shared) buffer
+        self._terms = None
+        self._hashes = None
+        self._hash_ids = None
+        if terms:
+            self._terms = {sys.intern (w): i
+                    for i, w in enumerate (self._iter_words ())}
+
+        # Number of indexed words of each comic, see lengths
+        self._lengths = None
+
+    def _word (self, term_id):
+        start = self._vocab_offsets[term_id]
+        end = self._vocab_offsets[term_id + 1]
+        return bytes (self._vocab[start:end]).decode ('utf-8')
+
+    def _iter_words (self):
+        for i in range (len (self._offsets) - 1):
+            yield self._word (i)
+
+    def __len__ (self):
+        return len (self._offsets) - 1
+
+    def __contains__ (self, word):
+        return self.term_id (word) >= 0
+
+    def __iter__ (self):
+        return self._iter_words ()
+
+    def __getitem__ (self, word):
+        term_id = self.term_id (word)
+        if term_id < 0:
+            raise KeyError (word)
+        return self.postings_of (term_id)
+
+    def get (self, word, default = None):
+        term_id = self.term_id (word)
+        if term_id < 0:
+            return default
+        return self.postings_of (term_id)
+
+    def term_id (self, word):
+        if self._terms is not None:
+            return self._terms.get (word, -1)
+
+        if self._hashes is None:
+            self._build_hashes ()
+        key = word.encode ('utf-8')
+        h = crc32 (key)
+        hashes, vocab, offsets = self._hashes, self._vocab, self._vocab_offsets
+        j = bisect_left (hashes, h)
+        # Words sharing a crc32 are next to each other
+        while j < len (hashes) and hashes[j] == h:
+            i = self._hash_ids[j]
+            if vocab[offsets[i]:offsets[i + 1]] == key:
+                return i
+            j += 1
+        return -1
+
+    # About 10 ms for the 19k words of the xkcd index
+    def _build_hashes (self):
+        vocab = bytes (self._vocab)
+        offsets = self._vocab_offsets.tolist ()
+        # crc32 and term id in one int, sorted by crc32 then term id
+        keys = [crc32 (vocab[start:end]) << 32 | i for i, (start, end)
+                in enumerate (zip (offsets, offsets[1:]))]
+        keys.sort ()
+        self._hashes = array ('I', [k >> 32 for k in keys])
+        self._hash_ids = array ('I', [k & 0xffffffff for k in keys])
+
+    def postings_of (self, term_id):
+        start = self._offsets[term_id]
+        end = self._offsets[term_id + 1]
+        return Postings (self._docs[start:end], self._tfs[start:end])
+
+    def words (self):
+        return self._iter_words ()
+
+    @property
+    def posting_count (self):
+        return len (self._docs)
+
+    # Biggest comic number referenced by the index
+    @property
+    def max_comic (self):
+        return max (self._docs) if len (self._docs) else 0
+
+    # Number of indexed words of each comic, by comic number (for BM25)
+    # Computed on first use and kept with the index
+    @property
+    def lengths (self):
+        if self._lengths is None:
+            lengths = array ('I', [0]) * (self.max_comic + 1)
+            for term_id in range (len (self)):
+                for doc, tf in self.postings_of (term_id).items ():
+                    lengths[doc] += tf
+            self._lengths = lengths
+        return self._lengths
+
+    # Back to the {word: {"comic_number": count}} form of the json index
+    def to_dict (self):
+        return {
+                w: {str (d): t for d, t in self.postings_of (i).items ()}
+                for i, w in enumerate (self._iter_words ())}
+
+    # Build from the json index, keys of the postings must be numbers
+    @classmethod
+    def from_dict (cls, index):
+        return cls._build (
+                (w, {int (k): v for k, v in index[w].items ()})
+                for w in sorted (index))
+
+    # New index with a delta segment (see index_delta) merged in
+    # Every posting of a comic listed as removed is dropped, its new
+    # postings (if any) come from the delta
+    def merged (self, delta):
+        removed = {int (n) for n in delta['removed']}
+        added = delta['postings']
+
+        def postings ():
+            for word in sorted (set (self.words ()) | set (added)):
+                p = dict ()
+                term_id = self.term_id (word)
+                if term_id >= 0:
+                    p = {d: t for d, t in self.postings_of (term_id).items ()
+                            if d not in removed}
+                for k, v in added.get (word, dict ()).items ():
+                    p[int (k)] = v
+                yield word, p
+
+        return self._build (postings ())
+
+    # postings: (word, {comic_number: count}) pairs, sorted by word
+    # Words without any posting are left out
+    @classmethod
+    def _build (cls, postings):
+        vocab = bytearray ()
+        vocab_offsets = array ('I', [0])
+        offsets = array ('I', [0])
+        docs = array ('I')
+        tfs = array ('I')
+
+        for word, p in postings:
+            if not p:
+                continue
+            vocab += word.encode ('utf-8')
+            vocab_offsets.append (len (vocab))
+            for comic_number in sorted (p):
+                docs.append (comic_number)
+                tfs.append (p[comic_number])
+            offsets.append (len (docs))
+
+        return cls (
+                bytes (vocab),
+                memoryview (vocab_offsets),
+                memoryview (offsets),
+                memoryview (docs),
+                memoryview (tfs))
+
+    def save (self, f):
+        with ATOMIC.replacing (f, 'wb') as outfile:
+            self._write (outfile)
+
+    # Content of the file written by save
+    def to_bytes (self):
+        out = io.BytesIO ()
+        self._write (out)
+        return out.getvalue ()
+
+    def _write (self, outfile):
+        outfile.write (HEADER.pack (
+                MAGIC,
+                VERSION,
+                len (self),
+                len (self._docs),
+                len (self._vocab)))
+        for buf in (self._vocab_offsets, self._offsets,
+                self._docs, self._tfs):
+            a = array ('I', buf)
+            if sys.byteorder == 'big':
+                a.byteswap ()
+            a.tofile (outfile)
+        outfile.write (self._vocab)
+
+    # Pickled as its file, the term ids and the lengths of the comics
+    def __reduce__ (self):
+        return (type (self)._unpickle,
+                (self.to_bytes (), self._terms, self._lengths))
+
+    @classmethod
+    def _unpickle (cls, buf, terms, lengths):
+        index = cls.from_buffer (buf, terms = False)
+        index._terms = terms
+        index._lengths = lengths
+        return index
+
+    # Read a compiled index file into private buffers
+    @classmethod
+    def load (cls, f):
+        with open (f, 'rb') as infile:
+            data = infile.read ()
+        return cls.from_buffer (data, copy = True)
+
+    # Map a compiled index file in memory, read only
+    # Pages are loaded on demand and shared with every other process mapping
+    # the same file. The word -> term id dict is not built, see __init__
+    @classmethod
+    def open (cls, f, terms = False):
+        with open (f, 'rb') as infile:
+            buf = mmap.mmap (infile.fileno (), 0, access = mmap.ACCESS_READ)
+        return cls.from_buffer (buf, copy = False, terms = terms)
+
+    # Slice the sections of a compiled index out of buf
+    # With copy = False the arrays are views on buf, which has to be
+    # little endian and stay alive as long as the index (the views keep it)
+    @classmethod
+    def from_buffer (cls, buf, copy = False, terms = True):
+        magic, version, n_terms, n_postings, vocab_size = \
+                HEADER.unpack_from (buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError ('Not a compiled xkcd index (or wrong version).')
+
+        view = memoryview (buf)
+        sizes = [n_terms + 1, n_terms + 1, n_postings, n_postings]
+        pos = HEADER.size
+        sections = []
+        for size in sizes:
+            raw = view[pos:pos + 4 * size]
+            if copy or sys.byteorder == 'big':
+                a = array ('I')
+                a.frombytes (raw)
+                if sys.byteorder == 'big':
+                    a.byteswap ()
+                sections.append (memoryview (a))
+            else:
+                sections.append (raw.cast ('I'))
+            pos += 4 * size
+
+        vocab = view[pos:pos + vocab_size]
+        if copy:
+            vocab = bytes (vocab)
+
+        return cls (vocab, *sections, terms = terms)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+# Why a command was turned down by Dispatcher.submit
+BUSY = 'busy'   # the queue is full
+USER = 'user'   # the user has too many commands waiting or running
+GUILD = 'guild' # same thing for the server
+
+# Runs the commands of the bot on a fixed number of worker tasks
+#
+# on_message only puts the command in a bounded queue (submit) and returns,
+# the workers take them out one by one. When a flood of messages comes in,
+# the queue fills up and the extra commands are turned down at once instead
+# of piling up: the caller tells the user (see REASONS in xkcd.py), once
+# per streak (see tell).
+# A user or a server can only have so many commands in the queue or running
+# at the same time, so one of them can't take every worker.
+#   handler  : coroutine function running a command, called with the
+#              arguments given to submit
+#   workers  : number of worker tasks
+#   size     : places in the queue
+#   per_user : commands waiting or running for one user
+#   per_guild: same thing for one server (or private channel)
+class Dispatcher:
+    def __init__ (self, handler, workers = 4, size = 64, per_user = 2,
+            per_guild = 8):
+        self.handler = handler
+        self.workers = workers
+        self.size = size
+        self.per_user = per_user
+        self.per_guild = per_guild
+        self._queue = None
+        self._tasks = list ()
+        # Commands waiting or running, only for the keys which have some
+        self._users = dict ()
+        self._guilds = dict ()
+        # Keys already told why their commands are turned down, see tell
+        self._told = {BUSY: set (), USER: set (), GUILD: set ()}
+        self.shed = 0
+
+    # Start the workers, once
+    # Needs a running event loop (call it from on_ready)
+    def start (self):
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue (maxsize = self.size)
+        self._tasks = [asyncio.ensure_future (self._work ())
+                for i in range (self.workers)]
+
+    @property
+    def pending (self):
+        return self._queue.qsize () if self._queue is not None else 0
+
+    # Queue a command of user in guild
+    # Returns None if it was queued, the reason why it wasn't otherwise
+    # (BUSY, USER or GUILD)
+    def submit (self, user, guild, *args):
+        reason = None
+        if self._queue is None or self._queue.full ():
+            reason = BUSY
+        elif self._users.get (user, 0) >= self.per_user:
+            reason = USER
+        elif self._guilds.get (guild, 0) >= self.per_guild:
+            reason = GUILD
+        if reason is not None:
+            self.shed += 1
+            return reason
+
+        self._users[user] = self._users.get (user, 0) + 1
+        self._guilds[guild] = self._guilds.get (guild, 0) + 1
+        self._queue.put_nowait ((user, guild, args))
+        # The streaks of this user and server are over
+        self._told[BUSY].clear ()
+        self._told[USER].discard (user)
+        self._told[GUILD].discard (guild)
+        return None
+
+    # True the first time a command of user in guild is turned down for
+    # reason since the last one which went through: to tell them once, not
+    # at every message of a flood. BUSY is told once per server, USER once
+    # per user and GUILD once per server.
+    def tell (self, user, guild, reason):
+        told = self._told[reason]
+        key = user if reason == USER else guild
+        if key in told:
+            return False
+        told.add (key)
+        return True
+
+    # A key without commands is forgotten, its streak with it
+    @staticmethod
+    def _release (counts, told, key):
+        counts[key] -= 1
+        if not counts[key]:
+            del counts[key]
+            told.discard (key)
+
+    async def _work (self):
+        while True:
+            user, guild, args = await self._queue.get ()
+            try:
+                await self.handler (*args)
+            except Exception:
+                logging.exception ('Command failed')
+            finally:
+                self._release (self._users, self._told[USER], user)
+                self._release (self._guilds, self._told[GUILD], guild)
+                self._queue.task_done ()
@@ -0,0 +1,64 @@
+import random
+import discord
+from array import array
+from cache import LRU
+from metrics import METRICS
+
+# Embeds kept at most, more than the whole corpus: once warm, every comic
+# of the references is served without building anything
+SIZE = 4096
+
+# Embed of a comic (the 'comic' part of a reference)
+def build_embed (comic):
+    embed_comic = discord.Embed (
+            title = '{}: {}'.format (comic['num'], comic['title']),
+            colour = discord.Colour (0x00ff00),
+            url = comic['img'])
+
+    embed_comic.set_footer (text = '{}'.format (comic['alt']))
+    embed_comic.set_image (url = comic['img'])
+    embed_comic.set_author (
+            name = 'xkcd',
+            url = 'https://xkcd.com/{}'.format (comic['num']))
+
+    return embed_comic
+
+# Embeds of the comics, built once and reused for every reply
+# The corpus hardly ever changes, and discord only reads an embed when
+# sending it, so the same object can be posted again and again.
+# Also keeps the numbers of the comics which can be posted (the references
+# hold entries without a comic, i.e. 404) to pick random ones.
+class EmbedCache:
+    def __init__ (self, refs, size = SIZE):
+        self.refs = refs
+        # A ComicTable knows them without building every reference
+        comics = getattr (refs, 'comics', None)
+        if comics is not None:
+            self.nums = array ('I', comics)
+        else:
+            self.nums = array ('I', sorted (
+                int (k) for k in refs if refs[k]['comic']))
+        self._embeds = LRU (size)
+
+    # A comic was added to the references
+    def add (self, num):
+        if not num in self.nums:
+            self.nums.append (num)
+
+    # Embed of a reference entry (or an online result: {'comic': ...})
+    def get (self, ref):
+        num = ref['comic']['num']
+        embed_comic = self._embeds.get (num)
+        if embed_comic is None:
+            with METRICS.time ('wame_embed_build_seconds'):
+                embed_comic = build_embed (ref['comic'])
+            self._embeds.put (num, embed_comic)
+        return embed_comic
+
+    # Embed of a random comic
+    def random (self):
+        return self.get (self.refs[str (random.choice (self.nums))])
+
+    @property
+    def stats (self):
+        return self._embeds
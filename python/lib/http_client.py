@@ -0,0 +1,132 @@
+import json
+import asyncio
+import threading
+import http.client
+import urllib.error
+from urllib.parse import urlsplit, urljoin
+from concurrent.futures import ThreadPoolExecutor
+from metrics import METRICS
+
+USER_AGENT = 'Mozilla/5.0 (compatible; wame xkcd bot)'
+MAX_REDIRECTS = 3
+
+# Non blocking HTTP GET for the bot
+#
+# urlopen blocks the event loop for as long as xkcd.com takes to answer.
+# Here the requests run in a small thread pool, each thread keeping its own
+# keep-alive connections (one per scheme/host/port) so that repeated calls to
+# the same host don't pay a new TCP + TLS handshake every time.
+#   max_connections: cap on the number of requests in flight (and threads)
+#   timeout        : default timeout of a request, in seconds
+# Errors are raised as urllib.error.HTTPError (status >= 400) or OSError
+# (network, timeout), like urlopen does.
+class AsyncHTTP:
+    def __init__ (self, max_connections = 4, timeout = 10):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor (
+                max_workers = max_connections,
+                thread_name_prefix = 'http')
+        self._local = threading.local ()
+        self._semaphore = None
+
+    # Keep-alive connection of the calling thread for this host
+    def _connection (self, scheme, host, port, timeout):
+        pool = self._local.__dict__.setdefault ('pool', dict ())
+        key = (scheme, host, port)
+        conn = pool.get (key)
+        if conn is None:
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection (host, port, timeout = timeout)
+            else:
+                conn = http.client.HTTPConnection (host, port, timeout = timeout)
+            pool[key] = conn
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout (timeout)
+        return conn
+
+    def _drop (self, scheme, host, port):
+        conn = self._local.__dict__.get ('pool', dict ()).pop (
+                (scheme, host, port), None)
+        if conn is not None:
+            conn.close ()
+
+    # Runs in a worker thread
+    def _fetch (self, url, headers, timeout):
+        for i in range (MAX_REDIRECTS + 1):
+            parts = urlsplit (url)
+            scheme = parts.scheme or 'http'
+            port = parts.port
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            # A kept alive connection may have been closed by the server in
+            # the meantime: retry once on a fresh one
+            for attempt in range (2):
+                conn = self._connection (scheme, parts.hostname, port, timeout)
+                try:
+                    conn.request ('GET', path, headers = headers)
+                    response = conn.getresponse ()
+                    body = response.read ()
+                    break
+                except (http.client.RemoteDisconnected,
+                        ConnectionResetError, BrokenPipeError):
+                    self._drop (scheme, parts.hostname, port)
+                    if attempt:
+                        raise
+                except Exception:
+                    self._drop (scheme, parts.hostname, port)
+                    raise
+
+            if response.will_close:
+                self._drop (scheme, parts.hostname, port)
+
+            location = response.getheader ('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                url = urljoin (url, location)
+                continue
+            if response.status >= 400:
+                raise urllib.error.HTTPError (
+                        url, response.status, response.reason,
+                        response.msg, None)
+            return body
+
+        raise urllib.error.HTTPError (
+                url, response.status, 'Too many redirects', response.msg, None)
+
+    # Body of url, as bytes
+    async def get (self, url, headers = None, timeout = None):
+        if timeout is None:
+            timeout = self.timeout
+        h = {'User-Agent': USER_AGENT}
+        h.update (headers or dict ())
+
+        # Created here so it belongs to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore (self.max_connections)
+
+        loop = asyncio.get_event_loop ()
+        host = urlsplit (url).hostname
+        # Waiting for a free connection included
+        with METRICS.time ('wame_http_seconds', host = host):
+            try:
+                async with self._semaphore:
+                    # The socket timeout covers each read, wait_for the
+                    # whole request
+                    return await asyncio.wait_for (
+                            loop.run_in_executor (
+                                self._executor, self._fetch, url, h, timeout),
+                            timeout * (MAX_REDIRECTS + 1))
+            except Exception:
+                METRICS.count ('wame_http_errors_total', host = host)
+                raise
+
+    async def get_json (self, url, headers = None, timeout = None):
+        body = await self.get (url, headers = headers, timeout = timeout)
+        return json.loads (body.decode ('utf-8'))
+
+    # Stop the worker threads, the connections go with them
+    def close (self):
+        self._executor.shutdown (wait = False)
@@ -0,0 +1,67 @@
+import json
+import atomic_file as ATOMIC
+
+# Delta segment of the search index
+#
+# scraper/index.py only re-indexes the comics which changed since the last
+# full build, and records the changes here instead of rewriting the index:
+#   removed : {"comic_number": [words]} -> postings to drop from the base
+#             index, the words the comic had there ([] for a new comic)
+#   postings: {word: {"comic_number": count}} -> postings to add, same form
+#             as the json index
+# The bot merges it in when it loads the index, a new delta is a change of
+# the watched files and reloads it. A full build folds it in the base.
+
+def empty ():
+    return {'removed': dict (), 'postings': dict ()}
+
+# Load a delta, an empty one if the file doesn't exist
+def load (f):
+    try:
+        with open (f) as infile:
+            return json.load (infile)
+    except FileNotFoundError:
+        return empty ()
+
+# Written next to it then renamed: the bot never reads half a delta
+def save (f, delta):
+    with ATOMIC.replacing (f) as outfile:
+        json.dump (delta, outfile)
+
+def is_empty (delta):
+    return not delta['removed'] and not delta['postings']
+
+# Record a new version of a comic
+# base_words: words of the comic in the base index, if it's the first
+#             change of this comic since the base was built
+# old_words : words of the previous version (what the delta holds for it)
+# new_words : {word: count} of the new version, None if the comic is gone
+def replace_comic (delta, num, base_words, old_words, new_words):
+    num = str (num)
+    if num not in delta['removed']:
+        delta['removed'][num] = list (base_words)
+
+    for w in old_words:
+        postings = delta['postings'].get (w)
+        if postings and num in postings:
+            del postings[num]
+            if not postings:
+                del delta['postings'][w]
+
+    for w, count in (new_words or dict ()).items ():
+        delta['postings'].setdefault (w, dict ())[num] = count
+
+# Merge delta in a json index (modified in place)
+def apply (index, delta):
+    for num, words in delta['removed'].items ():
+        for w in words:
+            postings = index.get (w)
+            if postings and num in postings:
+                del postings[num]
+                if not postings:
+                    del index[w]
+
+    for w, postings in delta['postings'].items ():
+        index.setdefault (w, dict ()).update (postings)
+
+    return index
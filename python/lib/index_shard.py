@@ -0,0 +1,75 @@
+import hashlib
+import xkcd_helpers as XKCD
+import tokenizer as TOKENIZER
+import refs_jsonl as REFS_JSONL
+
+# The part of scraper/index.py which indexes comics, in a module of its own
+# so that the worker processes of a parallel build (index.py --jobs) can
+# run it (index_range). The serial build goes through the same functions, with one shard
+# holding every comic.
+
+# Text of a comic, as indexed (before tokenizing)
+def comic_text (ref):
+    transcript = str ()
+    title = str ()
+    alt = str ()
+
+    #FIXME: I really need to fix these magic numbers
+    if ref['stat_com']['status'] == 0:
+        # Retrieve the comic info from the references
+        title = ref['comic']['title']
+        alt = ref['comic']['alt']
+        if ref['stat_tr']['status'] >= -1:
+            transcript = XKCD.removeNoise (ref['comic']['transcript'])
+
+    return '{} {} {}'.format(title, alt,  transcript)
+
+# {word: count} of a comic
+# The words go straight from the tokenizer to the indexer, filtered the same
+# way as the queries of the bot (TOKENIZER.terms)
+def comic_words (text, i, black_list):
+    single = dict ()
+    XKCD.indexTokens (TOKENIZER.terms (text, black_list), i, single, ())
+    return {w: single[w][i] for w in single}
+
+def content_hash (text):
+    return hashlib.sha1 (text.encode ('utf-8')).hexdigest ()
+
+# Index a shard of the references
+# items: [(comic number, ref)]
+# Returns the partial index {word: {comic number: count}} and the state of
+# the comics {comic number: {hash, words}}, both in the order of items
+def index_shard (items, black_list):
+    index = dict ()
+    comics = dict ()
+    for i, ref in items:
+        text = comic_text (ref)
+        words = comic_words (text, i, black_list)
+
+        # Record the comic in the index
+        for w, count in words.items ():
+            index.setdefault (w, dict ())[i] = count
+        comics[i] = {'hash': content_hash (text), 'words': list (words)}
+    return index, comics
+
+# Merge the results of index_shard for consecutive shards, in their order
+# Each word ends up where it first appears and its comics keep the order of
+# the references: exactly the index one shard of everything would give
+def merge_shards (shards):
+    index = dict ()
+    comics = dict ()
+    for partial, state in shards:
+        for w, postings in partial.items ():
+            merged = index.get (w)
+            if merged is None:
+                index[w] = postings
+            else:
+                merged.update (postings)
+        comics.update (state)
+    return index, comics
+
+# Index the comics first to last of the line delimited references f
+# A worker of index.py --jobs reads its comics itself: only the range is
+# sent to it, not the references
+def index_range (f, first, last, black_list):
+    return index_shard (REFS_JSONL.iter_last (f, first, last), black_list)
@@ -0,0 +1,244 @@
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets, in seconds (the last one is +Inf)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0)
+
+# Counts of the values falling in each of BUCKETS, their sum and number
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__ (self):
+        self.counts = [0] * (len (BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe (self, value):
+        self.counts[bisect_left (BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Upper bound of the bucket holding the q quantile (0 < q <= 1)
+    # Beyond the last bucket, the mean is all there is to tell
+    def quantile (self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip (BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return max (BUCKETS[-1], self.sum / self.count)
+
+# Times a block into a histogram: with METRICS.time (...):
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__ (self, histogram):
+        self.histogram = histogram
+
+    def __enter__ (self):
+        self.start = time.perf_counter ()
+        return self
+
+    def __exit__ (self, *exc):
+        self.histogram.observe (time.perf_counter () - self.start)
+        return False
+
+# What METRICS.time gives when the metrics are off: does nothing
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *exc):
+        return False
+
+_NO_TIMER = _NoTimer ()
+
+def _key (labels):
+    return tuple (sorted (labels.items ()))
+
+def _labels (key):
+    if not key:
+        return ''
+    return '{' + ','.join ('{}="{}"'.format (k, v) for k, v in key) + '}'
+
+# Where the time of the bot goes
+#
+# The hot paths record into histograms (latencies) and counters, by name and
+# labels: METRICS.time ('wame_command_seconds', command = 'search').
+# Values which already exist somewhere (hits of a cache, length of a queue)
+# aren't recorded again, a collector reads them when the metrics are asked
+# for (collect).
+# Off by default: time then hands out a shared timer doing nothing and
+# count returns at once, the cost is one test per call. The bot turns
+# them on from the "metrics" entry of the config (enable).
+# They are served in the Prometheus text format on a local port and/or
+# written to the log every so often, see start.
+class Metrics:
+    def __init__ (self):
+        self.enabled = False
+        self.config = dict ()
+        self._histograms = dict ()  # (name, labels) -> Histogram
+        self._counters = dict ()    # (name, labels) -> number
+        self._collectors = list ()  # (name, kind, function)
+        self._tasks = list ()
+
+    # "metrics": {"enabled": true, "host": "127.0.0.1", "port": 9108,
+    #             "log": 300, "lag": 1}
+    #   port: where to serve them, 0 for nowhere
+    #   log : seconds between two log lines, 0 for none
+    #   lag : seconds between two checks of the event loop lag
+    def enable (self, config):
+        self.config = config
+        self.enabled = config.get ('enabled', True)
+
+    def histogram (self, name, **labels):
+        key = (name, _key (labels))
+        histogram = self._histograms.get (key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram ()
+        return histogram
+
+    def time (self, name, **labels):
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer (self.histogram (name, **labels))
+
+    def observe (self, name, value, **labels):
+        if self.enabled:
+            self.histogram (name, **labels).observe (value)
+
+    def count (self, name, n = 1, **labels):
+        if self.enabled:
+            key = (name, _key (labels))
+            self._counters[key] = self._counters.get (key, 0) + n
+
+    # Read values when the metrics are asked for
+    #   kind    : 'gauge' or 'counter'
+    #   function: returns [(labels dict, value)]
+    def collect (self, name, kind, function):
+        self._collectors.append ((name, kind, function))
+
+    # Time every call of the coroutine method attr of obj
+    # Done only when the metrics are on, nothing is wrapped otherwise
+    def wrap (self, obj, attr, name, **labels):
+        if not self.enabled:
+            return
+        f = getattr (obj, attr)
+        histogram = self.histogram (name, **labels)
+
+        async def timed (*args, **kwargs):
+            with _Timer (histogram):
+                return await f (*args, **kwargs)
+        setattr (obj, attr, timed)
+
+    # Every metric in the Prometheus text format
+    def render (self):
+        lines = list ()
+        typed = set ()
+
+        def header (name, kind):
+            if not name in typed:
+                typed.add (name)
+                lines.append ('# TYPE {} {}'.format (name, kind))
+
+        for (name, key), histogram in sorted (self._histograms.items ()):
+            header (name, 'histogram')
+            seen = 0
+            for bound, n in zip (BUCKETS + ('+Inf',), histogram.counts):
+                seen += n
+                lines.append ('{}_bucket{} {}'.format (
+                    name, _labels (key + (('le', bound),)), seen))
+            lines.append ('{}_sum{} {}'.format (
+                name, _labels (key), histogram.sum))
+            lines.append ('{}_count{} {}'.format (
+                name, _labels (key), histogram.count))
+
+        for (name, key), n in sorted (self._counters.items ()):
+            header (name, 'counter')
+            lines.append ('{}{} {}'.format (name, _labels (key), n))
+
+        for name, kind, function in self._collectors:
+            header (name, kind)
+            for labels, value in function ():
+                lines.append ('{}{} {}'.format (
+                    name, _labels (_key (labels)), value))
+
+        return '\n'.join (lines) + '\n'
+
+    # One line for the log: count, p50 and p99 of each histogram, counters
+    # and collected values
+    def summary (self):
+        parts = list ()
+        for (name, key), h in sorted (self._histograms.items ()):
+            parts.append ('{}{} n={} p50={:.1f}ms p99={:.1f}ms'.format (
+                name, _labels (key), h.count,
+                h.quantile (0.5) * 1000, h.quantile (0.99) * 1000))
+        for (name, key), n in sorted (self._counters.items ()):
+            parts.append ('{}{}={}'.format (name, _labels (key), n))
+        for name, kind, function in self._collectors:
+            for labels, value in function ():
+                parts.append ('{}{}={:.4g}'.format (
+                    name, _labels (_key (labels)), value))
+        return '; '.join (parts)
+
+    # Start serving, logging and watching the event loop, once
+    # Needs a running event loop (call it from on_ready)
+    def start (self):
+        if not self.enabled or self._tasks:
+            return
+        port = self.config.get ('port', 0)
+        if port:
+            self._tasks.append (asyncio.ensure_future (asyncio.start_server (
+                self._serve, self.config.get ('host', '127.0.0.1'), port)))
+        log = self.config.get ('log', 0)
+        if log:
+            self._tasks.append (asyncio.ensure_future (self._log (log)))
+        self._tasks.append (asyncio.ensure_future (
+            self._watch_lag (self.config.get ('lag', 1))))
+
+    # Answers any GET with the metrics
+    async def _serve (self, reader, writer):
+        try:
+            request = await reader.readline ()
+            while (await reader.readline ()).strip ():
+                pass
+            if request.split (b' ')[:1] == [b'GET']:
+                body = self.render ().encode ('utf-8')
+                status = b'200 OK'
+            else:
+                body = b''
+                status = b'405 Method Not Allowed'
+            writer.write (b'HTTP/1.0 ' + status + b'\r\n'
+                    b'Content-Type: text/plain; version=0.0.4\r\n'
+                    b'Content-Length: ' + str (len (body)).encode () + b'\r\n'
+                    b'\r\n' + body)
+            await writer.drain ()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close ()
+
+    async def _log (self, interval):
+        while True:
+            await asyncio.sleep (interval)
+            logging.info ('Metrics: {}'.format (self.summary ()))
+
+    # How late the loop wakes a sleeping task: time the other tasks held it
+    async def _watch_lag (self, interval):
+        loop = asyncio.get_event_loop ()
+        histogram = self.histogram ('wame_event_loop_lag_seconds')
+        while True:
+            start = loop.time ()
+            await asyncio.sleep (interval)
+            histogram.observe (max (0.0, loop.time () - start - interval))
+
+# The metrics of the process, see Metrics
+METRICS = Metrics ()
@@ -0,0 +1,140 @@
+import sys
+import mmap
+import struct
+from array import array
+from itertools import accumulate
+import varint as VARINT
+from cache import LRU
+from compiled_index import CompiledIndex, Postings
+
+# Compressed version of the compiled index
+#
+# The postings of a word are (gap to the previous comic number, count)
+# pairs, varint encoded (see varint) one after the other. Most gaps and
+# counts fit in one byte: a posting takes 2 to 3 bytes instead of the 8 of
+# the compiled index (two uint32).
+#   vocab_offsets: uint32[n_terms + 1] -> slices of the utf-8 vocabulary blob
+#   offsets      : uint32[n_terms + 1] -> slices of the postings blob
+#
+# File layout (little endian):
+#   header | vocab_offsets | offsets | vocab blob | postings blob
+#
+# Only the postings of the words looked up are decoded, into the same
+# Postings as the compiled index, and the last ones are kept (cache_size)
+# for the scorer and ranker which ask for the same words again and again.
+
+MAGIC = b'XKCDPAK\x00'
+VERSION = 1
+HEADER = struct.Struct ('<8sIIIIII')
+
+# Decoded postings kept per index
+CACHE_SIZE = 512
+
+#==============================================================================#
+
+class PackedIndex (CompiledIndex):
+    # blob is the postings blob, n_postings and max_comic are in the header
+    # (they can't be read from the blob without decoding all of it)
+    def __init__ (self, vocab, vocab_offsets, offsets, blob, n_postings,
+            max_comic, terms = True, cache_size = CACHE_SIZE):
+        super ().__init__ (vocab, vocab_offsets, offsets, None, None, terms)
+        self._blob = blob
+        self._n_postings = n_postings
+        self._max_comic = max_comic
+        self._decoded = LRU (cache_size)
+
+    def postings_of (self, term_id):
+        postings = self._decoded.get (term_id)
+        if postings is None:
+            values = VARINT.decode (self._blob,
+                    self._offsets[term_id], self._offsets[term_id + 1])
+            postings = Postings (
+                    array ('I', accumulate (values[0::2])),
+                    array ('I', values[1::2]))
+            self._decoded.put (term_id, postings)
+        return postings
+
+    @property
+    def posting_count (self):
+        return self._n_postings
+
+    @property
+    def max_comic (self):
+        return self._max_comic
+
+    # postings: (word, {comic_number: count}) pairs, sorted by word
+    @classmethod
+    def _build (cls, postings):
+        vocab = bytearray ()
+        vocab_offsets = array ('I', [0])
+        offsets = array ('I', [0])
+        blob = bytearray ()
+        n_postings = 0
+        max_comic = 0
+
+        for word, p in postings:
+            if not p:
+                continue
+            vocab += word.encode ('utf-8')
+            vocab_offsets.append (len (vocab))
+            prev = 0
+            for comic_number in sorted (p):
+                VARINT.encode (comic_number - prev, blob)
+                VARINT.encode (p[comic_number], blob)
+                prev = comic_number
+            offsets.append (len (blob))
+            n_postings += len (p)
+            max_comic = max (max_comic, prev)
+
+        return cls (bytes (vocab), vocab_offsets, offsets, bytes (blob),
+                n_postings, max_comic)
+
+    # Called by CompiledIndex.save, see atomic_file
+    def _write (self, outfile):
+        outfile.write (HEADER.pack (
+                MAGIC,
+                VERSION,
+                len (self),
+                self._n_postings,
+                self._max_comic,
+                len (self._vocab),
+                len (self._blob)))
+        for buf in (self._vocab_offsets, self._offsets):
+            a = array ('I', buf)
+            if sys.byteorder == 'big':
+                a.byteswap ()
+            a.tofile (outfile)
+        outfile.write (self._vocab)
+        outfile.write (self._blob)
+
+    # Same as CompiledIndex.load/open, the blob is never copied by open
+    @classmethod
+    def from_buffer (cls, buf, copy = False, terms = True):
+        magic, version, n_terms, n_postings, max_comic, vocab_size, \
+                blob_size = HEADER.unpack_from (buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError ('Not a packed xkcd index (or wrong version).')
+
+        view = memoryview (buf)
+        pos = HEADER.size
+        sections = list ()
+        for size in (n_terms + 1, n_terms + 1):
+            raw = view[pos:pos + 4 * size]
+            if copy or sys.byteorder == 'big':
+                a = array ('I')
+                a.frombytes (raw)
+                if sys.byteorder == 'big':
+                    a.byteswap ()
+                sections.append (memoryview (a))
+            else:
+                sections.append (raw.cast ('I'))
+            pos += 4 * size
+
+        vocab = view[pos:pos + vocab_size]
+        blob = view[pos + vocab_size:pos + vocab_size + blob_size]
+        if copy:
+            vocab = bytes (vocab)
+            blob = bytes (blob)
+
+        return cls (vocab, *sections, blob, n_postings, max_comic,
+                terms = terms)
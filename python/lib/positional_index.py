@@ -0,0 +1,219 @@
+import sys
+import heapq
+import struct
+from array import array
+from bisect import bisect_left
+import varint as VARINT
+import atomic_file as ATOMIC
+
+# Where each word is in each comic, for phrase and proximity queries
+#
+# A position is the rank of a word in the tokens of the comic (title, alt
+# and transcript, see scraper/index.py), stop words included: "the cat in
+# the hat" has cat at 1 and hat at 4, so the phrase matches whatever the
+# stop words in between are.
+#
+# Same idea as the compiled index, plus the positions of every posting,
+# delta and varint encoded in one blob (see varint):
+#   vocab_offsets: uint32[n_terms + 1]    -> slices of the utf-8 vocabulary
+#   offsets      : uint32[n_terms + 1]    -> slices of docs for each term
+#   docs         : uint32[n_postings]     -> comic numbers, sorted per term
+#   pos_offsets  : uint32[n_postings + 1] -> slices of the positions blob
+#
+# File layout (little endian), written by scraper/index.py --positions:
+#   header | vocab_offsets | offsets | docs | pos_offsets | vocab | positions
+
+MAGIC = b'XKCDPOS\x00'
+VERSION = 1
+HEADER = struct.Struct ('<8sIIIII')
+
+#==============================================================================#
+
+class PositionalIndex:
+    def __init__ (self, vocab, vocab_offsets, offsets, docs, pos_offsets,
+            positions):
+        self._vocab = vocab
+        self._vocab_offsets = vocab_offsets
+        self._offsets = offsets
+        self._docs = docs
+        self._pos_offsets = pos_offsets
+        self._positions = positions
+
+        self._terms = {sys.intern (self._word (i)): i
+                for i in range (len (offsets) - 1)}
+
+    def _word (self, term_id):
+        start = self._vocab_offsets[term_id]
+        end = self._vocab_offsets[term_id + 1]
+        return bytes (self._vocab[start:end]).decode ('utf-8')
+
+    def __len__ (self):
+        return len (self._terms)
+
+    def __contains__ (self, word):
+        return word in self._terms
+
+    def term_id (self, word):
+        return self._terms.get (word, -1)
+
+    # Sorted comic numbers of a term
+    def docs (self, term_id):
+        return self._docs[self._offsets[term_id]:self._offsets[term_id + 1]]
+
+    # Index of the posting (term_id, doc) in docs/pos_offsets, -1 if none
+    def _posting (self, term_id, doc):
+        lo, hi = self._offsets[term_id], self._offsets[term_id + 1]
+        i = bisect_left (self._docs, doc, lo, hi)
+        if i < hi and self._docs[i] == doc:
+            return i
+        return -1
+
+    # Sorted positions of a word in a comic, [] if it isn't there
+    def positions (self, word, doc):
+        term_id = self.term_id (word)
+        if term_id < 0:
+            return list ()
+        i = self._posting (term_id, doc)
+        if i < 0:
+            return list ()
+        return VARINT.decode_deltas (
+                self._positions, self._pos_offsets[i], self._pos_offsets[i + 1])
+
+    # Comics holding all the words, sorted
+    # The intersection starts from the word in the fewest comics, and
+    # every other word only has to be searched for the comics left
+    def intersect (self, words):
+        term_ids = [self.term_id (w) for w in set (words)]
+        if not term_ids or min (term_ids) < 0:
+            return list ()
+        term_ids.sort (key = lambda t: self._offsets[t + 1] - self._offsets[t])
+
+        docs = list (self.docs (term_ids[0]))
+        for t in term_ids[1:]:
+            other = self.docs (t)
+            kept = list ()
+            lo = 0
+            for doc in docs:
+                # docs is sorted, the search goes on from the last match
+                lo = bisect_left (other, doc, lo)
+                if lo == len (other):
+                    break
+                if other[lo] == doc:
+                    kept.append (doc)
+            docs = kept
+            if not docs:
+                break
+        return docs
+
+    # Comics in which the words appear as a phrase
+    # phrase: [(offset, word)], offset of the word in the phrase (stop
+    # words counted, see phrase_terms in client_helpers)
+    def phrase (self, phrase):
+        if not phrase:
+            return list ()
+        found = list ()
+        for doc in self.intersect ([w for offset, w in phrase]):
+            # Where the phrase would start, according to each word
+            starts = None
+            for offset, w in phrase:
+                s = {p - offset for p in self.positions (w, doc)}
+                starts = s if starts is None else starts & s
+                if not starts:
+                    break
+            if starts:
+                found.append (doc)
+        return found
+
+    # Smallest number of positions covering one occurrence of each of the
+    # words found in doc (0 if there is only one of them)
+    # The lists are walked together, always moving the one furthest behind
+    def span (self, words, doc):
+        lists = [p for p in (self.positions (w, doc) for w in set (words)) if p]
+        if len (lists) < 2:
+            return 0
+
+        heap = [(p[0], i, 0) for i, p in enumerate (lists)]
+        heapq.heapify (heap)
+        right = max (p[0] for p in lists)
+        best = right - heap[0][0]
+        while True:
+            left, i, j = heapq.heappop (heap)
+            best = min (best, right - left)
+            if j + 1 == len (lists[i]):
+                return best
+            nxt = lists[i][j + 1]
+            right = max (right, nxt)
+            heapq.heappush (heap, (nxt, i, j + 1))
+
+    # Build from (comic number, [tokens]) pairs
+    # The words in stop are counted in the positions but not stored
+    @classmethod
+    def build (cls, comics, stop = ()):
+        # word -> {comic: [positions]}
+        table = dict ()
+        for num, tokens in comics:
+            for position, word in enumerate (tokens):
+                if word in stop:
+                    continue
+                table.setdefault (word, dict ()).setdefault (
+                        int (num), list ()).append (position)
+
+        vocab = bytearray ()
+        vocab_offsets = array ('I', [0])
+        offsets = array ('I', [0])
+        docs = array ('I')
+        pos_offsets = array ('I', [0])
+        positions = bytearray ()
+        for word in sorted (table):
+            vocab += word.encode ('utf-8')
+            vocab_offsets.append (len (vocab))
+            for num in sorted (table[word]):
+                docs.append (num)
+                VARINT.encode_deltas (table[word][num], positions)
+                pos_offsets.append (len (positions))
+            offsets.append (len (docs))
+
+        return cls (bytes (vocab), vocab_offsets, offsets, docs, pos_offsets,
+                bytes (positions))
+
+    def save (self, f):
+        with ATOMIC.replacing (f, 'wb') as outfile:
+            outfile.write (HEADER.pack (
+                    MAGIC,
+                    VERSION,
+                    len (self._offsets) - 1,
+                    len (self._docs),
+                    len (self._vocab),
+                    len (self._positions)))
+            for buf in (self._vocab_offsets, self._offsets, self._docs,
+                    self._pos_offsets):
+                a = array ('I', buf)
+                if sys.byteorder == 'big':
+                    a.byteswap ()
+                a.tofile (outfile)
+            outfile.write (self._vocab)
+            outfile.write (self._positions)
+
+    @classmethod
+    def load (cls, f):
+        with open (f, 'rb') as infile:
+            buf = infile.read ()
+
+        magic, version, n_terms, n_postings, vocab_size, blob_size = \
+                HEADER.unpack_from (buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError ('Not an xkcd positional index (or wrong version).')
+
+        sections = list ()
+        pos = HEADER.size
+        for size in (n_terms + 1, n_terms + 1, n_postings, n_postings + 1):
+            a = array ('I')
+            a.frombytes (buf[pos:pos + 4 * size])
+            if sys.byteorder == 'big':
+                a.byteswap ()
+            sections.append (a)
+            pos += 4 * size
+
+        vocab = buf[pos:pos + vocab_size]
+        positions = buf[pos + vocab_size:pos + vocab_size + blob_size]
+        return cls (vocab, *sections, positions)
@@ -0,0 +1,115 @@
+import math
+import heapq
+from bisect import bisect_left
+from compiled_index import CompiledIndex
+
+MODELS = ('bm25', 'tfidf')
+
+# Ranked retrieval over the index: top k comics for a query, best first
+#
+# Raw counts favour long transcripts, so instead of the (score, weight) of
+# search the comics are scored with BM25 or TF-IDF. Each word's postings are
+# also kept ordered by impact (the score it gives to a comic), biggest first.
+# The top k is then found with the threshold algorithm:
+#   - read the impact ordered lists in parallel, one posting at a time
+#   - score every new comic completely (binary search in the other postings)
+#     and keep the k best in a heap
+#   - stop when the k-th best score beats the sum of the impacts at the
+#     current position of every list, no unread comic can do better (an
+#     unread comic tied with it could still win on its number)
+# Broad queries stop after a few postings, the full set of matching comics is
+# never built.
+class Ranker:
+    # index is the json index or a CompiledIndex
+    # model is one of MODELS, k1 and b are the usual BM25 parameters
+    def __init__ (self, index, model = 'bm25', k1 = 1.2, b = 0.75):
+        if model not in MODELS:
+            raise ValueError (f"Unknown ranking model {model}.")
+        if not isinstance (index, CompiledIndex):
+            index = CompiledIndex.from_dict (index)
+
+        self.index = index
+        self.model = model
+        self.k1 = k1
+        self.b = b
+
+        # Length of each comic: number of indexed words it contains
+        # Kept by the index, a snapshot has them already
+        self.lengths = index.lengths
+        self.comic_count = sum (1 for l in self.lengths if l)
+        self.avg_length = sum (self.lengths) / max (self.comic_count, 1)
+
+        # term id -> impact ordered list of (impact, comic), built on demand
+        self._impacts = dict ()
+
+    def _idf (self, df):
+        n = self.comic_count
+        if self.model == 'bm25':
+            return math.log (1 + (n - df + 0.5) / (df + 0.5))
+        return math.log (n / df)
+
+    def _impact (self, tf, doc, idf):
+        if self.model == 'bm25':
+            norm = 1 - self.b + self.b * self.lengths[doc] / self.avg_length
+            return idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return idf * (1 + math.log (tf))
+
+    def impacts (self, term_id):
+        if term_id not in self._impacts:
+            postings = self.index.postings_of (term_id)
+            idf = self._idf (len (postings))
+            self._impacts[term_id] = sorted (
+                    ((self._impact (tf, doc, idf), doc)
+                        for doc, tf in postings.items ()),
+                    key = lambda x: (-x[0], x[1]))
+        return self._impacts[term_id]
+
+    # Impact of term_id for doc, 0 if doc doesn't contain the word
+    def _random_access (self, term_id, doc):
+        postings = self.index.postings_of (term_id)
+        i = bisect_left (postings.docs, doc)
+        if i < len (postings.docs) and postings.docs[i] == doc:
+            return self._impact (
+                    postings.tfs[i], doc, self._idf (len (postings)))
+        return 0.0
+
+    # Up to k (score, comic number) pairs for the words in terms, best first
+    # allowed: if not None, only the comics in it are ranked
+    def top (self, terms, k = 10, allowed = None):
+        term_ids = [self.index.term_id (t) for t in set (terms)]
+        term_ids = [t for t in term_ids if t >= 0]
+        lists = [self.impacts (t) for t in term_ids]
+        if not lists or k <= 0:
+            return list ()
+
+        heap = list () # (score, -comic), the worst of the k best on top
+        seen = set ()
+        depth = 0
+        while True:
+            threshold = 0.0
+            exhausted = True
+            for t, impacts in zip (term_ids, lists):
+                if depth >= len (impacts):
+                    continue
+                exhausted = False
+                impact, doc = impacts[depth]
+                threshold += impact
+                if doc in seen:
+                    continue
+                seen.add (doc)
+                if allowed is not None and doc not in allowed:
+                    continue
+
+                score = sum (
+                        impact if u == t else self._random_access (u, doc)
+                        for u in term_ids)
+                if len (heap) < k:
+                    heapq.heappush (heap, (score, -doc))
+                elif (score, -doc) > heap[0]:
+                    heapq.heapreplace (heap, (score, -doc))
+
+            depth += 1
+            if exhausted or (len (heap) == k and heap[0][0] > threshold):
+                break
+
+        return [(score, -doc) for score, doc in sorted (heap, reverse = True)]
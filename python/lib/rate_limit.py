@@ -0,0 +1,105 @@
+import time
+from collections import OrderedDict
+
+# Token buckets, one per key (a user, a server...)
+#
+# A bucket holds up to burst tokens and gets rate tokens back per second.
+# Each command takes one, a key with an empty bucket has to wait.
+# A bucket is three numbers, only kept for the keys seen recently: once a
+# bucket had the time to fill up again it's the same as a new one, so it is
+# dropped. The buckets are kept in the order they were last used, the
+# idle ones are always at the front.
+class TokenBuckets:
+    def __init__ (self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        # Time for an empty bucket to be full again
+        self.idle = burst / rate
+        # key -> [tokens, last update, told]
+        self._buckets = OrderedDict ()
+
+    def __len__ (self):
+        return len (self._buckets)
+
+    def _bucket (self, key, now):
+        # Forget the buckets which are full again
+        while self._buckets:
+            oldest = next (iter (self._buckets.values ()))
+            if now - oldest[1] < self.idle:
+                break
+            self._buckets.popitem (last = False)
+
+        bucket = self._buckets.get (key)
+        if bucket is None:
+            bucket = [self.burst, now, False]
+            self._buckets[key] = bucket
+        else:
+            bucket[0] = min (self.burst,
+                    bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self._buckets.move_to_end (key)
+        return bucket
+
+    # True if key has a token, without taking it
+    def peek (self, key, now = None):
+        now = time.monotonic () if now is None else now
+        return self._bucket (key, now)[0] >= 1
+
+    # Take a token for key, False if there is none
+    def take (self, key, now = None):
+        now = time.monotonic () if now is None else now
+        bucket = self._bucket (key, now)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        bucket[2] = False
+        return True
+
+    # True the first time it's asked for key since its last token was
+    # taken: to tell a user once that they are limited, not at every message
+    def tell (self, key):
+        bucket = self._buckets.get (key)
+        if bucket is None or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
+
+# Limits of the bot, from the "rate_limits" entry of the config:
+#   {"user"    : {"rate": 0.5, "burst": 5},
+#    "guild"   : {"rate": 5, "burst": 30},
+#    "commands": {"search": {"rate": 0.2, "burst": 3}, ...}}
+# rate is in commands per second. The commands are named by their function
+# (see xkcd.command.json), so aliases share a limit, and are limited per
+# user. Any entry can be left out.
+class RateLimits:
+    def __init__ (self, config):
+        def buckets (c):
+            return TokenBuckets (c['rate'], c['burst']) if c else None
+        self.user = buckets (config.get ('user'))
+        self.guild = buckets (config.get ('guild'))
+        self.commands = {name: buckets (c)
+                for name, c in config.get ('commands', dict ()).items ()}
+
+    # The (buckets, key) a command of user in guild takes a token from
+    def _keys (self, user, guild, command):
+        keys = list ()
+        if self.user is not None:
+            keys.append ((self.user, user))
+        if self.guild is not None:
+            keys.append ((self.guild, guild))
+        if command in self.commands:
+            keys.append ((self.commands[command], user))
+        return keys
+
+    # Let a command through, taking its tokens, or not, taking nothing
+    # Returns None if it went through, otherwise the buckets and key which
+    # stopped it
+    def check (self, user, guild, command):
+        now = time.monotonic ()
+        keys = self._keys (user, guild, command)
+        for buckets, key in keys:
+            if not buckets.peek (key, now):
+                return buckets, key
+        for buckets, key in keys:
+            buckets.take (key, now)
+        return None
@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import atomic_file as ATOMIC
+
+# Line delimited version of xkcd.references.json (xkcd.references.jsonl)
+#
+# One comic per line: {"num": 327, "ref": {...}}
+#   - the scraper appends a comic as soon as it's fetched (append), a crash
+#     loses at most the line being written: the readers skip it, and
+#     open_append cuts it before anything is added after it
+#   - readers go through the file one comic at a time (iter_refs), nothing
+#     has to hold every reference at once
+#   - a comic fetched again is appended again, the last line wins.
+#     compact rewrites the file with one line per comic, in order, next to
+#     it then renamed: the file is always whole. Until then, the readers
+#     building something from every comic go through iter_last
+
+# The line delimited file standing for the json references f
+def path (f):
+    return os.path.splitext (f)[0] + '.jsonl'
+
+# Generator over the (comic number, ref) of the file, in file order
+# The numbers are strings, like the keys of the json references
+# start: offset of the first line to read
+def iter_refs (f, start = 0):
+    with open (f, 'rb') as infile:
+        infile.seek (start)
+        for line in infile:
+            entry = _entry (line)
+            if entry is not None:
+                yield str (entry['num']), entry['ref']
+
+# Generator over the (comic number, ref) of the last line of each comic, by
+# comic number: the file as compact would write it, without writing it
+# Only the place of each line is kept in memory, the lines are read again
+# first, last: only the comics first to last (both included), the others
+# aren't parsed (a worker of index.py --jobs reads its range this way)
+def iter_last (f, first = None, last = None):
+    with open (f, 'rb') as infile:
+        lines = _last_lines (infile, first, last)
+        for num in sorted (lines):
+            start, length = lines[num]
+            infile.seek (start)
+            entry = _entry (infile.read (length))
+            if entry is not None:
+                yield str (num), entry['ref']
+
+# {num: (offset, length)} of the last line of each comic of infile, from
+# first to last if given
+def _last_lines (infile, first = None, last = None):
+    lines = dict ()
+    offset = 0
+    for line in infile:
+        num = _num (line)
+        if num is not None \
+                and (first is None or num >= first) \
+                and (last is None or num <= last):
+            lines[num] = (offset, len (line))
+        offset += len (line)
+    return lines
+
+# The start of a line as append and write put it
+_NUM = re.compile (rb'\{"num": (\d+), ')
+
+# Comic number of a line, None if it isn't one (cut by a crash)
+# A line with its newline was written whole (a cut one is removed before
+# anything is appended, see open_append): its number is read from its start
+# instead of parsing all of it. Any other line is parsed.
+def _num (line):
+    if line.endswith (b'\n'):
+        match = _NUM.match (line)
+        if match is not None:
+            return int (match.group (1))
+    entry = _entry (line)
+    return None if entry is None else int (entry['num'])
+
+def _entry (line):
+    try:
+        entry = json.loads (line)
+    except ValueError: # Line cut by a crash
+        return None
+    if not isinstance (entry, dict) or not 'num' in entry:
+        return None
+    return entry
+
+# Comic numbers of the file (strings), without keeping their references
+def nums (f, start = 0):
+    try:
+        with open (f, 'rb') as infile:
+            infile.seek (start)
+            return {str (num) for num in map (_num, infile) if num is not None}
+    except FileNotFoundError:
+        return set ()
+
+# Every reference of the file, {'num': ref}, for the ones needing them all
+# at hand (the bot)
+def load (f):
+    return dict (iter_refs (f))
+
+# Open the file to append comics to it
+# A last line cut by a crash is removed first, it would glue itself to the
+# next line otherwise
+def open_append (f):
+    try:
+        with open (f, 'rb+') as infile:
+            end = infile.seek (0, os.SEEK_END)
+            keep = end
+            while keep > 0:
+                step = min (4096, keep)
+                infile.seek (keep - step)
+                chunk = infile.read (step)
+                newline = chunk.rfind (b'\n')
+                if newline >= 0:
+                    keep = keep - step + newline + 1
+                    break
+                keep -= step
+            if keep != end:
+                infile.truncate (keep)
+    except FileNotFoundError:
+        pass
+    return open (f, 'a')
+
+# Append one comic to a file opened by open_append, on disk when it returns
+def append (outfile, num, ref):
+    outfile.write (json.dumps ({'num': int (num), 'ref': ref}) + '\n')
+    outfile.flush ()
+    os.fsync (outfile.fileno ())
+
+# Write (comic number, ref) pairs as a new file, next to it then renamed
+def write (f, items):
+    with ATOMIC.replacing (f) as outfile:
+        for num, ref in items:
+            outfile.write (json.dumps ({'num': int (num), 'ref': ref}) + '\n')
+
+# Rewrite the file with the last line of each comic, by comic number
+# Only the place of each line is kept in memory, the lines are copied
+def compact (f):
+    with open (f, 'rb') as infile:
+        lines = _last_lines (infile)
+        with ATOMIC.replacing (f, 'wb') as outfile:
+            for num in sorted (lines):
+                start, length = lines[num]
+                infile.seek (start)
+                line = infile.read (length)
+                outfile.write (line if line.endswith (b'\n') else line + b'\n')
@@ -0,0 +1,130 @@
+import sys
+import mmap
+import json
+import struct
+from array import array
+from bisect import bisect_left
+from collections.abc import Mapping
+import atomic_file as ATOMIC
+
+# Binary, memory mapped version of the references (xkcd.references.jsonl)
+#
+# Each reference ({'comic': ..., 'stat_com': ..., 'stat_tr': ...}) is stored
+# as compact json, one after the other. Two uint32 arrays find them back:
+#   nums   : uint32[count]     -> sorted comic numbers
+#   offsets: uint32[count + 1] -> slices of the records blob
+#
+# File layout (little endian):
+#   header | nums | offsets | records blob
+#
+# The file is mapped read only: every bot process shares the same pages
+# through the OS page cache and a record is only decoded when it's asked for.
+# Comics published after the store was built can be added in memory (add).
+
+MAGIC = b'XKCDREF\x00'
+VERSION = 1
+HEADER = struct.Struct ('<8sII')
+
+#==============================================================================#
+
+# Read only mapping with the same interface as the json references:
+# string comic numbers as keys, reference dicts as values
+class RefStore (Mapping):
+    def __init__ (self, buf):
+        magic, version, count = HEADER.unpack_from (buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError ('Not an xkcd references store (or wrong version).')
+
+        view = memoryview (buf)
+        pos = HEADER.size
+        self._nums = self._uint32 (view[pos:pos + 4 * count])
+        pos += 4 * count
+        self._offsets = self._uint32 (view[pos:pos + 4 * (count + 1)])
+        pos += 4 * (count + 1)
+        self._records = view[pos:]
+
+        # Comics added after the store was built, {'num': ref}
+        self._extra = dict ()
+
+    @staticmethod
+    def _uint32 (raw):
+        if sys.byteorder == 'big':
+            a = array ('I')
+            a.frombytes (raw)
+            a.byteswap ()
+            return memoryview (a)
+        return raw.cast ('I')
+
+    # Position of a comic in the store, -1 if it isn't there
+    def _find (self, key):
+        try:
+            num = int (key)
+        except (TypeError, ValueError):
+            return -1
+        i = bisect_left (self._nums, num)
+        if i < len (self._nums) and self._nums[i] == num:
+            return i
+        return -1
+
+    def __len__ (self):
+        return len (self._nums) + len (self._extra)
+
+    def __iter__ (self):
+        for num in self._nums:
+            yield str (num)
+        yield from self._extra
+
+    def __contains__ (self, key):
+        return str (key) in self._extra or self._find (key) >= 0
+
+    def __getitem__ (self, key):
+        if str (key) in self._extra:
+            return self._extra[str (key)]
+        i = self._find (key)
+        if i < 0:
+            raise KeyError (key)
+        raw = self._records[self._offsets[i]:self._offsets[i + 1]]
+        return json.loads (bytes (raw).decode ('utf-8'))
+
+    # Sorted comic numbers of the file, as ints
+    @property
+    def nums (self):
+        return self._nums
+
+    # Add a comic which isn't in the file, kept in memory only
+    def add (self, key, ref):
+        if self._find (key) < 0:
+            self._extra[str (key)] = ref
+
+    @classmethod
+    def open (cls, f):
+        with open (f, 'rb') as infile:
+            buf = mmap.mmap (infile.fileno (), 0, access = mmap.ACCESS_READ)
+        return cls (buf)
+
+    # Write a store from the (comic number, ref) pairs of items, in any order
+    # (refs_jsonl.iter_refs, or the items of the json references)
+    # Only the encoded records are kept until they are written
+    @staticmethod
+    def build (items, f):
+        encoded = dict ()
+        for num, ref in items:
+            encoded[int (num)] = json.dumps (
+                    ref,
+                    separators = (',', ':'),
+                    ensure_ascii = False).encode ('utf-8')
+
+        nums = array ('I', sorted (encoded))
+        offsets = array ('I', [0])
+        records = bytearray ()
+        for num in nums:
+            records += encoded[num]
+            offsets.append (len (records))
+
+        with ATOMIC.replacing (f, 'wb') as outfile:
+            outfile.write (HEADER.pack (MAGIC, VERSION, len (nums)))
+            for a in (nums, offsets):
+                if sys.byteorder == 'big':
+                    a.byteswap ()
+                a.tofile (outfile)
+            outfile.write (records)
@@ -0,0 +1,103 @@
+from compiled_index import CompiledIndex
+
+# NumPy is optional: without it the scorer falls back to a single pass in
+# pure python, still cheaper than combine + the three passes of candidates
+try:
+    import numpy as NP
+except ImportError:
+    NP = None
+
+# Score queries against the index with the same ranking as candidates:
+#   score : number of words of the query found in the comic
+#   weight: sum of the counts of those words in the comic
+# The best comics have the greatest score, then the greatest weight.
+#
+# With NumPy the postings of every word of a query are concatenated and
+# counted in one go (bincount) over dense arrays indexed by comic number,
+# instead of building a {'weight', 'score'} dict for every candidate.
+class Scorer:
+    # index is the json index or a CompiledIndex
+    def __init__ (self, index):
+        if not isinstance (index, CompiledIndex):
+            index = CompiledIndex.from_dict (index)
+        self.index = index
+        self.size = index.max_comic + 1
+
+    # docs and tfs of a word, None if the word isn't indexed
+    def _postings (self, word):
+        postings = self.index.get (word)
+        if postings is None or len (postings) == 0:
+            return None
+        if NP is None:
+            return postings.docs, postings.tfs
+        # Views on the index buffers, nothing is copied
+        return (NP.frombuffer (postings.docs, dtype = NP.uint32),
+                NP.frombuffer (postings.tfs, dtype = NP.uint32))
+
+    # Comic numbers tied on the best (score, weight) for terms
+    # terms must not hold duplicates, the query path already removes them
+    def best (self, terms):
+        return self.best_many ([terms])[0]
+
+    # Same as best for a batch of queries, scored all at once
+    # Returns one list of comic numbers per query (empty: nothing found)
+    def best_many (self, queries):
+        postings = dict ()
+        for terms in queries:
+            for t in terms:
+                if t not in postings:
+                    postings[t] = self._postings (t)
+
+        if NP is None:
+            return [self._best_python (terms, postings) for terms in queries]
+        return self._best_numpy (queries, postings)
+
+    def _best_python (self, terms, postings):
+        matched = dict ()
+        for t in terms:
+            p = postings[t]
+            if p is None:
+                continue
+            for doc, tf in zip (*p):
+                s, w = matched.get (doc, (0, 0))
+                matched[doc] = (s + 1, w + tf)
+
+        best = list ()
+        top = (0, 0)
+        for doc, key in matched.items ():
+            if key > top:
+                top = key
+                best = [doc]
+            elif key == top:
+                best.append (doc)
+        return best
+
+    def _best_numpy (self, queries, postings):
+        # One row of size comics per query, flattened so a single bincount
+        # scores the whole batch
+        docs, tfs = list (), list ()
+        for row, terms in enumerate (queries):
+            for t in terms:
+                p = postings[t]
+                if p is not None:
+                    docs.append (p[0].astype (NP.int64) + row * self.size)
+                    tfs.append (p[1])
+
+        if not docs:
+            return [list () for terms in queries]
+
+        docs = NP.concatenate (docs)
+        tfs = NP.concatenate (tfs)
+        length = len (queries) * self.size
+        score = NP.bincount (docs, minlength = length)
+        weight = NP.bincount (docs, weights = tfs, minlength = length)
+
+        # (score, weight) ordered as a single key, weight < total + 1
+        key = score * (int (tfs.sum ()) + 1) + weight.astype (NP.int64)
+        key = key.reshape (len (queries), self.size)
+        top = key.max (axis = 1)
+
+        return [
+                NP.flatnonzero (key[row] == top[row]).tolist ()
+                if top[row] > 0 else list ()
+                for row in range (len (queries))]
@@ -0,0 +1,40 @@
+from scoring import Scorer
+from ranking import Ranker
+from embed_cache import EmbedCache
+from cache import LRU
+from vocab_trie import VocabTrie
+
+# Queries whose results are kept, see client_helpers.search
+QUERY_CACHE_SIZE = 4096
+
+# Everything a search reads: the index, the references and what is built on
+# them. CommandManager only ever replaces it as a whole (one assignment), so
+# a search which took a SearchData keeps a consistent view until it's done,
+# even if a reload swaps in a new one in the meantime.
+# The query cache belongs to it too: new data, empty cache.
+#   ranking   : the "ranking" entry of the config, None for no ranked search
+#   cache_size: number of queries cached, 0 for no cache
+#   fuzzy     : True to look for close words when a search finds nothing
+#   vocab     : the trie the scraper wrote for this index, if fuzzy. Built
+#               from the index when there is none
+#   positions : positional index for phrases and proximity, None for none
+class SearchData:
+    __slots__ = ('index', 'refs', 'scorer', 'ranker', 'embeds', 'queries',
+            'vocab', 'positions')
+
+    def __init__ (self, index, refs, ranking = None,
+            cache_size = QUERY_CACHE_SIZE, fuzzy = False, vocab = None,
+            positions = None):
+        self.index = index
+        self.refs = refs
+        self.positions = positions
+        self.vocab = None
+        if fuzzy:
+            self.vocab = vocab if vocab is not None else VocabTrie.build (index)
+        self.queries = LRU (cache_size) if cache_size else None
+        self.embeds = EmbedCache (refs)
+        self.scorer = Scorer (index)
+        self.ranker = None
+        if ranking:
+            # The scorer has the index in its compiled form, reuse it
+            self.ranker = Ranker (self.scorer.index, ranking['model'])
@@ -0,0 +1,115 @@
+import os
+import gc
+import time
+import signal
+import logging
+
+# Runs the gateway shards of the bot, one process each, and keeps them alive
+#
+# The processes are forked from the one which loaded the data: the index
+# and the comics are read once and shared by every shard (the pages are only
+# copied by the OS if a shard writes to them). Each shard then has its own
+# discord client, event loop and CommandManager.
+# A shard which dies (crash, exception, killed) is started again after
+# delay seconds, doubled each time it dies again without having run for
+# stable seconds, up to max_delay. A shard exiting with status 0 stopped on
+# purpose and isn't restarted. SIGTERM or SIGINT stop every shard, then the
+# supervisor.
+#   run  : function running a shard until it stops, called with
+#          (shard_id, shard_count) in the forked process
+#   count: number of shards
+class Supervisor:
+    def __init__ (self, run, count, delay = 5, max_delay = 300,
+            stable = 600):
+        self.run = run
+        self.count = count
+        self.delay = delay
+        self.max_delay = max_delay
+        self.stable = stable
+        self._pids = dict ()     # pid -> shard id
+        self._started = dict ()  # shard id -> start time
+        self._delays = dict ()   # shard id -> delay before the next restart
+        self._restarts = dict () # shard id -> time to start it again
+        self._stopping = False
+
+    def _spawn (self, shard):
+        pid = os.fork ()
+        if pid == 0:
+            # The shard: default signals, and never back in the supervisor
+            signal.signal (signal.SIGTERM, signal.SIG_DFL)
+            signal.signal (signal.SIGINT, signal.SIG_DFL)
+            code = 1
+            try:
+                self.run (shard, self.count)
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance (e.code, int) else 1
+            except BaseException:
+                logging.exception ('Shard {} failed'.format (shard))
+            finally:
+                logging.shutdown ()
+                os._exit (code)
+
+        logging.info ('Shard {} started (pid {})'.format (shard, pid))
+        self._pids[pid] = shard
+        self._started[shard] = time.monotonic ()
+
+    def _stop (self, signum, frame):
+        self._stopping = True
+        for pid in self._pids:
+            try:
+                os.kill (pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # A shard exited with status, start it again later if it has to
+    def _exited (self, shard, status):
+        if os.WIFSIGNALED (status):
+            how = 'killed by signal {}'.format (os.WTERMSIG (status))
+        else:
+            code = os.WEXITSTATUS (status)
+            if code == 0:
+                logging.info ('Shard {} stopped'.format (shard))
+                return
+            how = 'exited with status {}'.format (code)
+
+        now = time.monotonic ()
+        delay = self._delays.get (shard, self.delay)
+        if now - self._started[shard] >= self.stable:
+            delay = self.delay
+        logging.warning ('Shard {} {}, restarting in {} s'.format (
+            shard, how, delay))
+        self._restarts[shard] = now + delay
+        self._delays[shard] = min (delay * 2, self.max_delay)
+
+    # Start the shards and watch them until they are all stopped
+    def start (self):
+        signal.signal (signal.SIGTERM, self._stop)
+        signal.signal (signal.SIGINT, self._stop)
+        # What is loaded so far is never freed: out of the way of the
+        # collector, which would touch (and copy) the shared pages
+        if hasattr (gc, 'freeze'):
+            gc.freeze ()
+
+        for shard in range (self.count):
+            self._spawn (shard)
+
+        while self._pids or (self._restarts and not self._stopping):
+            try:
+                pid, status = os.waitpid (-1, os.WNOHANG) if self._pids \
+                        else (0, 0)
+            except ChildProcessError:
+                pid, status = 0, 0
+            if pid:
+                shard = self._pids.pop (pid)
+                if not self._stopping:
+                    self._exited (shard, status)
+                continue
+
+            now = time.monotonic ()
+            for shard, due in list (self._restarts.items ()):
+                if now >= due and not self._stopping:
+                    del self._restarts[shard]
+                    self._spawn (shard)
+            time.sleep (0.5)
+        logging.info ('Every shard stopped')
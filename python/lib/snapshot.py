@@ -0,0 +1,71 @@
+import os
+import pickle
+import logging
+import atomic_file as ATOMIC
+from comics import ComicTable
+
+# Everything the bot loads at startup, already parsed, in one file
+# (xkcd.snapshot, written by scraper/index.py)
+#
+# Starting from the json files means parsing megabytes of json and building
+# the compiled index, its term ids and the lengths of the comics every time.
+# The snapshot is one pickle (protocol 5) of:
+#   index     : the index as the bot uses it (compiled or packed, delta
+#               merged), with what is built from it (see CompiledIndex)
+#   comics    : what the bot shows of each comic (comics.ComicTable)
+#   black_list: the stop words
+# The whole references aren't in it, the bot only shows the comics.
+#
+# Only load snapshots written by the scraper: unpickling runs code.
+
+VERSION = 2
+PROTOCOL = 5
+
+# Write the snapshot f
+# refs: (comic number, ref) pairs, in any order
+def write (f, index, refs, black_list):
+    comics = ComicTable.from_items (refs)
+
+    if not isinstance (index, dict):
+        # Built now rather than by every bot loading it
+        index.lengths
+    snapshot = {
+            'version': VERSION,
+            'index': index,
+            'comics': comics,
+            'black_list': frozenset (black_list)}
+    with ATOMIC.replacing (f, 'wb') as outfile:
+        pickle.dump (snapshot, outfile, protocol = PROTOCOL)
+
+# Load the snapshot f: {'index', 'refs', 'black_list'}, refs being the
+# ComicTable
+# None if there is none, or if it's older than one of the files of sources
+# (the files it was made from, changed since)
+def load (f, sources = ()):
+    try:
+        mtime = os.stat (f).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    for source in sources:
+        try:
+            if os.stat (source).st_mtime_ns > mtime:
+                logging.info ('{} is newer than {}, not used'.format (
+                    source, f))
+                return None
+        except FileNotFoundError:
+            pass
+
+    try:
+        with open (f, 'rb') as infile:
+            snapshot = pickle.load (infile)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ValueError,
+            TypeError) as e:
+        logging.warning ('Unable to load {}: {}'.format (f, e))
+        return None
+    if snapshot.get ('version') != VERSION:
+        return None
+
+    return {
+            'index': snapshot['index'],
+            'refs': snapshot['comics'],
+            'black_list': snapshot['black_list']}
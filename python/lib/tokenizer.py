@@ -0,0 +1,95 @@
+import re
+import json
+
+# Split a text in lowercase words, the way the index and the queries see it
+#
+# The rules are the ones removePunk always had:
+#   - letters and digits are kept
+#   - a '-' is kept between two letters (inner hyphen: "e-mail"), except at
+#     position 1 of the text (the old check was index - 1 > 0)
+#   - everything else separates words
+#
+# Ascii text (nearly every comic) goes through a bytes translation table
+# which turns every separator into a space, then str.split. Only the words
+# holding a '-' need a second look.
+# Other text goes through a precompiled regex. Its classes are a little
+# wider than str.isalpha/isdigit for some characters (i.e. '½' is numeric
+# but neither alpha nor digit), so its non ascii words are checked again
+# character by character.
+
+_KEEP = set (b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-')
+ASCII_TABLE = bytes (b if b in _KEEP else ord (' ') for b in range (256))
+
+# '-' without a letter on both sides, in an ascii word
+BAD_HYPHEN = re.compile (r'(?<![a-z])-|-(?![a-z])')
+
+# [^\W_]   : letter, digit or other numeric character
+# [^\W\d_] : same without the decimal digits, the letters of the rule
+TOKEN = re.compile (r'[^\W_]+(?:(?<=[^\W\d_])-(?=[^\W\d_])[^\W_]+)*')
+
+def _ascii_tokens (text):
+    words = text.encode ('ascii').translate (ASCII_TABLE).lower () \
+            .decode ('ascii').split ()
+    if not '-' in text:
+        return words
+
+    result = list ()
+    for w in words:
+        if '-' in w:
+            result.extend (p for p in BAD_HYPHEN.split (w) if p)
+        else:
+            result.append (w)
+    return result
+
+# Exact rules for a word the regex found
+def _split_exact (word):
+    part = list ()
+    for i, char in enumerate (word):
+        if char.isalpha () or char.isdigit ():
+            part.append (char)
+            continue
+        # The regex only lets a '-' in with a character on each side
+        if char == '-' and word[i - 1].isalpha () and word[i + 1].isalpha ():
+            part.append (char)
+            continue
+        if part:
+            yield ''.join (part).lower ()
+            part = list ()
+    if part:
+        yield ''.join (part).lower ()
+
+# Generator over the words of text
+# Same words as the old removePunk (text).split (' '), without the empty ones
+def tokens (text):
+    if text[1:2] == '-':
+        text = text[0] + ' ' + text[2:]
+
+    if text.isascii ():
+        yield from _ascii_tokens (text)
+        return
+
+    for m in TOKEN.finditer (text):
+        word = m.group ()
+        if word.isascii ():
+            yield word.lower ()
+        else:
+            yield from _split_exact (word)
+
+#==============================================================================#
+
+# Stop words of the file f (xkcd.common.json), as a frozenset
+# A lookup hashes the word once instead of comparing it to every word of
+# the list. Each file is read once, the indexer and the bot get the same set
+_stop_words = dict ()
+def stop_words (f):
+    if f not in _stop_words:
+        with open (f) as infile:
+            _stop_words[f] = frozenset (json.load (infile))
+    return _stop_words[f]
+
+# Generator over the words of text which aren't in stop (a set)
+# What the index holds for a text, and what a query looks up
+def terms (text, stop):
+    for w in tokens (text):
+        if not w in stop:
+            yield w
@@ -0,0 +1,48 @@
+# Variable length unsigned integers (LEB128)
+#
+# 7 bits per byte, low bits first, the high bit is set on every byte of a
+# number but the last: 0..127 take one byte, up to 16383 two bytes...
+# Sorted lists are stored as the gaps between consecutive values (delta
+# encoding), which keeps most numbers in one byte.
+
+from itertools import accumulate
+
+# Append the bytes of n to out (a bytearray)
+def encode (n, out):
+    while n >= 0x80:
+        out.append ((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append (n)
+
+# Append the sorted values as deltas: the first one, then the gaps
+def encode_deltas (values, out):
+    prev = 0
+    for v in values:
+        encode (v - prev, out)
+        prev = v
+
+# Values encoded in buf[start:end], as a list
+# buf is anything sliceable into bytes: bytes, bytearray, memoryview, mmap
+# When every value fits in one byte (no high bit anywhere, the common case
+# for gaps and counts) the bytes are the values and no loop is needed
+def decode (buf, start, end):
+    raw = bytes (buf[start:end])
+    if raw.isascii ():
+        return list (raw)
+
+    values = list ()
+    n = 0
+    shift = 0
+    for b in raw:
+        if b & 0x80:
+            n |= (b & 0x7f) << shift
+            shift += 7
+        else:
+            values.append (n | (b << shift))
+            n = 0
+            shift = 0
+    return values
+
+# Values of the deltas encoded in buf[start:end], as a list
+def decode_deltas (buf, start, end):
+    return list (accumulate (decode (buf, start, end)))
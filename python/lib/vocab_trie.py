@@ -0,0 +1,179 @@
+import sys
+import struct
+from array import array
+from bisect import bisect_left
+import atomic_file as ATOMIC
+
+# Trie over the words of the index, for the searches which found nothing
+# with the exact words of the query:
+#   prefixed: words starting with a prefix ("compil" -> "compile", ...)
+#   fuzzy   : words at a bounded edit distance ("scinece" -> "science")
+#
+# The nodes are numbered in breadth first order, so the children of a node
+# are consecutive and the whole trie fits in three flat arrays:
+#   first : uint32[n_nodes + 1] -> children of node i: first[i]..first[i + 1]
+#   labels: uint32[n_nodes]     -> code point on the edge leading to the node
+#   final : uint8[n_nodes]      -> 1 if a word ends on the node
+# Node 0 is the root, its label means nothing. The children of a node are
+# sorted by label.
+#
+# File layout (little endian), written by scraper/index.py:
+#   header | first | labels | final
+
+MAGIC = b'XKCDTRI\x00'
+VERSION = 1
+HEADER = struct.Struct ('<8sII')
+
+#==============================================================================#
+
+class VocabTrie:
+    def __init__ (self, first, labels, final):
+        self._first = first
+        self._labels = labels
+        self._final = final
+
+    # Number of nodes
+    def __len__ (self):
+        return len (self._labels)
+
+    def __contains__ (self, word):
+        node = self._walk (word)
+        return node > 0 and self._final[node] == 1
+
+    # Child of node on the edge labelled char, -1 if there is none
+    def _child (self, node, char):
+        lo, hi = self._first[node], self._first[node + 1]
+        i = bisect_left (self._labels, ord (char), lo, hi)
+        if i < hi and self._labels[i] == ord (char):
+            return i
+        return -1
+
+    # Node reached by following word from the root, -1 if it leaves the trie
+    def _walk (self, word):
+        node = 0
+        for char in word:
+            node = self._child (node, char)
+            if node < 0:
+                return -1
+        return node
+
+    # Words starting with prefix, in order, at most limit of them
+    # prefix itself is one of them if it's a word
+    def prefixed (self, prefix, limit = 16):
+        node = self._walk (prefix)
+        if node < 0:
+            return list ()
+
+        first, labels, final = self._first, self._labels, self._final
+        words = list ()
+        # Depth first, children pushed in reverse to pop them in order
+        stack = [(node, prefix)]
+        while stack and len (words) < limit:
+            node, word = stack.pop ()
+            if final[node]:
+                words.append (word)
+            for child in range (first[node + 1] - 1, first[node] - 1, -1):
+                stack.append ((child, word + chr (labels[child])))
+        return words
+
+    # [(distance, word)] of the words at most max_edits insertions,
+    # deletions or substitutions away from word, closest first
+    #
+    # Levenshtein distance computed along the trie: a prefix shares its row
+    # of the distance table with every word below it, and a branch is left
+    # as soon as every cell of its row is over max_edits.
+    # Only the cells less than max_edits away from the diagonal can be
+    # max_edits or less, the others are left at max_edits + 1 (the band)
+    def fuzzy (self, word, max_edits):
+        first, labels, final = self._first, self._labels, self._final
+        n = len (word)
+        over = max_edits + 1
+        codes = [ord (char) for char in word]
+        found = list ()
+
+        stack = [(0, '', [min (j, over) for j in range (n + 1)])]
+        while stack:
+            node, prefix, row = stack.pop ()
+            depth = len (prefix) + 1
+            lo = max (1, depth - max_edits)
+            hi = min (n, depth + max_edits)
+            start = depth if depth < over else over
+            for child in range (first[node], first[node + 1]):
+                label = labels[child]
+                new = [over] * (n + 1)
+                new[0] = best = start
+                for j in range (lo, hi + 1):
+                    v = row[j - 1] if codes[j - 1] == label else row[j - 1] + 1
+                    if row[j] + 1 < v:
+                        v = row[j] + 1
+                    if new[j - 1] + 1 < v:
+                        v = new[j - 1] + 1
+                    if v < best:
+                        best = v
+                    new[j] = v if v < over else over
+                if best > max_edits:
+                    continue
+                if final[child] and new[n] <= max_edits:
+                    found.append ((new[n], prefix + chr (label)))
+                stack.append ((child, prefix + chr (label), new))
+
+        found.sort ()
+        return found
+
+    # Build from an iterable of words (the keys of the index)
+    @classmethod
+    def build (cls, words):
+        # Nested {char: node} dicts first, '' marks the end of a word
+        root = dict ()
+        for word in words:
+            node = root
+            for char in word:
+                node = node.setdefault (char, dict ())
+            node[''] = True
+
+        first = array ('I', [1])
+        labels = array ('I', [0])
+        final = array ('B', [0])
+        # Breadth first: nodes are visited in the order they are numbered,
+        # each one numbers its children right after the ones already there
+        level = [root]
+        while level:
+            below = list ()
+            for node in level:
+                for char in sorted (c for c in node if c):
+                    labels.append (ord (char))
+                    final.append (1 if '' in node[char] else 0)
+                    below.append (node[char])
+                first.append (len (labels))
+            level = below
+        return cls (first, labels, final)
+
+    def save (self, f):
+        with ATOMIC.replacing (f, 'wb') as outfile:
+            outfile.write (HEADER.pack (MAGIC, VERSION, len (self)))
+            for a in (self._first, self._labels, self._final):
+                a = array (a.typecode, a)
+                if sys.byteorder == 'big':
+                    a.byteswap ()
+                a.tofile (outfile)
+
+    @classmethod
+    def load (cls, f):
+        with open (f, 'rb') as infile:
+            buf = infile.read ()
+
+        magic, version, n_nodes = HEADER.unpack_from (buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError ('Not an xkcd vocabulary trie (or wrong version).')
+
+        sections = list ()
+        pos = HEADER.size
+        for typecode, size in (('I', n_nodes + 1), ('I', n_nodes),
+                ('B', n_nodes)):
+            a = array (typecode)
+            a.frombytes (buf[pos:pos + a.itemsize * size])
+            if sys.byteorder == 'big':
+                a.byteswap ()
+            sections.append (a)
+            pos += a.itemsize * size
+        return cls (*sections)
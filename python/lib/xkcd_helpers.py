@@ -3,11 +3,18 @@ from urllib.request import Request, urlopen
 from bs4 import BeautifulSoup
 import bs4.element
 import json
+import tokenizer as TOKENIZER
+import time
+import threading
 
+XKCD_URL = "https://xkcd.com"
 EXPLAIN_URL = "http://www.explainxkcd.com/wiki/index.php"
 
 INC_STR = "This transcript is incomplete. Please help editing it! Thanks."
 
+# Seconds before giving up on a page, a stuck request would hold a worker
+TIMEOUT = 30
+
 
 #==============================================================================#
 #==============================================================================#
@@ -77,35 +84,10 @@ def getArgs (args):
 # Remove any  non alpha characters in a string
 # Doesn't remoe ' ' nor '-' if surrounded by alpha chars
 # p is as string
-# phrase (return value) is a string
+# phrase (return value) is a string, its words separated by single spaces
+# The work is done by tokenizer.tokens, use it directly to get the words
 def removePunk (p):
-    p = p.replace('\n', ' ')
-    phrase = str ()
-    for index, char in enumerate(p):
-        if char.isalpha () or char.isdigit ():
-            phrase += char
-        elif char == ' ':
-            # If in the middle of the string
-            if index - 1 > 0 and index + 1 < len (p):
-                if p[index - 1].isalpha ():
-                    phrase += char
-                else:
-                   phrase += ' '
-            else:
-                phrase += ' '
-        elif char == '-':
-            if index - 1 > 0 and index + 1 < len (p):
-                # If in the middle of a word
-                if p[index - 1].isalpha () and p[index + 1].isalpha ():
-                    phrase += char
-                else:
-                    phrase += ' '
-            else:
-                phrase += ' '
-        else:
-            phrase += ' '
-
-    return phrase.lower ()
+    return ' '.join (TOKENIZER.tokens (p))
 
 #==============================================================================#
 #==============================================================================#
@@ -159,16 +141,18 @@ def indexPhrase (phrase, comic_number, index):
 # comic is a string
 # comic_number is an int
 # index is dict
-# black_list is a list
+# black_list is a set (see tokenizer.stop_words)
 def indexComic (comic, comic_number, index, black_list):
-    phrase = comic.split (' ')
-    
+    indexTokens (comic.split (' '), comic_number, index, black_list)
+
+# Same as indexComic for words coming from an iterable (i.e. the generator
+# of tokenizer.tokens), nothing is built in between
+def indexTokens (tokens, comic_number, index, black_list):
     # Magic happens here: 
     # remove empty string, whitespaces and stop words from the list
-    phrase = [ x for x in phrase if x and not (x == ' ' or x in black_list) ]
-       
-    #removeBlack (phrase, black_list)
-    indexPhrase (phrase, comic_number, index)
+    for x in tokens:
+        if x and not (x == ' ' or x in black_list):
+            indexWord (x, comic_number, index)
 
 #==============================================================================#
 #==============================================================================#
@@ -205,7 +189,7 @@ def get_transcript (number=''):
             headers={'User-Agent': 'Mozilla/5.0'})
     try:
         # Get page and create xml tree
-        raw = urlopen(request).read ()
+        raw = urlopen(request, timeout = TIMEOUT).read ()
         soup = BeautifulSoup (raw, 'html.parser')
         #return soup
         # Check if the transcript is complete
@@ -233,7 +217,8 @@ def get_transcript (number=''):
         result['tr'] = transcript
         return result
     except urllib.error.HTTPError as uehe: # shrug
-        result['status'] = -1
+        # The wiki being down isn't an answer about the comic
+        result['status'] = -3 if uehe.code >= 500 else -1
         result['error'] = uehe
         return result
     except IndexError as ie: # If there is no #Transript id on the page
@@ -270,17 +255,18 @@ def transcript_is_complete(soup):
 # Duplicated from lib/client
 def get_xkcd(number = 0):
     if number is 0:
-        url ='https://xkcd.com/info.0.json'
+        url = XKCD_URL + '/info.0.json'
     else:
-        url = 'https://xkcd.com/{}/info.0.json'.format (number)
+        url = '{}/{}/info.0.json'.format (XKCD_URL, number)
 
     response = {'status': 0, 'error': '', 'comic': ""}
 
     try:
-        online_comic = urlopen(url).read ()
+        online_comic = urlopen(url, timeout = TIMEOUT).read ()
         response['comic'] = json.loads (online_comic.decode('utf-8'))
-    except urllib.error.HTTPError:
-        response['status'] = -1
+    except urllib.error.HTTPError as e:
+        # -1: no such comic (404), -2: try again later
+        response['status'] = -2 if e.code >= 500 else -1
     except IOError:
         response['status'] = -2
     except:
@@ -289,3 +275,66 @@ def get_xkcd(number = 0):
     return response
 
 #==============================================================================##==============================================================================#
+
+# Space the requests made to a host, from any number of threads
+# rate is the maximum number of requests per second
+class RateLimiter:
+    def __init__ (self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = threading.Lock ()
+
+    # Block until the caller is allowed to send its request
+    def wait (self):
+        with self._lock:
+            now = time.monotonic ()
+            slot = max (now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep (slot - now)
+
+#==============================================================================#
+#==============================================================================#
+
+# Build the reference entry of a comic, as saved in xkcd.references.json
+# Only gets the comic from xkcd.com, see needs_transcript/add_transcript
+# limiter is the RateLimiter of xkcd.com
+# Raises IOError if xkcd.com couldn't be reached: that isn't something to
+# save about the comic, it has to be fetched again
+def fetch_comic (number, limiter):
+    limiter.wait ()
+    temp_xkcd = get_xkcd (number)
+    if temp_xkcd['status'] not in (0, -1):
+        raise IOError ('xkcd.com: comic {} not fetched'.format (number))
+    ref = {
+            'comic': temp_xkcd['comic'],
+            'stat_com': {
+                'status': temp_xkcd['status'], 'error': temp_xkcd['error']},
+            'stat_tr': {'status': 0, 'error': '', 'complete': 0}}
+
+    if temp_xkcd['status'] != 0:
+        ref['stat_tr'] = {'status': -3, 'error': 'xkcd', 'complete': -3}
+
+    return ref
+
+# True if the transcript has to be taken from explainxkcd
+def needs_transcript (ref):
+    return ref['stat_com']['status'] == 0 and not ref['comic']['transcript']
+
+# Fill the transcript of a reference entry from explainxkcd
+# limiter is the RateLimiter of explainxkcd
+# Raises IOError if explainxkcd couldn't be reached, like fetch_comic
+def add_transcript (number, ref, limiter):
+    limiter.wait ()
+    temp_tr = get_transcript (number)
+    if temp_tr['status'] == -3:
+        raise IOError ('explainxkcd: comic {} not fetched: {}'.format (
+            number, temp_tr['error']))
+    ref['comic']['transcript'] = temp_tr['tr']
+    ref['stat_tr']['status'] = temp_tr['status']
+    # Exceptions can't go in json
+    ref['stat_tr']['error'] = str (temp_tr['error'])
+    return ref
+
+#==============================================================================#
+#==============================================================================#
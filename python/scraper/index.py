@@ -1,40 +1,221 @@
 #!/usr/bin/python
 
+# Build the search index from the comic references
+#   python index.py         -> only re-index the comics which changed since
+#                              the last run, the changes go in the delta
+#   python index.py --full  -> rebuild the whole index (folds the delta in)
+#   --packed                -> write the compressed index (.pack) instead of
+#                              the compiled one (.bin), see packed_index
+#   --positions             -> also write the positional index, always from
+#                              every comic (phrase and proximity search)
+#   --jobs N                -> full build in N worker processes (one for each
+#                              core if N is left out), same files as serial
+# The index, the comics and the stop words are also written pre-parsed
+# in one file (xkcd.snapshot) the bot starts from, see snapshot.
+# The first run is always a full one. The time of each stage is printed.
+
+import os
 import sys
 sys.path.insert (0, '/home/nhatz/Code/bots/randi/python/lib')
 import json
+import time
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 import client_helpers as CLIENT
-import xkcd_helpers as XKCD
+import tokenizer as TOKENIZER
+import index_delta as DELTA
+import snapshot as SNAPSHOT
+import atomic_file as ATOMIC
+import refs_jsonl as REFS_JSONL
+from compiled_index import CompiledIndex
+from packed_index import PackedIndex
+from refs_store import RefStore
+from vocab_trie import VocabTrie
+from positional_index import PositionalIndex
+from index_shard import comic_text, comic_words, content_hash, \
+        index_shard, index_range, merge_shards
 
 PREPATH = '/home/nhatz/Code/bots/randi/'
-REFS = PREPATH + 'json/xkcd.references.json'
+# One comic per line, read lazily (see refs_jsonl)
+REFS = PREPATH + 'json/xkcd.references.jsonl'
+# Before transcript.py converted it
+OLD_REFS = PREPATH + 'json/xkcd.references.json'
 #INDEX = PREPATH + 'json/xkcd.index.json'
 INDEX = 'xkcd.index.json'
+# Compiled version of the index, loaded by the bot instead of the json if found
+INDEX_BIN = 'xkcd.index.bin'
+# Same thing compressed, smaller but decoded when a word is looked up
+INDEX_PACK = 'xkcd.index.pack'
+# Changes since the last full build, merged by the bot when it loads the index
+INDEX_DELTA = 'xkcd.index.delta.json'
+# What each comic looked like when it was indexed:
+# {'version': STATE_VERSION, 'comics': {num: {hash, words}}}
+INDEX_STATE = 'xkcd.index.state.json'
+# Changes when the way comics are hashed changes, forcing a full build
+STATE_VERSION = 2
+# Trie of every indexed word (base and delta), for the fuzzy search of the bot
+INDEX_TRIE = 'xkcd.index.trie'
+# Positions of the words in each comic, only with --positions
+INDEX_POS = 'xkcd.index.pos'
+# Memory mapped references, used by the bot when shared_data is set
+REFS_BIN = 'xkcd.references.bin'
+# Everything the bot loads at startup, written last: it has to be newer than
+# the files it's made from (the bot doesn't use it otherwise)
+SNAPSHOT_FILE = 'xkcd.snapshot'
 BLACK_LIST = PREPATH + 'json/xkcd.common.json'
+# Comics per shard of a parallel build, small enough to keep workers busy
+SHARD_SIZE = 128
+
+# (stage, seconds), printed at the end
+timings = list ()
+
+@contextmanager
+def stage (name):
+    start = time.perf_counter ()
+    yield
+    timings.append ((name, time.perf_counter () - start))
+
+# Number of workers asked with --jobs, 0 for a serial build
+def jobs ():
+    if not '--jobs' in sys.argv:
+        return 0
+    i = sys.argv.index ('--jobs')
+    if i + 1 < len (sys.argv) and sys.argv[i + 1].isdigit ():
+        return int (sys.argv[i + 1])
+    return os.cpu_count () or 1
+
+# Generator over the (comic number, ref) of the references
+# Every pass over the references reads the file again, one comic at a time,
+# instead of keeping all of them
+# The file may not be compacted yet (a run of transcript.py which failed):
+# a comic fetched again has several lines, only its last one is read
+def references ():
+    if os.path.exists (REFS):
+        return REFS_JSONL.iter_last (REFS)
+    # Not converted yet (transcript.py does it), read at once
+    return iter (CLIENT.loadJson (OLD_REFS).items ())
+
+# Index every comic, in worker processes if asked to
+# Consecutive ranges of comics are indexed apart then merged in order, so
+# the index (down to the order of its keys) is the one of a serial build
+# Only the range goes to a worker, it reads its comics from REFS itself
+# (the old json references are read at once, the build is then serial)
+def index_all (black_list, workers):
+    if workers < 2 or not os.path.exists (REFS):
+        with stage ('index'):
+            return index_shard (references (), black_list)
+
+    with stage ('ranges'):
+        nums = sorted (int (i) for i in REFS_JSONL.nums (REFS))
+        ranges = [(nums[k], nums[min (k + SHARD_SIZE, len (nums)) - 1])
+                for k in range (0, len (nums), SHARD_SIZE)]
+    # fork: the workers don't import this script again
+    context = multiprocessing.get_context ('fork')
+    name = 'index ({} workers, {} shards)'.format (workers, len (ranges))
+    with stage (name):
+        with ProcessPoolExecutor (workers, mp_context = context) as pool:
+            results = list (pool.map (index_range,
+                [REFS] * len (ranges),
+                [first for first, last in ranges],
+                [last for first, last in ranges],
+                [black_list] * len (ranges)))
+    with stage ('merge'):
+        return merge_shards (results)
+
+with stage ('load'):
+    black_list = TOKENIZER.stop_words (BLACK_LIST)
+
+state = dict ()
+if os.path.exists (INDEX_STATE):
+    state = CLIENT.loadJson (INDEX_STATE)
+
+FULL = '--full' in sys.argv \
+        or state.get ('version') != STATE_VERSION \
+        or not state.get ('comics') \
+        or not os.path.exists (INDEX)
+
+if FULL:
+    state = {'version': STATE_VERSION, 'comics': dict ()}
+comics = state['comics']
+
+if FULL:
+    index, indexed = index_all (black_list, jobs ())
+    comics.update (indexed)
+
+    # save file
+    with stage ('write json'):
+        with open (INDEX, 'w') as outfile:
+            json.dump (index, outfile, indent = 4)
+
+    # Only one of them, the bot would take the .bin first
+    kind, out, other = CompiledIndex, INDEX_BIN, INDEX_PACK
+    if '--packed' in sys.argv:
+        kind, out, other = PackedIndex, INDEX_PACK, INDEX_BIN
+    with stage ('write ' + out):
+        kind.from_dict (index).save (out)
+    if os.path.exists (other):
+        os.remove (other)
+    if os.path.exists (INDEX_DELTA):
+        os.remove (INDEX_DELTA)
+    print ('Indexed {} comics.'.format (len (comics)))
+else:
+    with stage ('index changes'):
+        delta = DELTA.load (INDEX_DELTA)
+        changed = 0
+        seen = set ()
+
+        for i, ref in references ():
+            seen.add (i)
+            complete_str = comic_text (ref)
+            h = content_hash (complete_str)
+            old = comics.get (i, {'hash': None, 'words': list ()})
+            if old['hash'] == h:
+                continue
+
+            # If the comic wasn't changed since the full build, the words
+            # it has in the base index are the ones from the state
+            words = comic_words (complete_str, i, black_list)
+            DELTA.replace_comic (delta, i, old['words'], old['words'], words)
+            comics[i] = {'hash': h, 'words': list (words)}
+            changed += 1
+
+        # Comics which disappeared from the references
+        for i in [i for i in comics if not i in seen]:
+            DELTA.replace_comic (delta, i, comics[i]['words'],
+                    comics[i]['words'], None)
+            del comics[i]
+            changed += 1
+
+        if changed:
+            DELTA.save (INDEX_DELTA, delta)
+        print ('{} comic(s) re-indexed, {} in the delta.'.format (
+            changed, len (delta['removed'])))
 
-index = dict ()
-refs = CLIENT.loadJson (REFS)
-black_list = CLIENT.loadJson (BLACK_LIST)
+with stage ('write state'):
+    with ATOMIC.replacing (INDEX_STATE) as outfile:
+        json.dump (state, outfile)
 
-for i in list(refs.keys ()):
-    transcript = str ()
-    title = str ()
-    alt = str ()
-    complete_str = str ()
+# The state has the words of every comic as they are now
+with stage ('write ' + INDEX_TRIE):
+    words = {w for c in comics.values () for w in c['words']}
+    VocabTrie.build (words).save (INDEX_TRIE)
 
-    #FIXME: I really need to fix these magic numbers
-    if refs[i]['stat_com']['status'] == 0:
-        # Retrieve the comic info from the references
-        title = refs[i]['comic']['title']
-        alt = refs[i]['comic']['alt']
-        if refs[i]['stat_tr']['status'] >= -1:
-            transcript = XKCD.removeNoise (refs[i]['comic']['transcript'])
+if '--positions' in sys.argv:
+    with stage ('write ' + INDEX_POS):
+        PositionalIndex.build (
+                ((i, list (TOKENIZER.tokens (comic_text (ref))))
+                    for i, ref in references ()),
+                stop = black_list).save (INDEX_POS)
 
-    complete_str = XKCD.removePunk('{} {} {}'.format(title, alt,  transcript)) 
+with stage ('write ' + REFS_BIN):
+    RefStore.build (references (), REFS_BIN)
 
-    # Record the comic in the index
-    XKCD.indexComic (complete_str, i, index, black_list)
+# The index as the bot would load it, delta merged
+with stage ('write ' + SNAPSHOT_FILE):
+    SNAPSHOT.write (SNAPSHOT_FILE, CLIENT.loadIndex (INDEX), references (),
+            black_list)
 
-# save file
-with open (INDEX, 'w') as outfile:
-    json.dump (index, outfile, indent = 4)
+timings.append (('total', sum (seconds for name, seconds in timings)))
+for name, seconds in timings:
+    print ('{:<40}{:>10.1f} ms'.format (name, seconds * 1000))
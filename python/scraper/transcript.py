@@ -9,20 +9,26 @@ sys.path.insert (0, '/home/nhatz/Code/bots/randi/python/lib')
 PROMPT = "[xkcd Parser]"
 PREPATH = '/home/nhatz/Code/GitHub/bots/randi/'
 
-#REFS = PREPATH + 'json/xkcd.references.json'
-REFS = 'xkcd.references.json'
+#REFS = PREPATH + 'json/xkcd.references.jsonl'
+# One comic per line, see refs_jsonl
+REFS = 'xkcd.references.jsonl'
+# What was there before, converted on the first run
+OLD_REFS = 'xkcd.references.json'
 
 try:
     print (PROMPT + " Loading dependencies.")
-    from splinter import Browser
+    import os
     import json
+    import queue
+    from concurrent.futures import ThreadPoolExecutor
     import xkcd_helpers
+    import refs_jsonl as REFS_JSONL
     print (PROMPT + " Dependencies loaded.")
 except ModuleNotFoundError:
     print (PROMPT + " Missing or broke dependencies.\n \
             \tMake sure:\n \
                     \t\txkcd_helper.py exists in ./\n \
-                    \t\tsplinter is installed")
+                    \t\tbs4 is installed")
     traceback.print_exc()
     exit (1)
 
@@ -30,80 +36,167 @@ except ModuleNotFoundError:
 # FILE LOADING                                                                 #
 #==============================================================================#
 
-XKCD = dict ()
-try:
-    print (PROMPT + " Loading references")
-    with open (REFS) as infile:
-        XKCD = json.load (infile)
-    print (PROMPT + " References loaded")
-except FileNotFoundError:
-    xkcd_helpers.fileNotFound (PROMPT, REFS)
-    traceback.print_exc()
+# The references are never loaded: the fetched comics are appended to refs
+# as they come (see FETCHING)
+def convert (refs, old_refs):
+    if not os.path.exists (refs) and os.path.exists (old_refs):
+        print (PROMPT + " Converting " + old_refs + " to " + refs)
+        with open (old_refs) as infile:
+            old = json.load (infile)
+        REFS_JSONL.write (refs,
+                sorted (old.items (), key = lambda x: int (x[0])))
 
 #==============================================================================#
 # ARGUMENT CHECK                                                               #
 #==============================================================================#
 
-args = xkcd_helpers.getArgs (sys.argv [1:])
-if (args [0] == 0): # Success
-    print (PROMPT + \
-            " Requested fetch: " + str (args [1])  + " to " + str (args [2]))
-elif (args [0] == -1): #  
-    print (PROMPT + \
-            " Insufficient arguments. Provide one or two numbers.")
-    exit (2)
-elif (args [0] == -2):
-    print (PROMPT + \
-            " Invalid arguments. Provide numbers.")
-    exit (3)
-else:
-    print (PROMPT + \
-            " Unexpected return code from args retrieving. Stoping script.")
-    exit (6)
+# The first and last comic to fetch, exits if sys.argv doesn't have them
+def requested (argv):
+    args = xkcd_helpers.getArgs (argv)
+    if (args [0] == 0): # Success
+        print (PROMPT + \
+                " Requested fetch: " + str (args [1])  + " to " + str (args [2]))
+        return args [1], args [2]
+    elif (args [0] == -1): #  
+        print (PROMPT + \
+                " Insufficient arguments. Provide one or two numbers.")
+        exit (2)
+    elif (args [0] == -2):
+        print (PROMPT + \
+                " Invalid arguments. Provide numbers.")
+        exit (3)
+    else:
+        print (PROMPT + \
+                " Unexpected return code from args retrieving. Stoping script.")
+        exit (6)
 
 #==============================================================================#
 # FETCHING                                                                     #
 #==============================================================================#
+# Two stages, each with its own pool of workers and its own rate limit:
+#   xkcd    : comic info from xkcd.com, for every comic
+#   explain : transcript from explainxkcd, only if xkcd.com has none
+# A comic leaves the pipeline once both are done and is appended to refs
+# right away. If the script stops, the next run for the same comics starts
+# from there: the .run file holds the requested comics and where refs ended
+# when the run started, the lines after that are the comics already done.
+
+WORKERS = {'xkcd': 8, 'explain': 4}
+RATES = {'xkcd': 5, 'explain': 2} # requests per second
+
+def run_file (refs):
+    return refs + '.run'
+
+# The run of first to last: the one of the .run file if it is for the same
+# comics (the previous run stopped before the end), a new one otherwise
+def start_run (refs, first, last):
+    # Cut a line left half written by a crash before measuring refs
+    REFS_JSONL.open_append (refs).close ()
+    run = None
+    if os.path.exists (run_file (refs)):
+        with open (run_file (refs)) as infile:
+            run = json.load (infile)
+    if run is None or [run['first'], run['last']] != [first, last]:
+        run = {
+                'first': first,
+                'last': last,
+                'offset': os.path.getsize (refs)}
+        with open (run_file (refs), 'w') as outfile:
+            json.dump (run, outfile)
+    return run
+
+# Fetch the comics nums and append them to refs
+# Returns the number of comics which failed, they aren't in refs
+def fetch_all (nums, refs, rates = RATES, workers = WORKERS):
+    limiters = {host: xkcd_helpers.RateLimiter (rates[host]) for host in rates}
+    pools = {host: ThreadPoolExecutor (max_workers = workers[host]) \
+            for host in workers}
+    finished = queue.Queue ()
+
+    # ref is None if something unexpected happened, the comic is then left
+    # out of refs and will be fetched again by the next run
+    def transcript_stage (i, ref):
+        try:
+            xkcd_helpers.add_transcript (i, ref, limiters['explain'])
+        except:
+            traceback.print_exc ()
+            ref = None
+        finished.put ((i, ref))
+
+    def comic_stage (i):
+        try:
+            ref = xkcd_helpers.fetch_comic (i, limiters['xkcd'])
+        except:
+            traceback.print_exc ()
+            finished.put ((i, None))
+            return
+
+        if xkcd_helpers.needs_transcript (ref):
+            pools['explain'].submit (transcript_stage, i, ref)
+        else:
+            finished.put ((i, ref))
 
-print (PROMPT + " Starting fetch...")
-# last + 1 because we need to access the last element
-for i in range(args [1], args [2] + 1):
-        print ('{} Retrieving {}'.format(PROMPT, i))
-        temp_xkcd = xkcd_helpers.get_xkcd(i)
-        XKCD[i] = {\
-                'comic': temp_xkcd['comic'], \
-                'stat_com': {\
-                'status': temp_xkcd['status'], 'error': temp_xkcd['error']}, \
-                'stat_tr': {'status': 0, 'error': '', 'complete': 0}}
-        
-        if temp_xkcd['status'] != 0: 
-            XKCD[i]['stat_tr'] = \
-                    {'status': -3, 'error': 'xkcd', 'complete': -3}
-        elif not temp_xkcd['comic']['transcript']:
-            temp_tr = xkcd_helpers.get_transcript(i)
-            XKCD[i]['comic']['transcript'] = temp_tr['tr']
-            XKCD[i]['stat_tr']['status'] = temp_tr['status']
-            XKCD[i]['stat_tr']['error'] = temp_tr['error']
-        
-        print ('{} Comic {} referenced.'.format(PROMPT, i))
+    print (PROMPT + " Starting fetch...")
+    for i in nums:
+        pools['xkcd'].submit (comic_stage, i)
 
+    failed = 0
+    with REFS_JSONL.open_append (refs) as outfile:
+        for n in range (len (nums)):
+            i, ref = finished.get ()
+            if ref is None:
+                failed += 1
+                print ('{} Comic {} failed, run again to retry.'.format (
+                    PROMPT, i))
+                continue
+
+            REFS_JSONL.append (outfile, i, ref)
+            print ('{} Comic {} referenced. ({}/{})'.format (
+                PROMPT, i, n + 1, len (nums)))
+
+    for pool in pools.values ():
+        pool.shutdown ()
+
+    return failed
 
 #==============================================================================#
 # FILES SAVING                                                                 #
 #==============================================================================#
 
-try:
-    print (PROMPT + " Saving comic references in " + REFS)
-    with open (REFS, 'w') as outfile:
-        f = open(REFS, 'w').close()
-        json.dump (XKCD, outfile, indent = 4)
-        
-    print (PROMPT + " Comic references succesfully saved.")
-except:
-    print (PROMPT + " Something went wrong while saving the comic file. \
-            \n\tThat's not to bad.")
-    traceback.print_exc()
+# Every comic is already on disk, this only puts them back in order (a
+# comic fetched again has two lines until then)
+def finish (refs):
+    try:
+        print (PROMPT + " Compacting " + refs)
+        REFS_JSONL.compact (refs)
+        os.remove (run_file (refs))
+        print (PROMPT + " Comic references succesfully saved.")
+    except:
+        print (PROMPT + " Something went wrong while compacting the comic file. \
+                \n\tThat's not to bad, " + refs + " is still whole.")
+        traceback.print_exc()
 
 #==============================================================================#
-print (PROMPT + " Done.")
-#==============================================================================#
+
+# Fetch the comics first to last which aren't in refs since the start of
+# the run. Returns the number of comics which failed
+def scrape (first, last, refs = REFS, rates = RATES, workers = WORKERS):
+    run = start_run (refs, first, last)
+    done = REFS_JSONL.nums (refs, start = run['offset'])
+    # last + 1 because we need to access the last element
+    todo = [i for i in range (first, last + 1) if not str (i) in done]
+    if done:
+        print ('{} Resuming: {} comic(s) already done'.format (
+            PROMPT, len (done)))
+
+    failed = fetch_all (todo, refs, rates, workers)
+    # Not if some failed: the next run has to find where this one started
+    if not failed:
+        finish (refs)
+    return failed
+
+if __name__ == '__main__':
+    convert (REFS, OLD_REFS)
+    first, last = requested (sys.argv [1:])
+    scrape (first, last)
+    print (PROMPT + " Done.")
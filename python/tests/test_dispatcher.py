@@ -0,0 +1,78 @@
+#!/usr/bin/python
+
+# dispatcher.Dispatcher: the commands turned down and the replies to them
+#
+# Usage: python -m pytest python/tests (or python -m unittest from here)
+
+import os
+import sys
+import asyncio
+import unittest
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+sys.path.insert (0, os.path.join (HERE, '..', 'lib'))
+
+import dispatcher as DISPATCHER
+
+class DispatcherTest (unittest.TestCase):
+    def run_async (self, coro):
+        return asyncio.run (coro)
+
+    # Commands which wait until done is set
+    def dispatcher (self, **kwargs):
+        self.done = asyncio.Event ()
+        async def handler (*args):
+            await self.done.wait ()
+        d = DISPATCHER.Dispatcher (handler, **kwargs)
+        d.start ()
+        return d
+
+    # Replies which would be sent for the commands of user in guild
+    def flood (self, d, user, guild, n):
+        told = list ()
+        for i in range (n):
+            reason = d.submit (user, guild)
+            if reason is not None and d.tell (user, guild, reason):
+                told.append (reason)
+        return told
+
+    def test_user_told_once (self):
+        async def run ():
+            d = self.dispatcher (workers = 1, per_user = 1)
+            told = self.flood (d, 'u', 'g', 10)
+            self.assertEqual (d.shed, 9)
+            # Another user isn't limited
+            self.assertIsNone (d.submit ('v', 'g'))
+            self.assertEqual (self.flood (d, 'v', 'g', 3), [DISPATCHER.USER])
+            return told
+        self.assertEqual (self.run_async (run ()), [DISPATCHER.USER])
+
+    # The streak is over once a command went through
+    def test_new_streak (self):
+        async def run ():
+            d = self.dispatcher (workers = 1, per_user = 1)
+            first = self.flood (d, 'u', 'g', 3)
+            self.done.set ()
+            await asyncio.sleep (0)
+            await asyncio.sleep (0)
+            self.done.clear ()
+            second = self.flood (d, 'u', 'g', 3)
+            return first, second
+        first, second = self.run_async (run ())
+        self.assertEqual (first, [DISPATCHER.USER])
+        self.assertEqual (second, [DISPATCHER.USER])
+
+    def test_busy_once_per_guild (self):
+        async def run ():
+            d = self.dispatcher (workers = 1, size = 1, per_user = 10)
+            # One running, one in the queue
+            d.submit ('u', 'g')
+            await asyncio.sleep (0)
+            d.submit ('u', 'g')
+            return self.flood (d, 'u', 'g', 5) + self.flood (d, 'v', 'g', 5) \
+                    + self.flood (d, 'w', 'h', 5)
+        self.assertEqual (self.run_async (run ()),
+                [DISPATCHER.BUSY, DISPATCHER.BUSY])
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,252 @@
+#!/usr/bin/python
+
+# http_client.AsyncHTTP against a stub server on 127.0.0.1
+#
+# Usage: python -m pytest python/tests (or python -m unittest from here)
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import unittest
+import threading
+import urllib.error
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+sys.path.insert (0, os.path.join (HERE, '..', 'lib'))
+
+from http_client import AsyncHTTP
+
+COMIC = {'num': 1, 'title': 'Barrel - Part 1', 'alt': "Don't we all.",
+        'img': 'https://imgs.xkcd.com/comics/barrel_cropped_(1).jpg'}
+
+# Answers like xkcd.com, on keep-alive connections:
+#   /info.0.json, /1/info.0.json: a comic
+#   /404/info.0.json            : 404
+#   /broken                     : 500
+#   /garbage                    : 200, not json
+#   /moved                      : 301 to /info.0.json
+#   /close                      : a comic, then the server closes
+#   /slow                       : answers after SLOW seconds
+#   /wait                       : answers after WAIT seconds, counts the
+#                                 requests in flight
+SLOW = 2
+WAIT = 0.2
+
+class Stub (BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message (self, *args):
+        pass
+
+    def _send (self, status, body = b'', headers = None):
+        self.send_response (status)
+        for k, v in (headers or dict ()).items ():
+            self.send_header (k, v)
+        self.send_header ('Content-Length', str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def do_GET (self):
+        server = self.server
+        with server.lock:
+            server.ports.append (self.client_address[1])
+            server.agents.append (self.headers.get ('User-Agent'))
+
+        if self.path in ('/info.0.json', '/1/info.0.json'):
+            self._send (200, json.dumps (COMIC).encode ())
+        elif self.path == '/404/info.0.json':
+            self._send (404)
+        elif self.path == '/broken':
+            self._send (500)
+        elif self.path == '/garbage':
+            self._send (200, b'<html>')
+        elif self.path == '/moved':
+            self._send (301, headers = {'Location': '/info.0.json'})
+        elif self.path == '/close':
+            self.close_connection = True
+            self._send (200, json.dumps (COMIC).encode (),
+                    {'Connection': 'close'})
+        elif self.path == '/slow':
+            time.sleep (SLOW)
+            self._send (200, b'late')
+        elif self.path == '/wait':
+            with server.lock:
+                server.in_flight += 1
+                server.max_in_flight = max (
+                        server.max_in_flight, server.in_flight)
+            time.sleep (WAIT)
+            with server.lock:
+                server.in_flight -= 1
+            self._send (200, b'done')
+        else:
+            self._send (404)
+
+class StubServer (ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__ (self):
+        super ().__init__ (('127.0.0.1', 0), Stub)
+        self.lock = threading.Lock ()
+        self.ports = list ()
+        self.agents = list ()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    # The client gave up on a slow answer (timeout tests)
+    def handle_error (self, request, client_address):
+        pass
+
+    @property
+    def url (self):
+        return 'http://127.0.0.1:{}'.format (self.server_address[1])
+
+class StubTest (unittest.TestCase):
+    def setUp (self):
+        self.server = StubServer ()
+        self.thread = threading.Thread (target = self.server.serve_forever,
+                daemon = True)
+        self.thread.start ()
+        self.http = AsyncHTTP (max_connections = 2, timeout = 5)
+
+    def tearDown (self):
+        self.http.close ()
+        self.server.shutdown ()
+        self.server.server_close ()
+        self.thread.join ()
+
+    def run_async (self, coro):
+        return asyncio.run (coro)
+
+class AsyncHTTPTest (StubTest):
+    def test_get_json (self):
+        comic = self.run_async (
+                self.http.get_json (self.server.url + '/info.0.json'))
+        self.assertEqual (comic, COMIC)
+        self.assertTrue (self.server.agents[0].startswith ('Mozilla/5.0'))
+
+    def test_keep_alive (self):
+        http = AsyncHTTP (max_connections = 1, timeout = 5)
+        async def fetch ():
+            for i in range (5):
+                await http.get (self.server.url + '/1/info.0.json')
+        try:
+            self.run_async (fetch ())
+        finally:
+            http.close ()
+        # One thread, one connection: every request came from the same port
+        self.assertEqual (len (self.server.ports), 5)
+        self.assertEqual (len (set (self.server.ports)), 1)
+
+    def test_closed_connection (self):
+        http = AsyncHTTP (max_connections = 1, timeout = 5)
+        async def fetch ():
+            await http.get (self.server.url + '/close')
+            return await http.get_json (self.server.url + '/info.0.json')
+        try:
+            comic = self.run_async (fetch ())
+        finally:
+            http.close ()
+        # The server closed the first connection, a new one was made
+        self.assertEqual (comic, COMIC)
+        self.assertEqual (len (set (self.server.ports)), 2)
+
+    def test_timeout (self):
+        start = time.monotonic ()
+        with self.assertRaises (OSError):
+            self.run_async (self.http.get (
+                self.server.url + '/slow', timeout = 0.3))
+        self.assertLess (time.monotonic () - start, SLOW)
+
+    def test_default_timeout (self):
+        http = AsyncHTTP (max_connections = 1, timeout = 0.3)
+        try:
+            with self.assertRaises (OSError):
+                self.run_async (http.get (self.server.url + '/slow'))
+        finally:
+            http.close ()
+
+    def test_max_connections (self):
+        async def fetch ():
+            return await asyncio.gather (*(
+                self.http.get (self.server.url + '/wait') for i in range (6)))
+        start = time.monotonic ()
+        bodies = self.run_async (fetch ())
+        self.assertEqual (bodies, [b'done'] * 6)
+        self.assertEqual (self.server.max_in_flight, 2)
+        # 6 requests, 2 at a time
+        self.assertGreaterEqual (time.monotonic () - start, 3 * WAIT)
+
+    def test_not_found (self):
+        with self.assertRaises (urllib.error.HTTPError) as e:
+            self.run_async (self.http.get (
+                self.server.url + '/404/info.0.json'))
+        self.assertEqual (e.exception.code, 404)
+
+    def test_server_error (self):
+        with self.assertRaises (urllib.error.HTTPError) as e:
+            self.run_async (self.http.get (self.server.url + '/broken'))
+        self.assertEqual (e.exception.code, 500)
+
+    def test_redirect (self):
+        comic = self.run_async (
+                self.http.get_json (self.server.url + '/moved'))
+        self.assertEqual (comic, COMIC)
+
+    def test_not_json (self):
+        with self.assertRaises (ValueError):
+            self.run_async (self.http.get_json (self.server.url + '/garbage'))
+
+    def test_refused (self):
+        # A port nothing listens on
+        with socket.socket () as s:
+            s.bind (('127.0.0.1', 0))
+            port = s.getsockname ()[1]
+        with self.assertRaises (OSError):
+            self.run_async (self.http.get (
+                'http://127.0.0.1:{}/info.0.json'.format (port)))
+
+# get_online_xkcd on the stub: {'status': 0, 'comic': ...} or status -1 for
+# every error of AsyncHTTP
+class OnlineXkcdTest (StubTest):
+    def setUp (self):
+        try:
+            import discord
+        except ImportError:
+            self.skipTest ('needs discord.py')
+        super ().setUp ()
+        import client_helpers as CLIENT
+        self.client = CLIENT
+
+        # The urls of xkcd.com, sent to the stub
+        server, http = self.server, self.http
+        class Redirected:
+            async def get_json (self, url, headers = None, timeout = None):
+                return await http.get_json (
+                        url.replace ('https://xkcd.com', server.url),
+                        headers = headers, timeout = timeout)
+        self.saved = CLIENT.HTTP
+        CLIENT.HTTP = Redirected ()
+
+    def tearDown (self):
+        if hasattr (self, 'saved'):
+            self.client.HTTP = self.saved
+        super ().tearDown ()
+
+    def test_latest (self):
+        response = self.run_async (self.client.get_online_xkcd ())
+        self.assertEqual (response, {'status': 0, 'comic': COMIC})
+
+    def test_number (self):
+        response = self.run_async (self.client.get_online_xkcd (1))
+        self.assertEqual (response, {'status': 0, 'comic': COMIC})
+
+    def test_missing (self):
+        response = self.run_async (self.client.get_online_xkcd (404))
+        self.assertEqual (response['status'], -1)
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+
+# refs_jsonl on files which aren't compacted: a comic with several lines
+#
+# Usage: python -m pytest python/tests (or python -m unittest from here)
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+sys.path.insert (0, os.path.join (HERE, '..', 'lib'))
+
+import refs_jsonl as REFS_JSONL
+import tokenizer as TOKENIZER
+from index_shard import comic_text, index_shard, index_range, merge_shards
+from positional_index import PositionalIndex
+
+def ref (num, title, transcript):
+    return {
+            'comic': {'num': num, 'title': title, 'alt': 'alt text',
+                'img': 'https://imgs.xkcd.com/comics/{}.png'.format (num),
+                'transcript': transcript},
+            'stat_com': {'status': 0},
+            'stat_tr': {'status': 0}}
+
+OLD = ref (1, 'Barrel', 'oldword floats oldword')
+NEW = ref (1, 'Barrel', 'the boy floats away')
+OTHER = ref (2, 'Petit Trees', 'trees sheep oldword')
+
+class IterLastTest (unittest.TestCase):
+    def setUp (self):
+        self.dir = tempfile.mkdtemp ()
+        self.f = os.path.join (self.dir, 'xkcd.references.jsonl')
+        # Comic 1 fetched again after comic 2, not compacted
+        with open (self.f, 'w') as outfile:
+            for num, r in ((1, OLD), (2, OTHER), (1, NEW)):
+                outfile.write (json.dumps ({'num': num, 'ref': r}) + '\n')
+
+    def tearDown (self):
+        shutil.rmtree (self.dir)
+
+    def test_last_line_wins (self):
+        self.assertEqual (list (REFS_JSONL.iter_last (self.f)),
+                [('1', NEW), ('2', OTHER)])
+
+    def test_same_as_compacted (self):
+        items = list (REFS_JSONL.iter_last (self.f))
+        REFS_JSONL.compact (self.f)
+        self.assertEqual (list (REFS_JSONL.iter_refs (self.f)), items)
+
+    def test_cut_line (self):
+        with open (self.f, 'a') as outfile:
+            outfile.write ('{"num": 3, "ref": {"com')
+        self.assertEqual ([num for num, r in REFS_JSONL.iter_last (self.f)],
+                ['1', '2'])
+
+    def test_index (self):
+        index, comics = index_shard (REFS_JSONL.iter_last (self.f), ())
+        self.assertEqual (index['oldword'], {'2': 1})
+        self.assertEqual (index['boy'], {'1': 1})
+        self.assertEqual (set (comics), {'1', '2'})
+
+    def test_range (self):
+        self.assertEqual (list (REFS_JSONL.iter_last (self.f, 1, 1)),
+                [('1', NEW)])
+        self.assertEqual (list (REFS_JSONL.iter_last (self.f, 2)),
+                [('2', OTHER)])
+        self.assertEqual (list (REFS_JSONL.iter_last (self.f, 3, 9)), [])
+
+    def test_nums (self):
+        self.assertEqual (REFS_JSONL.nums (self.f), {'1', '2'})
+        with open (self.f, 'a') as outfile:
+            outfile.write ('{"num": 3, "ref": {"com')
+        self.assertEqual (REFS_JSONL.nums (self.f), {'1', '2'})
+
+    # index.py --jobs: each worker reads its range of comics
+    def test_index_ranges (self):
+        merged = merge_shards ([index_range (self.f, first, last, ())
+            for first, last in ((1, 1), (2, 2))])
+        self.assertEqual (merged, index_shard (
+            REFS_JSONL.iter_last (self.f), ()))
+
+    # index.py --positions
+    def test_positions (self):
+        positions = PositionalIndex.build (
+                ((i, list (TOKENIZER.tokens (comic_text (r))))
+                    for i, r in REFS_JSONL.iter_last (self.f)))
+        self.assertEqual (positions.positions ('oldword', 1), [])
+        self.assertEqual (len (positions.positions ('floats', 1)), 1)
+
+if __name__ == '__main__':
+    unittest.main ()
@@ -0,0 +1,236 @@
+#!/usr/bin/python
+
+# scraper/transcript.py against a stub of xkcd.com and explainxkcd on
+# 127.0.0.1
+#
+# Usage: python -m pytest python/tests (or python -m unittest from here)
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+import unittest.mock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+HERE = os.path.dirname (os.path.abspath (__file__))
+sys.path.insert (0, os.path.join (HERE, '..', 'lib'))
+sys.path.insert (0, os.path.join (HERE, '..', 'scraper'))
+
+try:
+    import bs4
+except ImportError:
+    bs4 = None
+else:
+    import refs_jsonl as REFS_JSONL
+    import xkcd_helpers
+    import transcript as TRANSCRIPT
+
+# Fast enough for the tests which don't look at the pacing
+FAST = {'xkcd': 1000, 'explain': 1000}
+
+# Odd comics have a transcript on xkcd.com, even ones only on explainxkcd
+def comic (num):
+    return {'num': num, 'title': 'Comic {}'.format (num), 'alt': 'alt',
+            'img': 'https://imgs.xkcd.com/comics/{}.png'.format (num),
+            'transcript': 'xkcd words' if num % 2 else ''}
+
+EXPLAIN = '''<html><body>
+<h2><span id="Transcript">Transcript</span></h2>
+<p>explain words</p>
+<h2><span id="Discussion">Discussion</span></h2>
+</body></html>'''
+
+# Answers like the two sites:
+#   /N/info.0.json         : comic N, 500 if N is in server.fail
+#   /wiki/index.php/N      : explainxkcd page of N, 500 if N is in
+#                            server.fail_explain
+class Stub (BaseHTTPRequestHandler):
+    def log_message (self, *args):
+        pass
+
+    def _send (self, status, body = b''):
+        self.send_response (status)
+        self.send_header ('Content-Length', str (len (body)))
+        self.end_headers ()
+        self.wfile.write (body)
+
+    def do_GET (self):
+        server = self.server
+        parts = self.path.strip ('/').split ('/')
+        with server.lock:
+            server.requests.append ((time.monotonic (), self.path))
+
+        if len (parts) == 2 and parts[1] == 'info.0.json':
+            num = int (parts[0])
+            if num in server.fail:
+                self._send (500)
+            else:
+                self._send (200, json.dumps (comic (num)).encode ())
+        elif parts[:2] == ['wiki', 'index.php']:
+            if int (parts[2]) in server.fail_explain:
+                self._send (500)
+            else:
+                self._send (200, EXPLAIN.encode ())
+        else:
+            self._send (404)
+
+class StubServer (ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__ (self):
+        super ().__init__ (('127.0.0.1', 0), Stub)
+        self.lock = threading.Lock ()
+        self.requests = list ()
+        self.fail = set ()
+        self.fail_explain = set ()
+
+    @property
+    def url (self):
+        return 'http://127.0.0.1:{}'.format (self.server_address[1])
+
+    # The comics asked to xkcd.com, in order
+    def comics (self):
+        return [int (path.split ('/')[1]) for t, path in self.requests
+                if path.endswith ('/info.0.json')]
+
+@unittest.skipIf (bs4 is None, 'needs bs4')
+class TranscriptTest (unittest.TestCase):
+    def setUp (self):
+        self.server = StubServer ()
+        self.thread = threading.Thread (target = self.server.serve_forever,
+                daemon = True)
+        self.thread.start ()
+        self.saved = xkcd_helpers.XKCD_URL, xkcd_helpers.EXPLAIN_URL
+        xkcd_helpers.XKCD_URL = self.server.url
+        xkcd_helpers.EXPLAIN_URL = self.server.url + '/wiki/index.php'
+
+        self.dir = tempfile.mkdtemp ()
+        self.refs = os.path.join (self.dir, 'xkcd.references.jsonl')
+        self.run_file = TRANSCRIPT.run_file (self.refs)
+
+    def tearDown (self):
+        xkcd_helpers.XKCD_URL, xkcd_helpers.EXPLAIN_URL = self.saved
+        self.server.shutdown ()
+        self.server.server_close ()
+        self.thread.join ()
+        shutil.rmtree (self.dir)
+
+    def scrape (self, first, last, rates = FAST):
+        return TRANSCRIPT.scrape (first, last, self.refs, rates = rates)
+
+    def lines (self):
+        with open (self.refs) as infile:
+            return [json.loads (line) for line in infile]
+
+    def test_fetch (self):
+        self.assertEqual (self.scrape (1, 4), 0)
+        refs = dict (REFS_JSONL.iter_refs (self.refs))
+        self.assertEqual (list (refs), ['1', '2', '3', '4'])
+        self.assertEqual (refs['1']['comic']['transcript'], 'xkcd words')
+        self.assertEqual (refs['2']['comic']['transcript'].strip (),
+                'explain words')
+        # Done: compacted, nothing to resume
+        self.assertEqual (len (self.lines ()), 4)
+        self.assertFalse (os.path.exists (self.run_file))
+
+    # Killed after comics 2 and 3 while writing 4: the lines before the
+    # offset of the .run file are from before the run, comic 1 is fetched
+    # again, 2 and 3 are kept
+    def test_resume (self):
+        before = {'comic': comic (1), 'stat_com': {'status': 0}}
+        REFS_JSONL.write (self.refs, [('1', before)])
+        with open (self.run_file, 'w') as outfile:
+            json.dump ({'first': 1, 'last': 4,
+                'offset': os.path.getsize (self.refs)}, outfile)
+        done = {'comic': dict (comic (2), title = 'Kept'),
+                'stat_com': {'status': 0}}
+        with REFS_JSONL.open_append (self.refs) as outfile:
+            REFS_JSONL.append (outfile, 2, done)
+            REFS_JSONL.append (outfile, 3, done)
+        with open (self.refs, 'a') as outfile:
+            outfile.write ('{"num": 4, "ref": {"com')
+
+        self.assertEqual (self.scrape (1, 4), 0)
+        self.assertEqual (sorted (self.server.comics ()), [1, 4])
+        refs = dict (REFS_JSONL.iter_refs (self.refs))
+        self.assertEqual (list (refs), ['1', '2', '3', '4'])
+        self.assertEqual (refs['2']['comic']['title'], 'Kept')
+        self.assertEqual (refs['4']['comic']['title'], 'Comic 4')
+        self.assertFalse (os.path.exists (self.run_file))
+
+    # Another range: a new run, the .run file of the old one is replaced
+    def test_other_run (self):
+        self.assertEqual (self.scrape (1, 2), 0)
+        self.assertEqual (self.scrape (1, 3), 0)
+        self.assertEqual (sorted (self.server.comics ()), [1, 1, 2, 2, 3])
+
+    def test_failed_fetch_retried (self):
+        self.server.fail = {3}
+        self.server.fail_explain = {2}
+        self.assertEqual (self.scrape (1, 4), 2)
+        # Neither is saved with an error, the run can be resumed
+        self.assertEqual (
+                [line['num'] for line in self.lines ()].count (3), 0)
+        self.assertEqual (
+                [line['num'] for line in self.lines ()].count (2), 0)
+        self.assertTrue (os.path.exists (self.run_file))
+
+        self.server.fail = set ()
+        self.server.fail_explain = set ()
+        del self.server.requests[:]
+        self.assertEqual (self.scrape (1, 4), 0)
+        self.assertEqual (sorted (self.server.comics ()), [2, 3])
+        refs = dict (REFS_JSONL.iter_refs (self.refs))
+        self.assertEqual (list (refs), ['1', '2', '3', '4'])
+        self.assertEqual (refs['2']['comic']['transcript'].strip (),
+                'explain words')
+        self.assertFalse (os.path.exists (self.run_file))
+
+    # A comic which doesn't exist is an answer, it is saved
+    def test_missing_comic_recorded (self):
+        with unittest.mock.patch.object (xkcd_helpers, 'XKCD_URL',
+                self.server.url + '/nothing'):
+            self.assertEqual (self.scrape (1, 1), 0)
+        refs = dict (REFS_JSONL.iter_refs (self.refs))
+        self.assertEqual (refs['1']['stat_com']['status'], -1)
+
+    # 8 workers, one request to xkcd.com every 1/rate seconds at most: the
+    # last one can't be sent before 7 intervals
+    def test_pacing (self):
+        rate = 20
+        start = time.monotonic ()
+        self.assertEqual (self.scrape (1, 8,
+            rates = {'xkcd': rate, 'explain': 1000}), 0)
+        times = sorted (t for t, path in self.server.requests
+                if path.endswith ('/info.0.json'))
+        self.assertEqual (len (times), 8)
+        self.assertGreaterEqual (times[-1] - start, 7 / rate)
+
+@unittest.skipIf (bs4 is None, 'needs bs4')
+class RateLimiterTest (unittest.TestCase):
+    def test_threads (self):
+        rate = 50
+        limiter = xkcd_helpers.RateLimiter (rate)
+        times = list ()
+        lock = threading.Lock ()
+        def wait ():
+            limiter.wait ()
+            with lock:
+                times.append (time.monotonic ())
+        start = time.monotonic ()
+        threads = [threading.Thread (target = wait) for i in range (10)]
+        for t in threads:
+            t.start ()
+        for t in threads:
+            t.join ()
+        # One slot each, the first one right away
+        self.assertEqual (len (times), 10)
+        self.assertGreaterEqual (max (times) - start, 9 / rate)
+        self.assertLess (min (times) - start, 1 / rate)
+
+if __name__ == '__main__':
+    unittest.main ()